@@ -3,6 +3,7 @@ import torch
 import torch.utils.data
 from munch import munchify
 
+from dlas.data.data_sampler import LengthBucketBatchSampler
 from dlas.utils.util import opt_get
 
 
@@ -10,14 +11,25 @@ def create_dataloader(dataset, dataset_opt, opt=None, sampler=None, collate_fn=N
     phase = dataset_opt['phase']
     pin_memory = opt_get(dataset_opt, ['pin_memory'], True)
     if phase == 'train':
+        world_size = 1
+        rank = 0
         if opt_get(opt, ['dist'], False):
             world_size = torch.distributed.get_world_size()
+            rank = torch.distributed.get_rank()
             num_workers = dataset_opt['n_workers']
             assert dataset_opt['batch_size'] % world_size == 0
             batch_size = dataset_opt['batch_size'] // world_size
         else:
             num_workers = dataset_opt['n_workers']
             batch_size = dataset_opt['batch_size']
+        if opt_get(dataset_opt, ['bucket_by_length'], False):
+            # The batch sampler splits batches between processes itself, in place of the given sampler.
+            batch_sampler = LengthBucketBatchSampler(dataset.get_wav_lengths(), batch_size,
+                                                     bucket_batches=opt_get(dataset_opt, ['bucket_batches'], 16),
+                                                     shuffle=shuffle or sampler is not None, drop_last=True,
+                                                     num_replicas=world_size, rank=rank)
+            return torch.utils.data.DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                                               pin_memory=pin_memory, collate_fn=collate_fn, persistent_workers=True)
         return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
                                            num_workers=num_workers, sampler=sampler, drop_last=True,
                                            pin_memory=pin_memory, collate_fn=collate_fn, persistent_workers=True)
@@ -77,10 +89,25 @@ def create_dataset(dataset_opt, return_collate=False):
     elif mode == 'paired_voice_audio':
         from dlas.data.audio.paired_voice_audio_dataset import \
             TextWavLoader as D
+        from dlas.data.audio.paired_voice_audio_dataset import \
+            TextWavCollate as C
+        from dlas.models.audio.tts.tacotron2 import create_hparams
+        default_params = create_hparams()
+        default_params.update(dataset_opt)
+        dataset_opt = munchify(default_params)
+        if opt_get(dataset_opt, ['bucket_by_length'], False):
+            collate = C()
+    elif mode == 'paired_voice_codes':
+        from dlas.data.audio.paired_voice_codes_dataset import \
+            TextCodeLoader as D
+        from dlas.data.audio.paired_voice_audio_dataset import \
+            TextWavCollate as C
         from dlas.models.audio.tts.tacotron2 import create_hparams
         default_params = create_hparams()
         default_params.update(dataset_opt)
         dataset_opt = munchify(default_params)
+        if opt_get(dataset_opt, ['bucket_by_length'], False):
+            collate = C()
     elif mode == 'fast_paired_voice_audio':
         from dlas.data.audio.fast_paired_dataset import \
             FastPairedVoiceDataset as D
@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import torch
+
+from dlas.data.audio.unsupervised_audio_dataset import load_audio
+
+
+def audio_shard_key(audiopath):
+    return os.path.normpath(audiopath)
+
+
+class AudioShardWriter:
+    """
+    Packs clips, resampled to a single sample rate, into flat int16 shard files plus an index of where each clip starts
+    and how long it is, which AudioShardStore reads back through memory maps.
+    """
+
+    def __init__(self, path, sample_rate=22050, shard_bytes=1024 * 1024 * 1024):
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.index = {
+            'sample_rate': sample_rate,
+            'entries': {},
+        }
+        self.shard = 0
+        self.offset = 0
+        self.file = None
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, audiopath, audio):
+        """
+        Adds a clip loaded with load_audio at the writer's sample rate.
+        """
+        samples = (audio.reshape(-1).clamp(-1, 1) * 32767).round().to(torch.int16).numpy()
+        if self.file is not None and self.offset > 0 and (self.offset + samples.shape[0]) * 2 > self.shard_bytes:
+            self.file.close()
+            self.file = None
+            self.shard += 1
+            self.offset = 0
+        if self.file is None:
+            self.file = open(os.path.join(self.path, f'audio_{self.shard:05d}.bin'), 'wb')
+        self.file.write(samples.tobytes())
+        self.index['entries'][audio_shard_key(audiopath)] = (self.shard, self.offset, samples.shape[0])
+        self.offset += samples.shape[0]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        # The index goes last, so shards that were interrupted while writing are never picked up.
+        torch.save(self.index, os.path.join(self.path, 'index.pth'))
+
+
+class AudioShardStore:
+    """
+    Reads back what AudioShardWriter wrote. Shards are memory mapped on first use in each process, so clips are sliced
+    straight out of the page cache, which all dataloader workers share, instead of being decoded and resampled again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        index = torch.load(os.path.join(path, 'index.pth'))
+        self.sample_rate = index['sample_rate']
+        self.entries = index['entries']
+        self.shards = {}
+
+    def __getstate__(self):
+        # Memory maps don't survive pickling (they'd be copied into memory); workers map the shards themselves.
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def __contains__(self, audiopath):
+        return audio_shard_key(audiopath) in self.entries
+
+    def get_shard(self, shard):
+        if shard not in self.shards:
+            self.shards[shard] = np.memmap(os.path.join(self.path, f'audio_{shard:05d}.bin'), dtype=np.int16,
+                                           mode='r')
+        return self.shards[shard]
+
+    def get_length(self, audiopath):
+        return self.entries[audio_shard_key(audiopath)][2]
+
+    def get(self, audiopath):
+        """
+        Returns a clip the way load_audio would: a (1, samples) float tensor in [-1, 1] at the store's sample rate.
+        """
+        shard, offset, length = self.entries[audio_shard_key(audiopath)]
+        audio = self.get_shard(shard)[offset:offset+length].astype(np.float32)
+        audio *= 1 / 32767
+        return torch.from_numpy(audio).unsqueeze(0)
+
+    def load_audio(self, audiopath, sampling_rate):
+        """
+        Drop-in for load_audio that reads from the store when it can and decodes the clip otherwise.
+        """
+        if sampling_rate == self.sample_rate and audiopath in self:
+            return self.get(audiopath)
+        return load_audio(audiopath, sampling_rate)
+
+
+def load_audio_shards(path, sample_rate):
+    """
+    Opens the store at path for a dataset, or returns None when path is None.
+    """
+    if path is None:
+        return None
+    store = AudioShardStore(path)
+    if store.sample_rate != sample_rate:
+        print(f'{path} holds audio at {store.sample_rate}Hz rather than {sample_rate}Hz and will not be used.')
+        return None
+    return store
@@ -8,8 +8,10 @@ import torch.utils.data
 import torchaudio
 from tqdm import tqdm
 
+from dlas.data.audio.audio_shards import load_audio_shards
 from dlas.data.audio.unsupervised_audio_dataset import (load_audio,
                                                         load_similar_clips)
+from dlas.data.zero_pad_dict_collate import ZeroPadDictCollate
 from dlas.models.audio.tts.tacotron2 import (load_filepaths_and_text,
                                              load_filepaths_and_text_type,
                                              sequence_to_text,
@@ -153,6 +155,8 @@ class TextWavLoader(torch.utils.data.Dataset):
             hparams, ['num_conditioning_candidates'], 1)
         self.conditioning_length = opt_get(
             hparams, ['conditioning_length'], 44100)
+        self.conditioning_cache_bytes = opt_get(
+            hparams, ['conditioning_cache_mb'], 128) * 1024 * 1024
         self.debug_failures = opt_get(
             hparams, ['debug_loading_failures'], False)
         self.load_aligned_codes = opt_get(
@@ -178,6 +182,9 @@ class TextWavLoader(torch.utils.data.Dataset):
             self.audiopaths_and_text.extend(fetcher_fn(p, type))
         self.text_cleaners = hparams.text_cleaners
         self.sample_rate = hparams.sample_rate
+        # Clips packed by scripts/audio/preparation/pack_audio_shards.py are read from there rather than decoded.
+        self.audio_store = load_audio_shards(
+            opt_get(hparams, ['audio_shards'], None), self.sample_rate)
         random.seed(hparams.seed)
         random.shuffle(self.audiopaths_and_text)
         self.max_wav_len = opt_get(hparams, ['max_wav_length'], None)
@@ -192,16 +199,47 @@ class TextWavLoader(torch.utils.data.Dataset):
                 hparams, ['tokenizer_vocab'], '../experiments/bpe_lowercase_asr_256.json'))
         else:
             self.tokenizer = CharacterTokenizer()
+        # When set, items are left unpadded and TextWavCollate pads every batch to its own longest item instead.
+        self.pad_to_batch_max = opt_get(hparams, ['bucket_by_length'], False)
+        # The DVAE turns every 1024 samples into a code, so clips are still padded to a multiple of that.
+        self.wav_pad_multiple = opt_get(hparams, ['wav_pad_multiple'], 1024)
+        self.wav_lengths = None
         # records how many items are skipped when accessing an index.
         self.skipped_items = 0
 
+    def get_wav_length(self, audiopath):
+        if self.audio_store is not None and audiopath in self.audio_store:
+            return self.audio_store.get_length(audiopath)
+        try:
+            info = torchaudio.info(audiopath)
+            length = info.num_frames * self.sample_rate // info.sample_rate
+        except:
+            length = 0
+        # Unreadable clips get skipped when loaded anyways; sort them with the longest ones so they can't shrink a batch.
+        return length if length > 0 else self.max_wav_len
+
+    def get_wav_lengths(self):
+        """
+        Returns the length in samples (at the dataset sample rate) of every clip, read from the file headers the first
+        time this is called. Used by LengthBucketBatchSampler to batch clips of similar length together.
+        """
+        if self.wav_lengths is None:
+            self.wav_lengths = [self.get_wav_length(a[0]) for a in tqdm(
+                self.audiopaths_and_text, desc='Indexing clip lengths')]
+        return self.wav_lengths
+
     def get_wav_text_pair(self, audiopath_and_text):
         # separate filename and text
         audiopath, text, type = audiopath_and_text[0], audiopath_and_text[1], audiopath_and_text[2]
         text_seq = self.get_text(text)
-        wav = load_audio(audiopath, self.sample_rate)
+        wav = self.load_audio(audiopath)
         return (text_seq, wav, text, audiopath_and_text[0], type)
 
+    def load_audio(self, audiopath):
+        if self.audio_store is not None:
+            return self.audio_store.load_audio(audiopath, self.sample_rate)
+        return load_audio(audiopath, self.sample_rate)
+
     def get_text(self, text):
         tokens = self.tokenizer.encode(text)
         tokens = torch.IntTensor(tokens)
@@ -223,7 +261,7 @@ class TextWavLoader(torch.utils.data.Dataset):
                 # Ultra short clips are also useless (and can cause problems within some models).
                 raise ValueError
             cond, cond_is_self = load_similar_clips(self.audiopaths_and_text[index][0], self.conditioning_length, self.sample_rate,
-                                                    n=self.conditioning_candidates) if self.load_conditioning else (None, False)
+                                                    n=self.conditioning_candidates, cache_bytes=self.conditioning_cache_bytes, audio_store=self.audio_store) if self.load_conditioning else (None, False)
         except:
             if self.skipped_items > 100:
                 raise  # Rethrow if we have nested too far.
@@ -249,13 +287,15 @@ class TextWavLoader(torch.utils.data.Dataset):
             return self[rv]
         orig_output = wav.shape[-1]
         orig_text_len = tseq.shape[0]
-        if wav.shape[-1] != self.max_wav_len:
+        if self.pad_to_batch_max:
+            wav = F.pad(wav, (0, -wav.shape[-1] % self.wav_pad_multiple))
+        elif wav.shape[-1] != self.max_wav_len:
             wav = F.pad(wav, (0, self.max_wav_len - wav.shape[-1]))
             if self.load_aligned_codes:
                 # These codes are aligned to audio inputs, so make sure to pad them as well.
                 aligned_codes = F.pad(
                     aligned_codes, (0, self.max_aligned_codes-aligned_codes.shape[0]))
-        if tseq.shape[0] != self.max_text_len:
+        if tseq.shape[0] != self.max_text_len and not self.pad_to_batch_max:
             tseq = F.pad(tseq, (0, self.max_text_len - tseq.shape[0]))
         res = {
             'real_text': text,
@@ -278,6 +318,19 @@ class TextWavLoader(torch.utils.data.Dataset):
         return len(self.audiopaths_and_text)
 
 
+class TextWavCollate(ZeroPadDictCollate):
+    """
+    Collate for TextWavLoader (and TextCodeLoader) with bucket_by_length set, which pads every tensor to the longest
+    item of its batch. Plain numbers are stacked into tensors as the default collate would, so PairedVoiceDebugger and
+    the trainer still get the same batch they do from max-length padded items.
+    """
+
+    def collate_into_list(self, batch, key):
+        if isinstance(batch[0][key], (bool, int, float)):
+            return torch.tensor([elem[key] for elem in batch])
+        return super().collate_into_list(batch, key)
+
+
 class PairedVoiceDebugger:
     def __init__(self):
         self.total_items = 0
@@ -0,0 +1,186 @@
+import os
+import random
+import sys
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+
+from dlas.data.audio.paired_voice_audio_dataset import TextWavLoader
+from dlas.data.audio.unsupervised_audio_dataset import load_similar_clips
+from dlas.utils.util import opt_get
+
+
+def code_store_key(audiopath):
+    return os.path.normpath(audiopath)
+
+
+class CodeStoreWriter:
+    """
+    Writes per-clip MEL spectrograms, DVAE codes and wav lengths into a sharded store that CodeStore can read back.
+    Codes and MELs go into separate shard files so the (much smaller) codes can be read without touching the MELs.
+    """
+
+    def __init__(self, path, code_length, mel_length, shard_size=1024, meta=None):
+        self.path = path
+        self.shard_size = shard_size
+        self.index = {
+            'code_length': code_length,
+            'mel_length': mel_length,
+            'meta': meta if meta is not None else {},
+            'entries': {},
+        }
+        self.shard = 0
+        self.codes = []
+        self.mels = []
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, audiopath, codes, mel, wav_length):
+        self.index['entries'][code_store_key(audiopath)] = (self.shard, len(self.codes), int(wav_length))
+        self.codes.append(codes.to(torch.int16).cpu())
+        self.mels.append(mel.half().cpu())
+        if len(self.codes) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.codes) == 0:
+            return
+        torch.save(_pack(self.codes), os.path.join(self.path, f'codes_{self.shard:05d}.pth'))
+        torch.save(_pack(self.mels), os.path.join(self.path, f'mels_{self.shard:05d}.pth'))
+        self.shard += 1
+        self.codes = []
+        self.mels = []
+
+    def close(self):
+        self.flush()
+        # The index goes last, so a store that was interrupted while writing is never picked up.
+        torch.save(self.index, os.path.join(self.path, 'index.pth'))
+
+
+def _pack(tensors):
+    lengths = torch.tensor([t.shape[-1] for t in tensors], dtype=torch.long)
+    offsets = F.pad(lengths.cumsum(0), (1, 0))
+    return {'data': torch.cat(tensors, dim=-1), 'offsets': offsets}
+
+
+def _unpack(shard, row):
+    return shard['data'][..., shard['offsets'][row]:shard['offsets'][row+1]]
+
+
+class CodeStore:
+    """
+    Reads back what CodeStoreWriter wrote. Code shards are kept once loaded, while only the max_mel_shards most
+    recently used MEL shards are.
+    """
+
+    def __init__(self, path, max_mel_shards=2):
+        self.path = path
+        index = torch.load(os.path.join(path, 'index.pth'))
+        self.code_length = index['code_length']
+        self.mel_length = index['mel_length']
+        self.meta = index['meta']
+        self.entries = index['entries']
+        self.code_shards = {}
+        self.mel_shards = OrderedDict()
+        self.max_mel_shards = max_mel_shards
+
+    def __contains__(self, audiopath):
+        return code_store_key(audiopath) in self.entries
+
+    def get_code_shard(self, shard):
+        if shard not in self.code_shards:
+            self.code_shards[shard] = torch.load(os.path.join(self.path, f'codes_{shard:05d}.pth'))
+        return self.code_shards[shard]
+
+    def get_mel_shard(self, shard):
+        if shard in self.mel_shards:
+            self.mel_shards.move_to_end(shard)
+        else:
+            self.mel_shards[shard] = torch.load(os.path.join(self.path, f'mels_{shard:05d}.pth'))
+            if len(self.mel_shards) > self.max_mel_shards:
+                self.mel_shards.popitem(last=False)
+        return self.mel_shards[shard]
+
+    def get(self, audiopath, load_mel=False):
+        """
+        Returns (codes, wav_length, mel) for a clip, where mel is None unless load_mel is set.
+        """
+        shard, row, wav_length = self.entries[code_store_key(audiopath)]
+        codes = _unpack(self.get_code_shard(shard), row).long()
+        mel = _unpack(self.get_mel_shard(shard), row).float() if load_mel else None
+        return codes, wav_length, mel
+
+
+class TextCodeLoader(TextWavLoader):
+    """
+    TextWavLoader that serves the DVAE codes of each clip from a CodeStore written by
+    scripts/audio/preparation/precompute_dvae_codes.py, instead of its audio. The codes are padded out to the length the
+    discrete_token injector produces and come under the 'paired_mel_codes' key the training template uses, so neither
+    the MEL injector nor the DVAE are needed for the clips themselves. Conditioning clips are still loaded as audio.
+    """
+
+    def __init__(self, hparams):
+        super().__init__(hparams)
+        self.store = CodeStore(hparams['codes_path'], opt_get(hparams, ['max_mel_shards'], 2))
+        self.load_mels = opt_get(hparams, ['load_mels'], False)
+        missing = len([a for a in self.audiopaths_and_text if a[0] not in self.store])
+        if missing > 0:
+            print(f'{missing} of {len(self.audiopaths_and_text)} clips are missing from {hparams["codes_path"]} and will be skipped.')
+
+    def get_wav_length(self, audiopath):
+        if audiopath in self.store:
+            return self.store.entries[code_store_key(audiopath)][2]
+        return self.max_wav_len
+
+    def __getitem__(self, index):
+        self.skipped_items += 1
+        try:
+            audiopath, text, type = self.audiopaths_and_text[index][:3]
+            tseq = self.get_text(text)
+            if text is None or len(text.strip()) == 0:
+                raise ValueError
+            codes, wav_length, mel = self.store.get(audiopath, load_mel=self.load_mels)
+            if wav_length < (.6 * self.sample_rate):
+                # Ultra short clips are also useless (and can cause problems within some models).
+                raise ValueError
+            cond, cond_is_self = load_similar_clips(audiopath, self.conditioning_length, self.sample_rate,
+                                                    n=self.conditioning_candidates, cache_bytes=self.conditioning_cache_bytes, audio_store=self.audio_store) if self.load_conditioning else (None, False)
+        except:
+            if self.skipped_items > 100:
+                raise  # Rethrow if we have nested too far.
+            if self.debug_failures:
+                print(
+                    f"error loading {self.audiopaths_and_text[index][0]} {sys.exc_info()}")
+            return self[(index+1) % len(self)]
+
+        actually_skipped_items = self.skipped_items
+        self.skipped_items = 0
+        if wav_length > self.max_wav_len or tseq.shape[0] > self.max_text_len:
+            if self.debug_failures:
+                print(
+                    f"error loading {audiopath}: ranges are out of bounds; {wav_length}, {tseq.shape[0]}")
+            rv = random.randint(0, len(self)-1)
+            return self[rv]
+        orig_text_len = tseq.shape[0]
+        if not self.pad_to_batch_max:
+            codes = F.pad(codes, (0, self.store.code_length - codes.shape[-1]))
+            if tseq.shape[0] != self.max_text_len:
+                tseq = F.pad(tseq, (0, self.max_text_len - tseq.shape[0]))
+        res = {
+            'real_text': text,
+            'padded_text': tseq,
+            'text_lengths': torch.tensor(orig_text_len, dtype=torch.long),
+            'paired_mel_codes': codes,
+            'wav_lengths': torch.tensor(wav_length, dtype=torch.long),
+            'filenames': audiopath,
+            'skipped_items': actually_skipped_items,
+            'type': type,
+        }
+        if self.load_mels:
+            res['paired_mel'] = mel if self.pad_to_batch_max else F.pad(
+                mel, (0, self.store.mel_length - mel.shape[-1]))
+        if self.load_conditioning:
+            res['conditioning'] = cond
+            res['conditioning_contains_self'] = cond_is_self
+        return res
@@ -1,6 +1,7 @@
 import os
 import random
 import sys
+from collections import OrderedDict
 
 import torch
 import torch.nn.functional as F
@@ -47,11 +48,76 @@ def load_audio(audiopath, sampling_rate):
     return audio.unsqueeze(0)
 
 
-def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=True):
+# Every dataloader worker is its own process, so both of these caches are per worker.
+_similarities_cache = {}
+
+
+def load_similarities(sim_path):
+    """
+    Returns the similarities.pth at sim_path, or None when there is none. Each file is only loaded once, and again
+    whenever it changes on disk.
+    """
+    try:
+        mtime = os.path.getmtime(sim_path)
+    except OSError:
+        return None
+    cached = _similarities_cache.get(sim_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, torch.load(sim_path))
+        _similarities_cache[sim_path] = cached
+    return cached[1]
+
+
+class AudioClipCache:
+    """
+    LRU cache of decoded (and resampled) clips that holds at most max_bytes of audio.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.clips = OrderedDict()
+
+    def get(self, path, sample_rate):
+        key = (path, sample_rate)
+        if key in self.clips:
+            self.clips.move_to_end(key)
+            return self.clips[key]
+        clip = load_audio(path, sample_rate)
+        size = clip.numel() * clip.element_size()
+        if size <= self.max_bytes:
+            self.clips[key] = clip
+            self.bytes += size
+            self.evict()
+        return clip
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def evict(self):
+        while self.bytes > self.max_bytes:
+            _, evicted = self.clips.popitem(last=False)
+            self.bytes -= evicted.numel() * evicted.element_size()
+
+
+_clip_cache = AudioClipCache()
+
+
+def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=True, cache_bytes=128 * 1024 * 1024,
+                       audio_store=None):
+    """
+    Loads n random sample_length long excerpts of the clips listed as similar to path in the similarities.pth next to
+    it. Decoded clips are kept in a per-worker LRU cache of up to cache_bytes, so conditioning clips shared between the
+    items of a speaker are only decoded and resampled once. Clips found in audio_store (an AudioShardStore) are read
+    from it instead.
+    """
+    if cache_bytes != _clip_cache.max_bytes:
+        _clip_cache.resize(cache_bytes)
     sim_path = os.path.join(os.path.dirname(path), 'similarities.pth')
     candidates = []
-    if os.path.exists(sim_path):
-        similarities = torch.load(sim_path)
+    similarities = load_similarities(sim_path)
+    if similarities is not None:
         fname = os.path.basename(path)
         if fname in similarities.keys():
             candidates = [os.path.join(os.path.dirname(path), s)
@@ -79,13 +145,19 @@ def load_similar_clips(path, sample_length, sample_rate, n=3, fallback_to_self=T
     for k in range(n):
         rel_path = random.choice(candidates)
         contains_self = contains_self or (rel_path == path)
-        rel_clip = load_audio(rel_path, sample_rate)
+        if audio_store is not None and rel_path in audio_store:
+            rel_clip = audio_store.get(rel_path)
+        else:
+            rel_clip = _clip_cache.get(rel_path, sample_rate)
         gap = rel_clip.shape[-1] - sample_length
         if gap < 0:
             rel_clip = F.pad(rel_clip, pad=(0, abs(gap)))
         elif gap > 0:
             rand_start = random.randint(0, gap)
-            rel_clip = rel_clip[:, rand_start:rand_start+sample_length]
+            # Copied out, so the cached clip isn't handed to (and moved into shared memory by) the dataloader.
+            rel_clip = rel_clip[:, rand_start:rand_start+sample_length].clone()
+        else:
+            rel_clip = rel_clip.clone()
         related_clips.append(rel_clip)
     if n > 1:
         return torch.stack(related_clips, dim=0), contains_self
@@ -127,13 +199,25 @@ class UnsupervisedAudioDataset(torch.utils.data.Dataset):
         # "Extra samples" are other audio clips pulled from wav files in the same directory as the 'clip' wav file.
         self.extra_samples = opt_get(opt, ['extra_samples'], 0)
         self.extra_sample_len = opt_get(opt, ['extra_sample_length'], 44000)
+        self.extra_sample_cache_bytes = opt_get(
+            opt, ['extra_sample_cache_mb'], 128) * 1024 * 1024
 
         self.debug_loading_failures = opt_get(
             opt, ['debug_loading_failures'], True)
 
+        # Clips packed by scripts/audio/preparation/pack_audio_shards.py are read from there rather than decoded.
+        from dlas.data.audio.audio_shards import load_audio_shards
+        self.audio_store = load_audio_shards(
+            opt_get(opt, ['audio_shards'], None), self.sampling_rate)
+
+    def load_audio(self, audiopath):
+        if self.audio_store is not None:
+            return self.audio_store.load_audio(audiopath, self.sampling_rate)
+        return load_audio(audiopath, self.sampling_rate)
+
     def get_audio_for_index(self, index):
         audiopath = self.audiopaths[index]
-        audio = load_audio(audiopath, self.sampling_rate)
+        audio = self.load_audio(audiopath)
         assert audio.shape[1] > self.min_length
         if self.dont_clip:
             assert audio.shape[1] <= self.pad_to
@@ -143,7 +227,8 @@ class UnsupervisedAudioDataset(torch.utils.data.Dataset):
         if self.extra_samples <= 0:
             return None, 0
         audiopath = self.audiopaths[index]
-        return load_similar_clips(audiopath, self.extra_sample_len, self.sampling_rate, n=self.extra_samples)
+        return load_similar_clips(audiopath, self.extra_sample_len, self.sampling_rate, n=self.extra_samples,
+                                  cache_bytes=self.extra_sample_cache_bytes, audio_store=self.audio_store)
 
     def __getitem__(self, index):
         try:
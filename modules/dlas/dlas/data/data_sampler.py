@@ -67,3 +67,81 @@ class DistIterSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler that puts items of similar length in the same batch, so that
+    padding each batch only to its own longest item leaves little padding.
+
+    Every epoch, the shuffled dataset is cut into buckets of ``bucket_batches``
+    batches. Each bucket is sorted by length and split into batches, and the
+    batches are shuffled again.
+
+    Arguments:
+        lengths: Length of every item of the dataset.
+        batch_size: Items per batch (per process).
+        bucket_batches (optional): How many batches each bucket is sorted over.
+            Larger buckets pad less but batch the same items together more often.
+        num_replicas (optional): Number of processes participating in
+            distributed training. Each gets every num_replicas-th batch.
+        rank (optional): Rank of the current process within num_replicas.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_batches=16, shuffle=True, drop_last=True, num_replicas=1, rank=0, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def get_batches(self, generator):
+        size = len(self.lengths)
+        if self.shuffle:
+            indices = torch.randperm(size, generator=generator).tolist()
+        else:
+            indices = list(range(size))
+
+        batches = []
+        bucket_size = self.batch_size * self.bucket_batches
+        for b in range(0, size, bucket_size):
+            bucket = sorted(indices[b:b+bucket_size],
+                            key=lambda i: self.lengths[i])
+            for s in range(0, len(bucket), self.batch_size):
+                batch = bucket[s:s+self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(
+                len(batches), generator=generator).tolist()]
+        return batches
+
+    def __iter__(self):
+        # deterministically shuffle based on epoch, so every process agrees on the batches
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        # DataLoaders re-iterate their batch sampler every epoch, so it moves on by itself as well
+        self.epoch += 1
+
+        batches = self.get_batches(g)
+        # every process needs to see the same number of batches
+        per_replica = len(batches) // self.num_replicas
+        return iter(batches[self.rank:per_replica * self.num_replicas:self.num_replicas])
+
+    def __len__(self):
+        size = len(self.lengths)
+        bucket_size = self.batch_size * self.bucket_batches
+        batches = (size // bucket_size) * self.bucket_batches
+        remainder = size % bucket_size
+        if self.drop_last:
+            batches += remainder // self.batch_size
+        else:
+            batches += int(math.ceil(remainder / self.batch_size))
+        return batches // self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
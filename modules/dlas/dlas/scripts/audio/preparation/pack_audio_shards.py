@@ -0,0 +1,72 @@
+import argparse
+
+import torch
+import torch.utils.data
+from tqdm import tqdm
+
+from dlas.data.audio.audio_shards import AudioShardWriter
+from dlas.data.audio.unsupervised_audio_dataset import load_audio
+from dlas.data.util import find_files_of_type, is_audio_file
+from dlas.models.audio.tts.tacotron2 import load_filepaths_and_text
+
+
+class ClipLoader(torch.utils.data.Dataset):
+    def __init__(self, clips, sample_rate):
+        self.clips = clips
+        self.sample_rate = sample_rate
+
+    def __getitem__(self, index):
+        clip = self.clips[index]
+        try:
+            return clip, load_audio(clip, self.sample_rate)
+        except Exception as e:
+            print(f"Error loading {clip}: {e}")
+            return clip, None
+
+    def __len__(self):
+        return len(self.clips)
+
+
+def pack_audio_shards(output, lists=None, dirs=None, sample_rate=22050, shard_size_mb=1024, num_workers=4):
+    """
+    Decodes and resamples every clip listed in lists (lj-style "path|text" files, such as train.txt and validation.txt)
+    or found under dirs once, and packs them into int16 shards that the paired and unsupervised audio datasets read
+    through their audio_shards option.
+    """
+    clips = []
+    for path in lists or []:
+        clips.extend([c[0] for c in load_filepaths_and_text(path)])
+    for path in dirs or []:
+        clips.extend(find_files_of_type(
+            'img', path, qualifier=is_audio_file)[0])
+    clips = list(dict.fromkeys(clips))
+
+    writer = AudioShardWriter(output, sample_rate=sample_rate,
+                              shard_bytes=shard_size_mb * 1024 * 1024)
+    loader = torch.utils.data.DataLoader(ClipLoader(clips, sample_rate), batch_size=None, num_workers=num_workers)
+    for clip, audio in tqdm(loader, total=len(clips)):
+        if audio is not None:
+            writer.add(clip, audio)
+    writer.close()
+    return writer
+
+
+if __name__ == '__main__':
+    """
+    Packs the audio of a dataset into memory mapped shards. Point a dataset's audio_shards option at --output to use
+    them; clips missing from the shards are still loaded from disk.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str,
+                        help='Where to write the shards to', required=True)
+    parser.add_argument('--path', type=str, nargs='*', default=[],
+                        help='lj-style dataset list(s) to pack')
+    parser.add_argument('--dir', type=str, nargs='*', default=[],
+                        help='Directories to pack every audio file under')
+    parser.add_argument('--sample_rate', type=int, default=22050)
+    parser.add_argument('--shard_size_mb', type=int, default=1024)
+    parser.add_argument('--num_workers', type=int, default=4)
+    args = parser.parse_args()
+
+    pack_audio_shards(args.output, lists=args.path, dirs=args.dir, sample_rate=args.sample_rate,
+                      shard_size_mb=args.shard_size_mb, num_workers=args.num_workers)
@@ -0,0 +1,98 @@
+import argparse
+import os
+
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from dlas.data.audio.paired_voice_codes_dataset import CodeStoreWriter
+from dlas.data.audio.unsupervised_audio_dataset import load_audio
+from dlas.models.audio.tts.tacotron2 import load_filepaths_and_text
+from dlas.trainer.injectors.audio_injectors import TorchMelSpectrogramInjector
+from dlas.utils.util import load_model_from_config
+
+
+def precompute_dvae_codes(paths, output, dvae_config, mel_norm_file=None, dvae_name='dvae', max_wav_length=255995,
+                          sample_rate=22050, batch_size=16, shard_size=1024, device='cuda'):
+    """
+    Runs the torch_mel_spectrogram and discrete_token injectors of the GPT training template over every clip listed in
+    paths (lj-style "path|text" files) once, and writes the results into a store the paired_voice_codes dataset reads.
+    Clips are padded to max_wav_length first, exactly as they are during training, so the codes come out the same.
+    """
+    mel_inj = TorchMelSpectrogramInjector(
+        {'in': 'wav', 'out': 'mel', 'mel_norm_file': mel_norm_file, 'sampling_rate': sample_rate}, {})
+    dvae = load_model_from_config(
+        dvae_config, dvae_name, device=device).eval()
+
+    clips = []
+    for path in paths:
+        clips.extend([c[0] for c in load_filepaths_and_text(path)])
+    clips = list(dict.fromkeys(clips))
+
+    writer = None
+    with torch.no_grad():
+        for b in tqdm(range(0, len(clips), batch_size)):
+            batch_paths = []
+            wavs = []
+            for clip in clips[b:b+batch_size]:
+                try:
+                    wav = load_audio(clip, sample_rate)
+                except Exception as e:
+                    print(f"Error loading {clip}: {e}")
+                    continue
+                if wav.shape[-1] > max_wav_length:
+                    # The dataset skips these anyway.
+                    continue
+                batch_paths.append(clip)
+                wavs.append(wav)
+            if len(wavs) == 0:
+                continue
+
+            wav_lengths = [w.shape[-1] for w in wavs]
+            wavs = torch.stack(
+                [F.pad(w, (0, max_wav_length - w.shape[-1])) for w in wavs]).to(device)
+            mels = mel_inj({'wav': wavs})['mel']
+            codes = dvae.get_codebook_indices(mels)
+
+            if writer is None:
+                writer = CodeStoreWriter(output, codes.shape[-1], mels.shape[-1], shard_size=shard_size, meta={
+                    'dvae_config': dvae_config,
+                    'mel_norm_file': mel_norm_file,
+                    'max_wav_length': max_wav_length,
+                    'sample_rate': sample_rate,
+                })
+            for i, clip in enumerate(batch_paths):
+                # Only the codes the GPT actually sees are kept; +4 preserves the termination codes.
+                code_length = min(codes.shape[-1], wav_lengths[i] * codes.shape[-1] // max_wav_length + 4)
+                mel_length = min(mels.shape[-1], wav_lengths[i] // mel_inj.hop_length + 1)
+                writer.add(clip, codes[i, :code_length], mels[i, :, :mel_length], wav_lengths[i])
+
+    if writer is not None:
+        writer.close()
+    return writer
+
+
+if __name__ == '__main__':
+    """
+    Precomputes the DVAE codes of a GPT fine-tuning dataset, so it can be trained with the paired_voice_codes dataset
+    mode (with codes_path pointing at --output) and without the torch_mel_spectrogram and discrete_token injectors.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', type=str, nargs='+',
+                        help='lj-style dataset list(s) to precompute', required=True)
+    parser.add_argument('--output', type=str,
+                        help='Where to write the store to', required=True)
+    parser.add_argument('--dvae_config', type=str, help='Options YAML holding the DVAE',
+                        default='./models/tortoise/train_diffusion_vocoder_22k_level.yml')
+    parser.add_argument('--mel_norm_file', type=str,
+                        default='./modules/tortoise-tts/tortoise/data/mel_norms.pth')
+    parser.add_argument('--max_wav_length', type=int, default=255995)
+    parser.add_argument('--sample_rate', type=int, default=22050)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--shard_size', type=int, default=1024)
+    parser.add_argument('--device', type=str, default='cuda')
+    args = parser.parse_args()
+
+    precompute_dvae_codes(args.path, args.output, args.dvae_config, mel_norm_file=args.mel_norm_file,
+                          max_wav_length=args.max_wav_length, sample_rate=args.sample_rate,
+                          batch_size=args.batch_size, shard_size=args.shard_size, device=args.device)
@@ -421,6 +421,7 @@ class Trainer:
 
         if self.rank <= 0:
             self.save()
+            self.model.flush_checkpoints()
             self.logger.info('Finished training!')
 
     def create_training_generator(self, index):
@@ -439,6 +440,7 @@ class Trainer:
                 yield self.model
                 metric = self.do_step(train_data)
         self.save()
+        self.model.flush_checkpoints()
         self.logger.info('Finished training')
 
 
@@ -6,6 +6,7 @@ import torch.nn as nn
 from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel.distributed import DistributedDataParallel
 
+from dlas.trainer.checkpoint_writer import CheckpointWriter
 from dlas.utils.util import (copy_files_to_server, map_cuda_to_correct_device,
                              map_to_device, opt_get, optimizer_to)
 
@@ -26,6 +27,11 @@ class BaseModel():
         self.optimizers = []
         self.disc_optimizers = []
         self.save_history = {}
+        # How many past checkpoints of each network (and training states) to keep on disk, 0 keeps them all.
+        self.keep_checkpoints = opt_get(
+            opt, ['logger', 'keep_x_past_checkpoints'], 0)
+        self.checkpoint_writer = CheckpointWriter() if self.is_train and opt_get(
+            opt, ['logger', 'async_checkpoints'], True) else None
 
     def feed_data(self, data):
         pass
@@ -88,26 +94,71 @@ class BaseModel():
             network = network.module
         return str(network), sum(map(lambda x: x.numel(), network.parameters()))
 
+    def write_checkpoint(self, state, save_path, history_label, suffix, alt_path=None, remote_path=None):
+        """
+        Saves state to save_path (and alt_path), then copies it to the server in colab mode and prunes the
+        checkpoints ending in suffix next to it. With async_checkpoints (the default), all of that happens on the
+        checkpoint writer's thread once state has been copied to host memory.
+        """
+        if history_label not in self.save_history.keys():
+            self.save_history[history_label] = []
+        self.save_history[history_label].append(save_path)
+
+        paths = [save_path] if alt_path is None else [save_path, alt_path]
+
+        def finish():
+            self.prune_checkpoints(save_path, suffix)
+            if self.opt['colab_mode']:
+                copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
+                                     save_path, remote_path)
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.write(self.checkpoint_writer.snapshot(
+                state), paths, callback=finish)
+            return
+        for path in paths:
+            torch.save(state, path)
+        finish()
+
+    def prune_checkpoints(self, save_path, suffix):
+        """
+        Removes all but the keep_x_past_checkpoints latest '<step><suffix>' checkpoints in save_path's directory,
+        including ones left behind by earlier runs.
+        """
+        if self.keep_checkpoints <= 0:
+            return
+        directory = os.path.dirname(save_path)
+        steps = []
+        for name in os.listdir(directory):
+            if not name.endswith(suffix):
+                continue
+            try:
+                steps.append((int(name[:-len(suffix)]), name))
+            except ValueError:
+                continue
+        for _, name in sorted(steps)[:-self.keep_checkpoints]:
+            path = os.path.join(directory, name)
+            if os.path.normpath(path) != os.path.normpath(save_path):
+                os.remove(path)
+
+    def flush_checkpoints(self):
+        """Waits for every checkpoint that is still being written in the background."""
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
+
     def save_network(self, network, network_label, iter_label):
         save_filename = '{}_{}.pth'.format(iter_label, network_label)
         save_path = os.path.join(self.opt['path']['models'], save_filename)
         if isinstance(network, nn.DataParallel) or isinstance(network, DistributedDataParallel):
             network = network.module
         state_dict = network.state_dict()
-        for key, param in state_dict.items():
-            state_dict[key] = param.cpu()
-        torch.save(state_dict, save_path)
-        if network_label not in self.save_history.keys():
-            self.save_history[network_label] = []
-        self.save_history[network_label].append(save_path)
-
+        if self.checkpoint_writer is None:
+            for key, param in state_dict.items():
+                state_dict[key] = param.cpu()
         # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
-        if 'alt_path' in self.opt['path'].keys():
-            torch.save(state_dict, os.path.join(
-                self.opt['path']['alt_path'], save_filename))
-        if self.opt['colab_mode']:
-            copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                 save_path, os.path.join(self.opt['remote_path'], 'models', save_filename))
+        alt_path = os.path.join(self.opt['path']['alt_path'], save_filename) if 'alt_path' in self.opt['path'].keys() else None
+        self.write_checkpoint(state_dict, save_path, network_label, f'_{network_label}.pth', alt_path=alt_path,
+                              remote_path=os.path.join(self.opt['remote_path'], 'models', save_filename) if self.opt['colab_mode'] else None)
         return save_path
 
     def load_network(self, load_path, network, strict=True, pretrain_base_path=None):
@@ -154,18 +205,12 @@ class BaseModel():
             opt_get(state, ['iter'], 'no_step_provided'))
         save_path = os.path.join(
             self.opt['path']['training_state'], save_filename)
-        torch.save(map_to_device(state, 'cpu'), save_path)
-        if '__state__' not in self.save_history.keys():
-            self.save_history['__state__'] = []
-        self.save_history['__state__'].append(save_path)
-
         # Also save to the 'alt_path' which is useful for caching to Google Drive in colab, for example.
-        if 'alt_path' in self.opt['path'].keys():
-            torch.save(state, os.path.join(
-                self.opt['path']['alt_path'], 'latest.state'))
-        if self.opt['colab_mode']:
-            copy_files_to_server(self.opt['ssh_server'], self.opt['ssh_username'], self.opt['ssh_password'],
-                                 save_path, os.path.join(self.opt['remote_path'], 'training_state', save_filename))
+        alt_path = os.path.join(self.opt['path']['alt_path'], 'latest.state') if 'alt_path' in self.opt['path'].keys() else None
+        if self.checkpoint_writer is None:
+            state = map_to_device(state, 'cpu')
+        self.write_checkpoint(state, save_path, '__state__', '.state', alt_path=alt_path,
+                              remote_path=os.path.join(self.opt['remote_path'], 'training_state', save_filename) if self.opt['colab_mode'] else None)
 
     def stash_optimizers(self):
         """
@@ -0,0 +1,116 @@
+import atexit
+import copy
+import os
+import queue
+import threading
+from collections import defaultdict
+
+import torch
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread, so training only waits for the state to be copied to host memory.
+
+    snapshot() copies every tensor of a state (nested dicts/lists/tuples, such as network and optimizer state_dicts)
+    into CPU buffers that are reused from one checkpoint to the next, pinned when CUDA is available so device tensors
+    are copied asynchronously. write() then hands the snapshot to the writer thread, which saves it to a temporary file
+    next to each destination and renames it into place, so a checkpoint is never seen half written. The callback
+    passed along runs once the write succeeded, which is where old checkpoints get pruned.
+
+    Once max_pending writes are queued, snapshot() waits for them, which bounds how much host memory the buffers take
+    when checkpoints are taken faster than they can be written.
+    """
+
+    def __init__(self, pin_memory=True, max_pending=4):
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.max_pending = max_pending
+        self.free_buffers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+        # The thread doesn't keep the process alive by itself, so give it a chance to finish before exiting.
+        atexit.register(self.jobs.join)
+
+    def get_buffer(self, tensor):
+        key = (tuple(tensor.shape), tensor.dtype)
+        with self.lock:
+            if len(self.free_buffers[key]) > 0:
+                return self.free_buffers[key].pop()
+        return torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self.pin_memory)
+
+    def copy_to_host(self, obj, buffers):
+        if isinstance(obj, torch.Tensor):
+            if obj.is_sparse or obj.is_quantized:
+                return obj.detach().cpu().clone()
+            buffer = self.get_buffer(obj)
+            buffer.copy_(obj.detach(), non_blocking=self.pin_memory and obj.is_cuda)
+            buffers.append(buffer)
+            return buffer
+        elif isinstance(obj, dict):
+            # Keeps OrderedDicts (and their state_dict _metadata) intact.
+            result = copy.copy(obj)
+            for k, v in obj.items():
+                result[k] = self.copy_to_host(v, buffers)
+            return result
+        elif isinstance(obj, (list, tuple)):
+            return type(obj)(self.copy_to_host(v, buffers) for v in obj)
+        return copy.deepcopy(obj)
+
+    def snapshot(self, state):
+        """
+        Returns a copy of state whose tensors live in host memory owned by the writer. Device to host copies are still
+        in flight when this returns; the writer thread waits for them before saving.
+        """
+        if self.jobs.unfinished_tasks >= self.max_pending:
+            self.jobs.join()
+        self.raise_error()
+        buffers = []
+        state = self.copy_to_host(state, buffers)
+        event = None
+        if self.pin_memory:
+            event = torch.cuda.Event()
+            event.record()
+        return {'state': state, 'buffers': buffers, 'event': event}
+
+    def write(self, snapshot, paths, callback=None):
+        """
+        Saves a snapshot to every path in paths, then calls callback.
+        """
+        self.jobs.put((snapshot, paths, callback))
+
+    def run(self):
+        while True:
+            snapshot, paths, callback = self.jobs.get()
+            try:
+                if snapshot['event'] is not None:
+                    snapshot['event'].synchronize()
+                for path in paths:
+                    temp_path = f'{path}.tmp'
+                    torch.save(snapshot['state'], temp_path)
+                    os.replace(temp_path, path)
+                if callback is not None:
+                    callback()
+            except Exception as e:
+                self.error = e
+            finally:
+                with self.lock:
+                    for buffer in snapshot['buffers']:
+                        self.free_buffers[(tuple(buffer.shape), buffer.dtype)].append(buffer)
+                self.jobs.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def flush(self):
+        """
+        Blocks until every checkpoint handed to the writer is on disk.
+        """
+        self.jobs.join()
+        self.raise_error()
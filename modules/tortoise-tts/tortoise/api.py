@@ -2,6 +2,14 @@ import os
 import random
 import uuid
 import gc
+import bisect
+import heapq
+import functools
+import threading
+import contextlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from time import time
 from urllib import request
@@ -17,19 +25,20 @@ from tortoise.models.diffusion_decoder import DiffusionTts
 from tortoise.models.autoregressive import UnifiedVoice
 from tqdm import tqdm
 
-from tortoise.models.arch_util import TorchMelSpectrogram
+from tortoise.models.arch_util import get_mel_spectrogram
 from tortoise.models.clvp import CLVP
 from tortoise.models.cvvp import CVVP
 from tortoise.models.random_latent_generator import RandomLatentConverter
 from tortoise.models.vocoder import UnivNetGenerator
 from tortoise.models.bigvgan import BigVGAN
 
-from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel
+from tortoise.utils.audio import wav_to_univnet_mel, denormalize_tacotron_mel, TACOTRON_MEL_MIN
 from tortoise.utils.diffusion import SpacedDiffusion, space_timesteps, get_named_beta_schedule
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
 
 from tortoise.utils.device import get_device, get_device_name, get_device_batch_size, print_stats, do_gc
+from transformers.utils.model_parallel_utils import get_device_map
 
 pbar = None
 STOP_SIGNAL = False
@@ -142,28 +151,41 @@ def pad_or_truncate(t, length):
         return t[..., :length]
 
 
-def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1):
+def load_discrete_vocoder_diffuser(trained_diffusion_steps=4000, desired_diffusion_steps=200, cond_free=True, cond_free_k=1, fused_cond_free=True):
     """
     Helper function to load a GaussianDiffusion instance configured for use as a vocoder.
+
+    When fused_cond_free is set, the conditioned and conditioning-free passes are run as one batch per step.
     """
     return SpacedDiffusion(use_timesteps=space_timesteps(trained_diffusion_steps, [desired_diffusion_steps]), model_mean_type='epsilon',
                            model_var_type='learned_range', loss_type='mse', betas=get_named_beta_schedule('linear', trained_diffusion_steps),
-                           conditioning_free=cond_free, conditioning_free_k=cond_free_k)
+                           conditioning_free=cond_free, conditioning_free_k=cond_free_k, fused_conditioning_free=fused_cond_free)
 
 @torch.inference_mode()
 def format_conditioning(clip, cond_length=132300, device='cuda', sampling_rate=22050):
     """
     Converts the given conditioning signal to a MEL spectrogram and clips it as expected by the models.
     """
-    gap = clip.shape[-1] - cond_length
-    if gap < 0:
-        clip = F.pad(clip, pad=(0, abs(gap)))
-    elif gap > 0:
-        rand_start = random.randint(0, gap)
-        clip = clip[:, rand_start:rand_start + cond_length]
-    mel_clip = TorchMelSpectrogram(sampling_rate=sampling_rate)(clip.unsqueeze(0)).squeeze(0)
-    mel_clip = mel_clip.unsqueeze(0)
-    return migrate_to_device(mel_clip, device)
+    return format_conditioning_batch([clip], cond_length=cond_length, device=device, sampling_rate=sampling_rate).squeeze(1)
+
+def format_conditioning_batch(clips, cond_length=132300, device='cuda', sampling_rate=22050):
+    """
+    format_conditioning() for a list of clips, which go through a single STFT call.
+    :return: The MEL spectrograms stacked as (1,n,c,s), the way get_conditioning() expects them.
+    """
+    cropped = []
+    for clip in clips:
+        gap = clip.shape[-1] - cond_length
+        if gap < 0:
+            clip = F.pad(clip, pad=(0, abs(gap)))
+        elif gap > 0:
+            rand_start = random.randint(0, gap)
+            clip = clip[:, rand_start:rand_start + cond_length]
+        cropped.append(clip)
+    clips = torch.cat(cropped, dim=0)
+    mel_clips = get_mel_spectrogram(sampling_rate=sampling_rate, device=clips.device, dtype=clips.dtype)(clips)
+    mel_clips = mel_clips.unsqueeze(0)
+    return migrate_to_device(mel_clips, device)
 
 def fix_autoregressive_output(codes, stop_token, complain=True):
     """
@@ -176,41 +198,194 @@ def fix_autoregressive_output(codes, stop_token, complain=True):
     Failing to do this padding will produce speech with a harsh end that sounds like "BLAH" or similar.
     """
     # Strip off the autoregressive stop token and add padding.
-    stop_token_indices = (codes == stop_token).nonzero()
-    if len(stop_token_indices) == 0:
-        if complain:
-            print("No stop tokens found in one of the generated voice clips. This typically means the spoken audio is "
-                  "too long. In some cases, the output will still be good, though. Listen to it and if it is missing words, "
-                  "try breaking up your input text.")
-        return codes
-    else:
-        codes[stop_token_indices] = 83
-    stm = stop_token_indices.min().item()
-    codes[stm:] = 83
-    if stm - 3 < codes.shape[0]:
-        codes[-3] = 45
-        codes[-2] = 45
-        codes[-1] = 248
+    return fix_autoregressive_output_batch(codes.unsqueeze(0), stop_token, complain=complain)[0]
+
+
+def fix_autoregressive_output_batch(codes, stop_token, complain=True):
+    """
+    Batched fix_autoregressive_output(), applied in place to every row of a (b,s) tensor of codes at once.
+    """
+    is_stop = codes == stop_token
+    has_stop = is_stop.any(dim=1)
+    if complain and not has_stop.all():
+        print(f"No stop tokens found in {(~has_stop).sum().item()} of the generated voice clips. This typically means the spoken audio is "
+              "too long. In some cases, the output will still be good, though. Listen to it and if it is missing words, "
+              "try breaking up your input text.")
+    # argmax returns the first maximum, which is the first stop token of rows that have one.
+    first_stop = torch.where(has_stop, is_stop.int().argmax(dim=1), codes.shape[1])
+    positions = torch.arange(codes.shape[1], device=codes.device).unsqueeze(0)
+    codes.masked_fill_(positions >= first_stop.unsqueeze(1), 83)
+    codes[has_stop, -3:] = torch.tensor([45, 45, 248], dtype=codes.dtype, device=codes.device)
 
     return codes
 
+def find_calm_token_trim(codes, calm_token, breathing_room, default):
+    """
+    Finds, for every row of a (b,s) tensor of codes, the first index at which the current run of calm tokens is longer
+    than breathing_room. Rows that never get there are given default.
+    """
+    positions = torch.arange(codes.shape[1], device=codes.device).unsqueeze(0).expand_as(codes)
+    # index of the most recent non-calm token at every position, so the distance to it is the length of the calm run
+    last_other = positions.masked_fill(codes == calm_token, -1).cummax(dim=1).values
+    exceeded = (positions - last_other) > breathing_room
+    return torch.where(exceeded.any(dim=1), exceeded.int().argmax(dim=1), torch.full_like(positions[:, 0], default))
+
+def store_autoregressive_latents(latents, used_bytes, budget_bytes):
+    """
+    Keeps a batch of autoregressive latents on its device while the running total stays within budget_bytes, and
+    spills it to (pinned, when possible) CPU memory otherwise. Returns the latents to keep and the new device total.
+    """
+    size = latents.numel() * latents.element_size()
+    if latents.device.type != 'cpu' and used_bytes + size <= budget_bytes:
+        return latents, used_bytes + size
+
+    latents = latents.cpu()
+    if torch.cuda.is_available():
+        latents = latents.pin_memory()
+    return latents, used_bytes
+
+class CandidateRanker():
+    """
+    Scores autoregressive batches as they are sampled and only keeps a running top-k of them, so at most k candidates
+    plus the batch in flight are held instead of every sample. With a CUDA stream, each batch is scored on that stream
+    while the next one is being sampled; its scores are only read back once the next batch has been pushed.
+
+    With a patience or a threshold, done is set once the best score has stopped improving by more than margin for
+    patience batches, or has reached threshold, after at least k samples have been scored.
+    """
+    def __init__(self, k, score, stream=None, patience=0, margin=0.0, threshold=None):
+        self.k = k
+        self.score = score
+        self.stream = stream
+        self.patience = patience
+        self.margin = margin
+        self.threshold = threshold
+        self.heap = []
+        self.count = 0
+        self.pending = None
+        self.best = None
+        self.stale = 0
+        self.done = False
+
+    def push(self, codes, latents=None):
+        if self.stream is None:
+            self.collect(self.score(codes), codes, latents)
+            return
+
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            scores = self.score(codes)
+        # the side stream still reads these, keep the allocator from handing them back out until it is done
+        codes.record_stream(self.stream)
+        event = self.stream.record_event()
+
+        self.flush()
+        self.pending = (event, scores, codes, latents)
+
+    def flush(self):
+        if self.pending is None:
+            return
+        event, scores, codes, latents = self.pending
+        self.pending = None
+        event.synchronize()
+        self.collect(scores, codes, latents)
+
+    def collect(self, scores, codes, latents):
+        scores = scores.float().cpu().tolist()
+        for i, score in enumerate(scores):
+            # ties go to the earlier sample
+            key = (score, -self.count)
+            self.count += 1
+            if len(self.heap) >= self.k and key <= self.heap[0][:2]:
+                continue
+            entry = (score, key[1], codes[i].clone(), None if latents is None else latents[i].clone())
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, entry)
+            else:
+                heapq.heapreplace(self.heap, entry)
+        self.update(max(scores))
+
+    def update(self, best):
+        if self.best is None or best > self.best + self.margin:
+            self.stale = 0
+        else:
+            self.stale += 1
+        self.best = best if self.best is None else max(self.best, best)
+
+        if self.count < self.k:
+            return
+        if self.threshold is not None and self.best >= self.threshold:
+            self.done = True
+        if self.patience > 0 and self.stale >= self.patience:
+            self.done = True
+
+    def finish(self):
+        """
+        :return: A tuple of (best_codes, best_latents), best first. best_latents is a list of one [1 x S x D] tensor per
+                 candidate (for gather_autoregressive_latents()), or empty if no latents were pushed.
+        """
+        self.flush()
+        entries = sorted(self.heap, key=lambda entry: entry[:2], reverse=True)
+        self.heap = []
+        best_codes = torch.stack([entry[2] for entry in entries], dim=0)
+        best_latents = [entry[3].unsqueeze(0) for entry in entries if entry[3] is not None]
+        return best_codes, best_latents
+
+def gather_autoregressive_latents(cached_latents, indices, length, device):
+    """
+    Pulls the latents for the given indices (into the concatenation of every batch) out of the per-batch latents kept
+    while sampling. Each one is extended to <length> by repeating its last latent, to line up with the stop-token padded codes.
+    """
+    offsets = [0]
+    for latents in cached_latents:
+        offsets.append(offsets[-1] + latents.shape[0])
+
+    gathered = []
+    for i in indices:
+        b = bisect.bisect_right(offsets, i) - 1
+        latent = cached_latents[b][i - offsets[b]].to(device, non_blocking=True).float()
+        if latent.shape[0] < length:
+            latent = torch.cat([latent, latent[-1:].expand(length - latent.shape[0], -1)], dim=0)
+        gathered.append(latent[:length])
+    return torch.stack(gathered, dim=0)
+
+def get_diffusion_output_length(latent_length, input_sample_rate=22050, output_sample_rate=24000):
+    """
+    Returns the number of spectrogram frames the diffusion model produces for the given number of latents.
+    """
+    return latent_length * 4 * output_sample_rate // input_sample_rate  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
+
 @torch.inference_mode()
-def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True, desc=None, sampler="P", input_sample_rate=22050, output_sample_rate=24000):
+def do_spectrogram_diffusion(diffusion_model, diffuser, latents, conditioning_latents, temperature=1, verbose=True, desc=None, sampler="P", input_sample_rate=22050, output_sample_rate=24000, latent_lengths=None):
     """
     Uses the specified diffusion model to convert discrete codes into a spectrogram.
+
+    If latent_lengths is given, latents is treated as a zero-padded batch of differently sized candidates: padding is
+    masked out of the diffusion model and the padded frames of the returned spectrogram are filled with silence.
+    Use get_diffusion_output_length() to find where each candidate's spectrogram ends.
     """
     with torch.no_grad():
-        output_seq_len = latents.shape[1] * 4 * output_sample_rate // input_sample_rate  # This diffusion model converts from 22kHz spectrogram codes to a 24kHz spectrogram signal.
+        output_seq_len = get_diffusion_output_length(latents.shape[1], input_sample_rate, output_sample_rate)
         output_shape = (latents.shape[0], 100, output_seq_len)
-        precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
+        model_kwargs = {}
+        if latent_lengths is None:
+            precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False)
+        else:
+            output_lengths = get_diffusion_output_length(latent_lengths, input_sample_rate, output_sample_rate)
+            precomputed_embeddings = diffusion_model.timestep_independent(latents, conditioning_latents, output_seq_len, False,
+                                                                          aligned_lengths=latent_lengths, expected_lengths=output_lengths)
+            model_kwargs['mask'] = torch.arange(output_seq_len, device=latents.device).unsqueeze(0) < output_lengths.unsqueeze(1)
+        model_kwargs['precomputed_aligned_embeddings'] = precomputed_embeddings
 
         noise = torch.randn(output_shape, device=latents.device) * temperature
         
         diffuser.sampler = sampler.lower()
         mel = diffuser.sample_loop(diffusion_model, output_shape, noise=noise,
-                                      model_kwargs={'precomputed_aligned_embeddings': precomputed_embeddings}, desc=desc)
+                                      model_kwargs=model_kwargs, desc=desc)
 
         mel = denormalize_tacotron_mel(mel)[:,:,:output_seq_len]
+        if 'mask' in model_kwargs:
+            mel = mel.masked_fill(~model_kwargs['mask'].unsqueeze(1), TACOTRON_MEL_MIN)
         if get_device_name() == "dml":
             mel = mel.cpu()
         return mel
@@ -249,6 +424,207 @@ def migrate_to_device( t, device ):
 
     return t
 
+class ModelOffloader():
+    """
+    Moves models between the CPU and their devices in low VRAM mode. The weights of every registered model are kept in
+    pinned CPU memory, so loading a model is a non-blocking copy on a side stream, and offloading it only points its
+    tensors back at those copies.
+
+    Without a budget, a model is offloaded as soon as it is released. With a budget (in MiB), released models stay loaded
+    until their room is needed, are then offloaded least recently used first, and the model of the next stage can be
+    prefetched while the current one runs.
+    """
+    def __init__(self, budget=None):
+        self.budget = budget * 1024 * 1024 if budget else None
+        self.models = OrderedDict() # least recently used first
+        self.streams = {}
+        self.used = 0
+
+    def register(self, name, model, device):
+        if name in self.models:
+            if self.models[name]['model'] is model:
+                return
+            self.unregister(name)
+
+        # parameters and buffers may alias each other, so every tensor is only moved once
+        tensors = list({ id(t): t for t in list(model.parameters()) + list(model.buffers()) }.values())
+        for t in tensors:
+            t.data = t.data.cpu().pin_memory()
+
+        self.models[name] = {
+            'model': model,
+            'device': torch.device(device),
+            'tensors': tensors,
+            'host': [ t.data for t in tensors ],
+            'size': sum([ t.numel() * t.element_size() for t in tensors ]),
+            'loaded': False,
+            'active': False,
+            'event': None,
+        }
+        self.track(model, 'cpu')
+
+    def unregister(self, name):
+        if name not in self.models:
+            return
+        self.offload(name)
+        del self.models[name]
+
+    def track(self, model, device):
+        # keeps the device migrate_to_device() tracks on modules in step
+        model.device = device
+        model.manually_track_device = True
+
+    def stream(self, device):
+        if device not in self.streams:
+            self.streams[device] = torch.cuda.Stream(device=device)
+        return self.streams[device]
+
+    def make_room(self, size, keep=None):
+        """
+        Offloads released models, least recently used first, until size more bytes fit in the budget.
+        :return: Whether they fit.
+        """
+        if self.budget is None:
+            return True
+
+        for name, entry in list(self.models.items()):
+            if self.used + size <= self.budget:
+                break
+            if name != keep and entry['loaded'] and not entry['active']:
+                self.offload(name)
+        return self.used + size <= self.budget
+
+    def copy(self, name):
+        entry = self.models[name]
+        stream = self.stream(entry['device'])
+        with torch.cuda.stream(stream):
+            for t, host in zip(entry['tensors'], entry['host']):
+                t.data = host.to(entry['device'], non_blocking=True)
+            entry['event'] = stream.record_event()
+        entry['loaded'] = True
+        self.used += entry['size']
+        self.track(entry['model'], entry['device'])
+
+    def prefetch(self, name):
+        """
+        Starts copying a model onto its device in the background, if the budget has room for it. Does nothing without a budget.
+        """
+        entry = self.models.get(name)
+        if self.budget is None or entry is None or entry['loaded']:
+            return
+        if self.make_room(entry['size'], keep=name):
+            self.copy(name)
+
+    def load(self, name):
+        """
+        Makes a model usable from the current stream of its device, and keeps it loaded until it is released.
+        """
+        entry = self.models[name]
+        if not entry['loaded']:
+            self.make_room(entry['size'], keep=name)
+            self.copy(name)
+
+        if entry['event'] is not None:
+            current = torch.cuda.current_stream(entry['device'])
+            current.wait_event(entry['event'])
+            # the weights were allocated on the side stream, so their memory must not be reused before this one is done with them
+            for t in entry['tensors']:
+                t.data.record_stream(current)
+            entry['event'] = None
+
+        entry['active'] = True
+        self.models.move_to_end(name)
+        return entry['model']
+
+    def release(self, name):
+        entry = self.models.get(name)
+        if entry is None:
+            return
+        entry['active'] = False
+        if self.budget is None:
+            self.offload(name)
+
+    def offload(self, name):
+        entry = self.models[name]
+        if not entry['loaded']:
+            return
+        for t, host in zip(entry['tensors'], entry['host']):
+            t.data = host
+        entry['loaded'] = False
+        entry['active'] = False
+        entry['event'] = None
+        self.used -= entry['size']
+        self.track(entry['model'], 'cpu')
+
+class CandidateDecodeBatcher:
+    """
+    Lets the threads of several concurrent tts() calls share diffusion and vocoder batches. Sampling stays one thread at
+    a time, and once every participating thread is waiting to decode (or done), all of their candidates are decoded
+    together with TextToSpeech.decode_candidates_batch().
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.sampling_lock = threading.Lock()
+        self.participants = set()
+        self.pending = []
+        self.decoding = False
+        self.batch_sizes = []
+
+    def join(self):
+        with self.condition:
+            self.participants.add(threading.get_ident())
+
+    def leave(self):
+        with self.condition:
+            self.participants.discard(threading.get_ident())
+            self.condition.notify_all()
+
+    def is_participant(self):
+        with self.condition:
+            return threading.get_ident() in self.participants
+
+    def decode(self, tts, job, **diffusion_kwargs):
+        """
+        Queues <job> (text, best_results, best_latents, diffusion_conditioning) and blocks until it has been decoded.
+        """
+        entry = { 'job': job, 'kwargs': diffusion_kwargs, 'done': False, 'result': None, 'error': None }
+        batch = None
+        with self.condition:
+            self.pending.append(entry)
+            self.condition.notify_all()
+            while not entry['done']:
+                if not self.decoding and len(self.pending) >= len(self.participants):
+                    batch, self.pending = self.pending, []
+                    self.decoding = True
+                    break
+                self.condition.wait()
+
+        if batch is not None:
+            try:
+                self.batch_sizes.append(len(batch))
+                # only jobs asking for the same diffusion settings can share a batch
+                groups = {}
+                for pending in batch:
+                    groups.setdefault(tuple(sorted(pending['kwargs'].items())), []).append(pending)
+                for group in groups.values():
+                    results = tts.decode_candidates_batch([ pending['job'] for pending in group ], **group[0]['kwargs'])
+                    for pending, result in zip(group, results):
+                        pending['result'] = result
+            except Exception as e:
+                for pending in batch:
+                    pending['error'] = e
+            finally:
+                with self.condition:
+                    for pending in batch:
+                        pending['done'] = True
+                    self.decoding = False
+                    self.condition.notify_all()
+
+        if entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+
 class TextToSpeech:
     """
     Main entry point into Tortoise.
@@ -259,6 +635,8 @@ class TextToSpeech:
         unsqueeze_sample_batches=False,
         input_sample_rate=22050, output_sample_rate=24000,
         autoregressive_model_path=None, diffusion_model_path=None, vocoder_model=None, tokenizer_json=None,
+        device_map=None,
+        offload_budget=None,
 #    ):
         use_deepspeed=False):  # Add use_deepspeed parameter
         """
@@ -271,6 +649,14 @@ class TextToSpeech:
                                  (but are still rendered by the model). This can be used for prompt engineering.
                                  Default is true.
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
+        :param device_map: Optionally places models on devices other than device, as a dict keyed by 'autoregressive',
+                           'clvp' (which also covers CVVP), 'diffusion' and 'vocoder'. CLVP defaults to the autoregressive
+                           model's device and the vocoder to the diffusion model's, so {'autoregressive': 'cuda:0',
+                           'diffusion': 'cuda:1'} runs sampling and decoding on separate GPUs. The 'autoregressive' entry
+                           may also be a list of CUDA devices to split the GPT2 layers across (requires minor_optimizations).
+        :param offload_budget: Without minor_optimizations, how many MiB of model weights may stay on CUDA devices between
+                               stages. Models are then only offloaded once that room is needed, and the next stage's model
+                               is copied over while the current one runs. By default, models are offloaded right after use.
         """ 
         self.loading = True
         if device is None:
@@ -286,6 +672,9 @@ class TextToSpeech:
         # for clarity, it's simpler to split these up and just predicate them on requesting VRAM-consuming optimizations
         self.preloaded_tensors = minor_optimizations
         self.use_kv_cache = minor_optimizations
+        # set to a CandidateDecodeBatcher to let concurrent tts() calls share their diffusion batches
+        self.decode_batcher = None
+        self.num_autoregressive_samples_used = 0
         if get_device_name() == "dml": # does not work with DirectML
             print("KV caching requested but not supported with the DirectML backend, disabling...")
             self.use_kv_cache = False
@@ -294,8 +683,33 @@ class TextToSpeech:
         self.autoregressive_batch_size = get_device_batch_size() if autoregressive_batch_size is None or autoregressive_batch_size == 0 else autoregressive_batch_size
         self.enable_redaction = enable_redaction
         self.device = device
+
+        device_map = {} if device_map is None else device_map
+        self.autoregressive_layer_devices = None
+        self.autoregressive_device = device_map.get('autoregressive', device)
+        if isinstance(self.autoregressive_device, (list, tuple)):
+            self.autoregressive_layer_devices = [ torch.device(d) for d in self.autoregressive_device ]
+            self.autoregressive_device = self.autoregressive_layer_devices[0]
+            if not self.preloaded_tensors or self.use_deepspeed:
+                print("Splitting the autoregressive model across devices requires it to stay loaded (and no deepspeed), disabling...")
+                self.autoregressive_layer_devices = None
+            else:
+                # GPT2Model.forward() hands the hidden states on from cuda:N to cuda:N+1
+                indices = [ d.index if d.index is not None else 0 for d in self.autoregressive_layer_devices ]
+                if any([ d.type != 'cuda' for d in self.autoregressive_layer_devices ]) or indices != list(range(indices[0], indices[0] + len(indices))):
+                    print("Splitting the autoregressive model across devices requires consecutive CUDA devices, disabling...")
+                    self.autoregressive_layer_devices = None
+        self.clvp_device = device_map.get('clvp', self.autoregressive_device)
+        self.diffusion_device = device_map.get('diffusion', device)
+        self.vocoder_device = device_map.get('vocoder', self.diffusion_device)
+
+        # in low VRAM mode, models are moved on and off their devices from pinned memory
+        self.offloader = None
+        if not self.preloaded_tensors and get_device_name() == "cuda":
+            self.offloader = ModelOffloader(budget=offload_budget)
+
         if self.enable_redaction:
-            self.aligner = Wav2VecAlignment(device='cpu' if get_device_name() == "dml" else self.device)
+            self.aligner = Wav2VecAlignment(device='cpu' if get_device_name() == "dml" else self.vocoder_device, keep_loaded=self.preloaded_tensors)
 
         self.load_tokenizer_json(tokenizer_json)
 
@@ -331,13 +745,85 @@ class TextToSpeech:
         self.rlg_diffusion = None
 
         if self.preloaded_tensors:
-            self.autoregressive = migrate_to_device( self.autoregressive, self.device )
-            self.diffusion = migrate_to_device( self.diffusion, self.device )
-            self.clvp = migrate_to_device( self.clvp, self.device )
-            self.vocoder = migrate_to_device( self.vocoder, self.device )
+            self.migrate_autoregressive( self.autoregressive_device )
+            self.diffusion = migrate_to_device( self.diffusion, self.diffusion_device )
+            self.clvp = migrate_to_device( self.clvp, self.clvp_device )
+            self.vocoder = migrate_to_device( self.vocoder, self.vocoder_device )
+        else:
+            for name in ['autoregressive', 'diffusion', 'clvp', 'vocoder']:
+                self.register_model(name)
 
         self.loading = False
 
+    def get_model_device(self, name):
+        if name == 'autoregressive':
+            return self.autoregressive_device
+        if name in ['clvp', 'cvvp']:
+            return self.clvp_device
+        if name == 'diffusion':
+            return self.diffusion_device
+        return self.vocoder_device
+
+    def register_model(self, name):
+        """
+        Hands a freshly loaded model over to the offloader, when there is one.
+        """
+        if self.offloader is not None and getattr(self, name, None) is not None:
+            self.offloader.register(name, getattr(self, name), self.get_model_device(name))
+
+    def load_model(self, name, device=None):
+        """
+        Brings a model onto device (its own device by default) for the current stage, through the offloader when there is one.
+        """
+        if device is None:
+            device = self.get_model_device(name)
+
+        if self.offloader is not None and name in self.offloader.models:
+            if torch.device(device).type == 'cpu':
+                self.offloader.offload(name)
+            else:
+                self.offloader.load(name)
+        elif name == 'autoregressive':
+            self.migrate_autoregressive( device )
+        else:
+            setattr(self, name, migrate_to_device( getattr(self, name), device ))
+
+    def release_model(self, name):
+        """
+        Marks the end of a model's stage: in low VRAM mode it goes back to the offloader (or the CPU), otherwise it goes
+        back to its own device.
+        """
+        if self.preloaded_tensors:
+            self.load_model(name)
+        elif self.offloader is not None and name in self.offloader.models:
+            self.offloader.release(name)
+        else:
+            self.load_model(name, 'cpu')
+
+    def prefetch_model(self, *names):
+        """
+        Lets the offloader start copying the models of the next stage while the current one runs.
+        """
+        if self.offloader is None:
+            return
+        for name in names:
+            self.offloader.prefetch(name)
+
+    def migrate_autoregressive(self, device):
+        """
+        migrate_to_device() for the autoregressive model, which also splits its GPT2 layers across
+        autoregressive_layer_devices whenever it lands on its own device, and joins them back before it leaves.
+        """
+        inference_model = getattr(self.autoregressive, 'inference_model', None)
+        if inference_model is not None and inference_model.model_parallel and device != self.autoregressive_device:
+            inference_model.deparallelize()
+
+        self.autoregressive = migrate_to_device( self.autoregressive, device )
+
+        if inference_model is not None and self.autoregressive_layer_devices and device == self.autoregressive_device and not inference_model.model_parallel:
+            device_ids = [ d.index if d.index is not None else 0 for d in self.autoregressive_layer_devices ]
+            inference_model.parallelize(get_device_map(len(inference_model.transformer.h), device_ids))
+
     def load_autoregressive_model(self, autoregressive_model_path, is_xtts=False):
         if hasattr(self,"autoregressive_model_path") and os.path.samefile(self.autoregressive_model_path, autoregressive_model_path):
             return
@@ -354,6 +840,8 @@ class TextToSpeech:
         print(f"Loading autoregressive model: {self.autoregressive_model_path}")
 
         if hasattr(self, 'autoregressive'):
+            if self.offloader is not None:
+                self.offloader.unregister('autoregressive')
             del self.autoregressive
 
         # XTTS requires a different "dimensionality" for its autoregressive model
@@ -391,7 +879,9 @@ class TextToSpeech:
         self.autoregressive.load_state_dict(torch.load(self.autoregressive_model_path))
         self.autoregressive.post_init_gpt2_config(use_deepspeed=self.use_deepspeed, kv_cache=self.use_kv_cache)
         if self.preloaded_tensors:
-            self.autoregressive = migrate_to_device( self.autoregressive, self.device )
+            self.migrate_autoregressive( self.autoregressive_device )
+        else:
+            self.register_model('autoregressive')
 
         self.loading = False
         print(f"Loaded autoregressive model")
@@ -406,6 +896,8 @@ class TextToSpeech:
         self.diffusion_model_hash = hash_file(self.diffusion_model_path)
 
         if hasattr(self, 'diffusion'):
+            if self.offloader is not None:
+                self.offloader.unregister('diffusion')
             del self.diffusion
 
         # XTTS does not require a different "dimensionality" for its diffusion model
@@ -425,7 +917,9 @@ class TextToSpeech:
         self.diffusion = DiffusionTts(**dimensionality)
         self.diffusion.load_state_dict(torch.load(get_model_path('diffusion_decoder.pth', self.models_dir)))
         if self.preloaded_tensors:
-            self.diffusion = migrate_to_device( self.diffusion, self.device )
+            self.diffusion = migrate_to_device( self.diffusion, self.diffusion_device )
+        else:
+            self.register_model('diffusion')
 
         self.loading = False
         print(f"Loaded diffusion model")
@@ -437,6 +931,8 @@ class TextToSpeech:
         self.loading = True
 
         if hasattr(self, 'vocoder'):
+            if self.offloader is not None:
+                self.offloader.unregister('vocoder')
             del self.vocoder
 
         print("Loading vocoder model:", vocoder_model)
@@ -466,7 +962,9 @@ class TextToSpeech:
 
         self.vocoder.eval(inference=True)
         if self.preloaded_tensors:
-            self.vocoder = migrate_to_device( self.vocoder, self.device )
+            self.vocoder = migrate_to_device( self.vocoder, self.vocoder_device )
+        else:
+            self.register_model('vocoder')
         self.loading = False
         print(f"Loaded vocoder model")
 
@@ -493,7 +991,9 @@ class TextToSpeech:
         self.cvvp.load_state_dict(torch.load(get_model_path('cvvp.pth', self.models_dir)))
         
         if self.preloaded_tensors:
-            self.cvvp = migrate_to_device( self.cvvp, self.device )
+            self.cvvp = migrate_to_device( self.cvvp, self.clvp_device )
+        else:
+            self.register_model('cvvp')
 
     @torch.inference_mode()
     def get_conditioning_latents(self, voice_samples, return_mels=False, verbose=False, slices=1, max_chunk_size=None, force_cpu=False, original_ar=False, original_diffusion=False):
@@ -508,7 +1008,8 @@ class TextToSpeech:
             # computing conditional latents requires being done on the CPU if using DML because M$ still hasn't implemented some core functions
             if get_device_name() == "dml":
                 force_cpu = True
-            device = torch.device('cpu') if force_cpu else self.device
+            device = torch.device('cpu') if force_cpu else self.autoregressive_device
+            diffusion_device = torch.device('cpu') if force_cpu else self.diffusion_device
 
             if not isinstance(voice_samples, list):
                 voice_samples = [voice_samples]
@@ -533,13 +1034,9 @@ class TextToSpeech:
 
             voice_samples = [migrate_to_device(v, device)  for v in voice_samples]
 
-            auto_conds = []
-            diffusion_conds = []
-
             if original_ar:
                 samples = [resampler_22K(sample) for sample in voice_samples]
-                for sample in tqdm(samples, desc="Computing AR conditioning latents..."):
-                    auto_conds.append(format_conditioning(sample, device=device, sampling_rate=self.input_sample_rate, cond_length=132300))
+                auto_conds = format_conditioning_batch(samples, device=device, sampling_rate=self.input_sample_rate, cond_length=132300)
             else:
                 samples = [resampler_22K(sample) for sample in voice_samples]
                 concat = torch.cat(samples, dim=-1)
@@ -555,33 +1052,27 @@ class TextToSpeech:
                 chunks = torch.chunk(concat, slices, dim=1)
                 chunk_size = chunks[0].shape[-1]
 
-                for chunk in tqdm(chunks, desc="Computing AR conditioning latents..."):
-                    auto_conds.append(format_conditioning(chunk, device=device, sampling_rate=self.input_sample_rate, cond_length=chunk_size))
-                
+                auto_conds = format_conditioning_batch(chunks, device=device, sampling_rate=self.input_sample_rate, cond_length=chunk_size)
 
+            check_for_kill_signal()
             if original_diffusion:
                 samples = [resampler_24K(sample) for sample in voice_samples]
-                for sample in tqdm(samples, desc="Computing diffusion conditioning latents..."):
-                    sample = pad_or_truncate(sample, 102400)
-                    cond_mel = wav_to_univnet_mel(migrate_to_device(sample, device), do_normalization=False, device=self.device)
-                    diffusion_conds.append(cond_mel)
+                samples = torch.cat([pad_or_truncate(sample, 102400) for sample in samples], dim=0)
+                diffusion_conds = wav_to_univnet_mel(migrate_to_device(samples, diffusion_device), do_normalization=False, device=diffusion_device)
             else:
-                samples = [resampler_24K(sample) for sample in voice_samples]
-                for chunk in tqdm(chunks, desc="Computing diffusion conditioning latents..."):
-                    check_for_kill_signal()
-                    chunk = pad_or_truncate(chunk, chunk_size)
-                    cond_mel = wav_to_univnet_mel(migrate_to_device( chunk, device ), do_normalization=False, device=device)
-                    diffusion_conds.append(cond_mel)
+                chunks = torch.cat([pad_or_truncate(chunk, chunk_size) for chunk in chunks], dim=0)
+                diffusion_conds = wav_to_univnet_mel(migrate_to_device( chunks, diffusion_device ), do_normalization=False, device=diffusion_device)
+            diffusion_conds = diffusion_conds.unsqueeze(0)
 
-            auto_conds = torch.stack(auto_conds, dim=1)
-            self.autoregressive = migrate_to_device( self.autoregressive, device )
+            self.load_model('autoregressive', device)
+            if not force_cpu:
+                self.prefetch_model('diffusion')
             auto_latent = self.autoregressive.get_conditioning(auto_conds)
-            self.autoregressive = migrate_to_device( self.autoregressive, self.device if self.preloaded_tensors else 'cpu' )
+            self.release_model('autoregressive')
 
-            diffusion_conds = torch.stack(diffusion_conds, dim=1)
-            self.diffusion = migrate_to_device( self.diffusion, device )
+            self.load_model('diffusion', diffusion_device)
             diffusion_latent = self.diffusion.get_conditioning(diffusion_conds)
-            self.diffusion = migrate_to_device( self.diffusion, self.device if self.preloaded_tensors else 'cpu' )
+            self.release_model('diffusion')
 
         if return_mels:
             return auto_latent, diffusion_latent, auto_conds, diffusion_conds
@@ -627,6 +1118,10 @@ class TextToSpeech:
             # autoregressive generation parameters follow
             num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
             sample_batch_size=None,
+            cache_autoregressive_latents=False, autoregressive_latent_budget=1024,
+            early_exit=True,
+            pipeline_ranking=False,
+            adaptive_patience=0, adaptive_margin=0.0, adaptive_threshold=None,
             autoregressive_model=None,
             diffusion_model=None,
             tokenizer_json=None,
@@ -636,6 +1131,7 @@ class TextToSpeech:
             diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
             diffusion_sampler="P",
             breathing_room=8,
+            batch_diffusion=True,
             half_p=False,
             **hf_generate_kwargs):
         """
@@ -660,6 +1156,24 @@ class TextToSpeech:
                                  I was interested in the premise, but the results were not as good as I was hoping. This is off by default, but
                                  could use some tuning.
         :param typical_mass: The typical_mass parameter from the typical_sampling algorithm.
+        :param cache_autoregressive_latents: Keeps the latents of every sample while sampling, instead of re-running the
+                                             autoregressive model over the best results to produce the diffusion conditioning.
+                                             The latents after each stop token come from sampling rather than the fixed up codes.
+        :param autoregressive_latent_budget: How many MiB of cached latents are kept on the device. Anything past this
+                                             is spilled to pinned CPU memory.
+        :param early_exit: Stops computing each autoregressive sample once it has produced its stop token, rather than running
+                           the whole batch until its longest sample is done. Turn it off to sample through huggingface's generate().
+        :param pipeline_ranking: Scores each autoregressive batch with CLVP (and CVVP) as soon as it is sampled, overlapping
+                                 the two on CUDA, and only keeps the running top k candidates instead of every sample.
+                                 The ranking models stay on the device next to the autoregressive model while sampling.
+        :param adaptive_patience: Stops drawing autoregressive batches once the best candidate score has not improved by more
+                                  than adaptive_margin for this many batches. 0 disables it. Implies pipeline_ranking.
+        :param adaptive_margin: How much the best score has to rise by for a batch to count as an improvement.
+        :param adaptive_threshold: Stops drawing autoregressive batches as soon as a candidate scores at least this much
+                                   (on CLVP's scale, i.e. cosine similarity times its learned temperature). Implies pipeline_ranking.
+                                   At least k samples are always drawn, and on CUDA one extra batch may already be in flight
+                                   when sampling stops. With return_deterministic_state, the number of samples actually
+                                   drawn is returned as the last item of the state.
         ~~CLVP-CVVP KNOBS~~
         :param cvvp_amount: Controls the influence of the CVVP model in selecting the best output from the autoregressive model.
                             [0,1]. Values closer to 1 mean the CVVP model is more important, 0 disables the CVVP model.
@@ -676,6 +1190,12 @@ class TextToSpeech:
                             Formula is: output=cond_present_output*(cond_free_k+1)-cond_absenct_output*cond_free_k
         :param diffusion_temperature: Controls the variance of the noise fed into the diffusion model. [0,1]. Values at 0
                                       are the "mean" prediction of the diffusion network and will sound bland and smeared.
+        :param diffusion_sampler: Sampler used for the diffusion loop: "P", "DDIM", or one of the multistep ODE solvers
+                                  "DPM++2M" and "UniPC", which reach comparable quality in far fewer iterations (10-20).
+        :param batch_diffusion: When k > 1, decodes every candidate in a single padded and masked diffusion pass and
+                                vocodes them in one call, instead of running the diffusion loop once per candidate.
+                                If a decode_batcher is set and this thread takes part in it, the candidates of concurrent
+                                tts() calls are decoded together as well, and seeded results are no longer reproducible.
         ~~OTHER STUFF~~
         :param hf_generate_kwargs: The huggingface Transformers generate API is used for the autoregressive transformer.
                                    Extra keyword args fed to this function get forwarded directly to that API. Documentation
@@ -684,30 +1204,187 @@ class TextToSpeech:
                  Sample rate is 24kHz.
         """
 
+        if get_device_name() == "dml" and half_p:
+            print("Float16 requested but not supported with the DirectML backend, disabling...")
+            half_p = False
+
+        batcher = self.decode_batcher if self.decode_batcher is not None and self.decode_batcher.is_participant() else None
+        with batcher.sampling_lock if batcher is not None else contextlib.nullcontext():
+            self.diffusion.enable_fp16 = half_p
+            deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+            self.update_models(autoregressive_model=autoregressive_model, diffusion_model=diffusion_model, tokenizer_json=tokenizer_json)
+
+            best_results, best_latents, diffusion_conditioning = self.sample_candidates(text, voice_samples=voice_samples, conditioning_latents=conditioning_latents,
+                k=k, verbose=verbose,
+                num_autoregressive_samples=num_autoregressive_samples, temperature=temperature, length_penalty=length_penalty,
+                repetition_penalty=repetition_penalty, top_p=top_p, max_mel_tokens=max_mel_tokens, sample_batch_size=sample_batch_size,
+                cache_autoregressive_latents=cache_autoregressive_latents, autoregressive_latent_budget=autoregressive_latent_budget,
+                early_exit=early_exit,
+                pipeline_ranking=pipeline_ranking,
+                adaptive_patience=adaptive_patience, adaptive_margin=adaptive_margin, adaptive_threshold=adaptive_threshold,
+                cvvp_amount=cvvp_amount,
+                half_p=half_p,
+                **hf_generate_kwargs)
+            num_autoregressive_samples_used = self.num_autoregressive_samples_used
+
+        diffusion_kwargs = dict(diffusion_iterations=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k,
+            diffusion_temperature=diffusion_temperature, diffusion_sampler=diffusion_sampler,
+            breathing_room=breathing_room, batch_diffusion=batch_diffusion)
+        if batcher is not None:
+            res = batcher.decode(self, (text, best_results, best_latents, diffusion_conditioning), **diffusion_kwargs)
+        else:
+            res = self.decode_candidates(text, best_results, best_latents, diffusion_conditioning, **diffusion_kwargs)
+
+        do_gc()
+
+        if return_deterministic_state:
+            return res, (deterministic_seed, text, voice_samples, conditioning_latents, num_autoregressive_samples_used)
+        else:
+            return res
+
+    def tts_stream(self, texts, voice_samples=None, conditioning_latents=None, k=1, verbose=True, use_deterministic_seed=None,
+            autoregressive_model=None,
+            diffusion_model=None,
+            tokenizer_json=None,
+            # diffusion generation parameters follow
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_sampler="P",
+            breathing_room=8,
+            batch_diffusion=True,
+            half_p=False,
+            pipeline=True,
+            **sampling_kwargs):
+        """
+        Generator flavor of tts() over a list of lines. Takes the same parameters as tts(), and yields (line, clip(s)) for
+        each line as soon as it is vocoded.
+        :param pipeline: Samples the next line's candidates on a background thread (and its own CUDA stream) while the
+                         current line is being diffused, so the first clip arrives after about one line's latency.
+                         Only used when the models are kept on the device. Seeded results are not reproducible with it on.
+        """
         if get_device_name() == "dml" and half_p:
             print("Float16 requested but not supported with the DirectML backend, disabling...")
             half_p = False
 
         self.diffusion.enable_fp16 = half_p
-        deterministic_seed = self.deterministic_state(seed=use_deterministic_seed)
+        self.deterministic_state(seed=use_deterministic_seed)
+        self.update_models(autoregressive_model=autoregressive_model, diffusion_model=diffusion_model, tokenizer_json=tokenizer_json)
+
+        # compute the conditioning latents once rather than once per line
+        if voice_samples is not None:
+            conditioning_latents = self.get_conditioning_latents(voice_samples, return_mels=True, verbose=True)
+
+        sample = functools.partial(self.sample_candidates, conditioning_latents=conditioning_latents, k=k, verbose=verbose, half_p=half_p, **sampling_kwargs)
+        decode = functools.partial(self.decode_candidates,
+            diffusion_iterations=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k,
+            diffusion_temperature=diffusion_temperature, diffusion_sampler=diffusion_sampler,
+            breathing_room=breathing_room, batch_diffusion=batch_diffusion)
+
+        if not pipeline or not self.preloaded_tensors or len(texts) < 2:
+            for line, text in enumerate(texts):
+                yield line, decode(text, *sample(text))
+            do_gc()
+            return
 
-        if autoregressive_model is None:
-            autoregressive_model = self.autoregressive_model_path
-        elif autoregressive_model != self.autoregressive_model_path:
+        stream = torch.cuda.Stream(device=self.autoregressive_device) if get_device_name() == "cuda" else None
+        def sample_in_background(text):
+            if stream is None:
+                return sample(text)
+            with torch.cuda.stream(stream):
+                candidates = sample(text)
+            stream.synchronize()
+            return candidates
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(sample_in_background, texts[0])
+            for line, text in enumerate(texts):
+                candidates = pending.result()
+                if stream is not None:
+                    # these were allocated on the side stream, keep the allocator from handing them back out while still in use here
+                    for t in candidates:
+                        if t.is_cuda:
+                            t.record_stream(torch.cuda.current_stream())
+                if line + 1 < len(texts):
+                    pending = executor.submit(sample_in_background, texts[line + 1])
+                yield line, decode(text, *candidates)
+        do_gc()
+
+    def update_models(self, autoregressive_model=None, diffusion_model=None, tokenizer_json=None):
+        """
+        Swaps in the requested models (if they differ from the loaded ones) ahead of generation.
+        """
+        if autoregressive_model is not None and autoregressive_model != self.autoregressive_model_path:
             self.load_autoregressive_model(autoregressive_model)
 
-        if diffusion_model is None:
-            diffusion_model = self.diffusion_model_path
-        elif diffusion_model != self.diffusion_model_path:
+        if diffusion_model is not None and diffusion_model != self.diffusion_model_path:
             self.load_diffusion_model(diffusion_model)
 
-        if tokenizer_json is None:
-            tokenizer_json = self.tokenizer_json
-        elif tokenizer_json != self.tokenizer_json:
+        if tokenizer_json is not None and tokenizer_json != self.tokenizer_json:
             self.load_tokenizer_json(tokenizer_json)
 
+    def prepare_candidate_ranking(self, text_tokens, auto_conds, cvvp_amount):
+        """
+        Brings CLVP (and CVVP, when cvvp_amount > 0) onto the device and encodes what every candidate is scored against.
+        :return: A tuple of (text_latents, cond_latents) to pass on to score_candidates(). Either may be None when unused.
+        """
+        if not self.preloaded_tensors:
+            self.load_model('clvp')
+
+        if cvvp_amount > 0:
+            if self.cvvp is None:
+                self.load_cvvp()
+
+            if not self.preloaded_tensors:
+                self.load_model('cvvp')
+
+        # The text and the conditioning clips are the same for every candidate, so they are encoded once up front.
+        # Averaging the similarity over every conditioning clip is the same as scoring against their mean latent.
+        text_latents = None
+        cond_latents = None
+        if cvvp_amount != 1 or auto_conds is None:
+            text_latents = self.clvp.encode_text(text_tokens.to(self.clvp_device))
+        if auto_conds is not None and cvvp_amount > 0:
+            cond_latents = self.cvvp.encode_conditioning(auto_conds[0].to(self.clvp_device)).mean(dim=0, keepdim=True)
+        return text_latents, cond_latents
+
+    def score_candidates(self, batch, text_latents, cond_latents, cvvp_amount):
+        """
+        Scores a batch of (fixed up) autoregressive codes against the latents from prepare_candidate_ranking().
+        """
+        if self.unsqueeze_sample_batches and batch.shape[0] > 1:
+            return torch.cat([self.score_candidates(row, text_latents, cond_latents, cvvp_amount) for row in batch.split(1)], dim=0)
+
+        batch = batch.to(self.clvp_device)
+
+        if text_latents is not None:
+            clvp = self.clvp.similarity(text_latents, self.clvp.encode_speech(batch))
+        if cond_latents is None:
+            return clvp
+
+        cvvp = self.cvvp.similarity(cond_latents, self.cvvp.encode_speech(batch))
+        if text_latents is None:
+            return cvvp
+        return cvvp * cvvp_amount + clvp * (1-cvvp_amount)
+
+    @torch.inference_mode()
+    def sample_candidates(self, text, voice_samples=None, conditioning_latents=None, k=1, verbose=True,
+            # autoregressive generation parameters follow
+            num_autoregressive_samples=512, temperature=.8, length_penalty=1, repetition_penalty=2.0, top_p=.8, max_mel_tokens=500,
+            sample_batch_size=None,
+            cache_autoregressive_latents=False, autoregressive_latent_budget=1024,
+            early_exit=True,
+            pipeline_ranking=False,
+            adaptive_patience=0, adaptive_margin=0.0, adaptive_threshold=None,
+            # CVVP parameters follow
+            cvvp_amount=.0,
+            half_p=False,
+            **hf_generate_kwargs):
+        """
+        First half of tts(): samples the autoregressive model and ranks the samples with CLVP (and CVVP).
+        Takes the same parameters as tts().
+        :return: A tuple of (best_codes, best_latents, diffusion_conditioning) to pass on to decode_candidates().
+        """
         text_tokens = torch.IntTensor(self.tokenizer.encode(text)).unsqueeze(0)
-        text_tokens = migrate_to_device( text_tokens, self.device )
+        text_tokens = migrate_to_device( text_tokens, self.autoregressive_device )
 
         text_tokens = F.pad(text_tokens, (0, 1))  # This may not be necessary.
         assert text_tokens.shape[-1] < 400, 'Too much text provided. Break the text up into separate segments and re-try inference.'
@@ -724,25 +1401,38 @@ class TextToSpeech:
         else:
             auto_conditioning, diffusion_conditioning = self.get_random_conditioning_latents()
 
-        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
-
         self.autoregressive_batch_size = get_device_batch_size() if sample_batch_size is None or sample_batch_size == 0 else sample_batch_size
 
         with torch.no_grad():
             samples = []
+            sample_latents = []
+            sample_latent_bytes = 0
             num_batches = num_autoregressive_samples // self.autoregressive_batch_size
             if num_autoregressive_samples < self.autoregressive_batch_size:
                 num_autoregressive_samples = 1
             stop_mel_token = self.autoregressive.stop_mel_token
-            calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
 
-            self.autoregressive = migrate_to_device( self.autoregressive, self.device )
-            auto_conditioning = migrate_to_device( auto_conditioning, self.device )
-            text_tokens = migrate_to_device( text_tokens, self.device )
+            self.load_model('autoregressive')
+            # ranking comes next, so its models can be copied over while sampling
+            self.prefetch_model(*(['clvp', 'cvvp'] if cvvp_amount > 0 else ['clvp']))
+            auto_conditioning = migrate_to_device( auto_conditioning, self.autoregressive_device )
+            text_tokens = migrate_to_device( text_tokens, self.autoregressive_device )
 
+            ranker = None
+            adaptive = adaptive_patience > 0 or adaptive_threshold is not None
             with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
+                if pipeline_ranking or adaptive:
+                    text_latents, cond_latents = self.prepare_candidate_ranking(text_tokens, auto_conds, cvvp_amount)
+                    score = functools.partial(self.score_candidates, text_latents=text_latents, cond_latents=cond_latents, cvvp_amount=cvvp_amount)
+                    # scores are read back on the sampling stream, so only overlap the two when they share a device
+                    same_device = torch.device(self.clvp_device) == torch.device(self.autoregressive_device)
+                    stream = torch.cuda.Stream(device=self.clvp_device) if get_device_name() == "cuda" and same_device else None
+                    ranker = CandidateRanker(k, score, stream=stream, patience=adaptive_patience, margin=adaptive_margin, threshold=adaptive_threshold)
+
                 for b in tqdm(range(num_batches), desc="Generating autoregressive samples"):
                     check_for_kill_signal()
+                    if ranker is not None and ranker.done:
+                        break
                     codes = self.autoregressive.inference_speech(auto_conditioning, text_tokens,
                                                                  do_sample=True,
                                                                  top_p=top_p,
@@ -751,162 +1441,207 @@ class TextToSpeech:
                                                                  length_penalty=length_penalty,
                                                                  repetition_penalty=repetition_penalty,
                                                                  max_generate_length=max_mel_tokens,
+                                                                 return_latent=cache_autoregressive_latents,
+                                                                 early_exit=early_exit,
                                                                  **hf_generate_kwargs)
+                    latents = None
+                    if cache_autoregressive_latents:
+                        codes, latents = codes
                     padding_needed = max_mel_tokens - codes.shape[1]
                     codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
+                    if ranker is not None:
+                        fix_autoregressive_output_batch(codes, stop_mel_token)
+                        ranker.push(codes, latents)
+                        continue
+                    if latents is not None:
+                        latents, sample_latent_bytes = store_autoregressive_latents(latents, sample_latent_bytes, autoregressive_latent_budget * 1024 * 1024)
+                        sample_latents.append(latents)
                     samples.append(codes)
 
-            if not self.preloaded_tensors:
-                self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
+                if ranker is not None:
+                    best_results, sample_latents = ranker.finish()
+                    self.num_autoregressive_samples_used = ranker.count
+                else:
+                    self.num_autoregressive_samples_used = sum([codes.shape[0] for codes in samples])
 
-            if self.unsqueeze_sample_batches:
-                new_samples = []
-                for batch in samples:
-                     for i in range(batch.shape[0]):
-                        new_samples.append(batch[i].unsqueeze(0))
-                samples = new_samples
+            if not self.preloaded_tensors:
+                self.release_model('autoregressive')
+                # The KV cache buffers are only worth keeping around while the model stays on the device.
+                self.autoregressive.inference_model.release_static_cache()
 
-            clip_results = []
             if auto_conds is not None:
-                auto_conditioning = migrate_to_device( auto_conditioning, self.device )
+                auto_conditioning = migrate_to_device( auto_conditioning, self.autoregressive_device )
 
-            with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
-                if not self.preloaded_tensors:
-                    self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
-                    self.clvp = migrate_to_device( self.clvp, self.device )
-
-                if cvvp_amount > 0:
-                    if self.cvvp is None:
-                        self.load_cvvp()
-                    
-                    if not self.preloaded_tensors:
-                        self.cvvp = migrate_to_device( self.cvvp, self.device )
-                
-                desc="Computing best candidates"
-                if verbose:
-                    if self.cvvp is None:
-                        desc = "Computing best candidates using CLVP"
-                    else:
-                        desc = f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
-
-                
-                for batch in tqdm(samples, desc=desc):
-                    check_for_kill_signal()
-                    for i in range(batch.shape[0]):
-                        batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-
-                    if cvvp_amount != 1:
-                        clvp = self.clvp(text_tokens.repeat(batch.shape[0], 1), batch, return_loss=False)
-                        
-                    if auto_conds is not None and cvvp_amount > 0:
-                        cvvp_accumulator = 0
-                        for cl in range(auto_conds.shape[1]):
-                            cvvp_accumulator = cvvp_accumulator + self.cvvp(auto_conds[:, cl].repeat(batch.shape[0], 1, 1), batch, return_loss=False)
-                        cvvp = cvvp_accumulator / auto_conds.shape[1]
-                        if cvvp_amount == 1:
-                            clip_results.append(cvvp)
-                        else:
-                            clip_results.append(cvvp * cvvp_amount + clvp * (1-cvvp_amount))
-                    else:
-                        clip_results.append(clvp)
+            if ranker is None:
+                with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=half_p):
+                    text_latents, cond_latents = self.prepare_candidate_ranking(text_tokens, auto_conds, cvvp_amount)
 
-            if not self.preloaded_tensors and auto_conds is not None:
-                auto_conds = migrate_to_device( auto_conds, 'cpu' )
-
-            clip_results = torch.cat(clip_results, dim=0)
-            samples = torch.cat(samples, dim=0)
-            if k < num_autoregressive_samples:
-                best_results = samples[torch.topk(clip_results, k=k).indices]
+                    desc="Computing best candidates"
+                    if verbose:
+                        if self.cvvp is None:
+                            desc = "Computing best candidates using CLVP"
+                        else:
+                            desc = f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
+
+                    clip_results = []
+                    for batch in tqdm(samples, desc=desc):
+                        check_for_kill_signal()
+                        fix_autoregressive_output_batch(batch, stop_mel_token)
+                        clip_results.append(self.score_candidates(batch, text_latents, cond_latents, cvvp_amount))
+
+                clip_results = torch.cat(clip_results, dim=0)
+                samples = torch.cat(samples, dim=0)
+                if k < num_autoregressive_samples:
+                    best_indices = torch.topk(clip_results, k=k).indices
+                    best_results = samples[best_indices]
+                else:
+                    best_indices = torch.arange(samples.shape[0])
+                    best_results = samples
             else:
-                best_results = samples
+                # the ranker hands back one cached latent per kept candidate, already in order
+                best_indices = torch.arange(best_results.shape[0])
             
             if not self.preloaded_tensors:
-                self.clvp = migrate_to_device( self.clvp, 'cpu' )
-                self.cvvp = migrate_to_device( self.cvvp, 'cpu' )
+                self.release_model('clvp')
+                self.release_model('cvvp')
             
 
             if get_device_name() == "dml":
                 text_tokens = migrate_to_device( text_tokens, 'cpu' )
                 best_results = migrate_to_device( best_results, 'cpu' )
                 auto_conditioning = migrate_to_device( auto_conditioning, 'cpu' )
-                self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
+                self.load_model('autoregressive', 'cpu')
             else:
-                auto_conditioning = auto_conditioning.to(self.device)
-                self.autoregressive = self.autoregressive.to(self.device)
+                auto_conditioning = auto_conditioning.to(self.autoregressive_device)
+                self.load_model('autoregressive')
+                # decoding comes next
+                self.prefetch_model('diffusion', 'vocoder')
 
             del samples
 
             # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
-            # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            best_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
-                                               torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
-                                               torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
-                                               return_latent=True, clip_inputs=False)
+            # inputs. Either pull those out of what was kept while sampling, or re-produce them for the top results.
+            if cache_autoregressive_latents:
+                best_latents = gather_autoregressive_latents(sample_latents, best_indices.tolist(), best_results.shape[-1], text_tokens.device)
+            else:
+                best_latents = self.autoregressive(auto_conditioning.repeat(k, 1), text_tokens.repeat(k, 1),
+                                                   torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), best_results,
+                                                   torch.tensor([best_results.shape[-1]*self.autoregressive.mel_length_compression], device=text_tokens.device),
+                                                   return_latent=True, clip_inputs=False)
+            del sample_latents
             
-            diffusion_conditioning = migrate_to_device( diffusion_conditioning, self.device )
+            if get_device_name() == "dml":
+                self.load_model('autoregressive', self.device)
+            elif not self.preloaded_tensors:
+                self.release_model('autoregressive')
+
+            return best_results, best_latents, diffusion_conditioning
+
+    @torch.inference_mode()
+    def decode_candidates(self, text, best_results, best_latents, diffusion_conditioning,
+            # diffusion generation parameters follow
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_sampler="P",
+            breathing_room=8,
+            batch_diffusion=True):
+        """
+        Second half of tts(): turns the candidates picked by sample_candidates() into (redacted) audio with the
+        diffusion model and the vocoder. Takes the same parameters as tts().
+        """
+        return self.decode_candidates_batch([(text, best_results, best_latents, diffusion_conditioning)],
+            diffusion_iterations=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k, diffusion_temperature=diffusion_temperature,
+            diffusion_sampler=diffusion_sampler, breathing_room=breathing_room, batch_diffusion=batch_diffusion)[0]
+
+    @torch.inference_mode()
+    def decode_candidates_batch(self, jobs,
+            # diffusion generation parameters follow
+            diffusion_iterations=100, cond_free=True, cond_free_k=2, diffusion_temperature=1.0,
+            diffusion_sampler="P",
+            breathing_room=8,
+            batch_diffusion=True):
+        """
+        decode_candidates() over a list of (text, best_results, best_latents, diffusion_conditioning) jobs, which may come
+        from different lines and voices. With batch_diffusion, the candidates of every job go through one diffusion pass
+        and one vocoder call.
+        :return: A list holding what decode_candidates() returns for each job.
+        """
+        diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=diffusion_iterations, cond_free=cond_free, cond_free_k=cond_free_k)
+        calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
 
+        with torch.no_grad():
             if get_device_name() == "dml":
-                self.autoregressive = migrate_to_device( self.autoregressive, self.device )
-                best_results = migrate_to_device( best_results, self.device )
-                best_latents = migrate_to_device( best_latents, self.device )
-                self.vocoder = migrate_to_device( self.vocoder, 'cpu' )
+                self.load_model('vocoder', 'cpu')
             else:
-                if not self.preloaded_tensors:
-                    self.autoregressive = migrate_to_device( self.autoregressive, 'cpu' )
-
-                self.diffusion = migrate_to_device( self.diffusion, self.device )
-                self.vocoder = migrate_to_device( self.vocoder, self.device )
-            
-            del text_tokens
-            del auto_conditioning
+                self.load_model('diffusion')
+                # the vocoder is only needed once the diffusion model is done
+                self.prefetch_model('vocoder')
+
+            # (job index, latents, latent length, diffusion conditioning) of every candidate
+            candidates = []
+            for i, (text, best_results, best_latents, diffusion_conditioning) in enumerate(jobs):
+                diffusion_conditioning = migrate_to_device( diffusion_conditioning, self.diffusion_device )
+                if get_device_name() == "dml":
+                    best_results = migrate_to_device( best_results, self.device )
+                    best_latents = migrate_to_device( best_latents, self.device )
+                else:
+                    best_latents = best_latents.to(self.diffusion_device)
+
+                # Trim each candidate where its run of "calm" tokens first outgrows the breathing room.
+                # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+                latent_lengths = find_calm_token_trim(best_results, calm_token, breathing_room, best_latents.shape[1]).tolist()
+                for b in range(best_results.shape[0]):
+                    candidates.append((i, best_latents[b], latent_lengths[b], diffusion_conditioning))
 
             wav_candidates = []
-            for b in range(best_results.shape[0]):
-                codes = best_results[b].unsqueeze(0)
-                latents = best_latents[b].unsqueeze(0)
-
-                # Find the first occurrence of the "calm" token and trim the codes to that.
-                ctokens = 0
-                for k in range(codes.shape[-1]):
-                    if codes[0, k] == calm_token:
-                        ctokens += 1
-                    else:
-                        ctokens = 0
-                    if ctokens > breathing_room:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                        latents = latents[:, :k]
-                        break
+            if batch_diffusion and len(candidates) > 1:
+                device = candidates[0][1].device
+                latent_lengths = torch.tensor([candidate[2] for candidate in candidates], device=device)
+                max_length = latent_lengths.max().item()
+                latents = torch.stack([F.pad(latents[:max_length], (0, 0, 0, max_length - latents[:max_length].shape[0])) for _, latents, _, _ in candidates])
+                # every candidate carries the conditioning of its own job
+                diffusion_conditioning = torch.cat([conditioning for _, _, _, conditioning in candidates], dim=0)
 
                 mel = do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning,
                                                temperature=diffusion_temperature, desc="Transforming autoregressive outputs into audio..", sampler=diffusion_sampler,
-                                               input_sample_rate=self.input_sample_rate, output_sample_rate=self.output_sample_rate)
-
-                wav = self.vocoder.inference(mel)
-                wav_candidates.append(wav)
-            
-            if not self.preloaded_tensors:
-                self.diffusion = migrate_to_device( self.diffusion, 'cpu' )
-                self.vocoder = migrate_to_device( self.vocoder, 'cpu' )
-
-            def potentially_redact(clip, text):
-                if self.enable_redaction:
-                    t = clip.squeeze(1)
-                    t = migrate_to_device( t, 'cpu' if get_device_name() == "dml" else self.device)
-                    return self.aligner.redact(t, text, self.output_sample_rate).unsqueeze(1)
-                return clip
-            wav_candidates = [potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates]
-
-            if len(wav_candidates) > 1:
-                res = wav_candidates
+                                               input_sample_rate=self.input_sample_rate, output_sample_rate=self.output_sample_rate,
+                                               latent_lengths=latent_lengths)
+
+                if get_device_name() != "dml":
+                    self.load_model('vocoder')
+                wavs = self.vocoder.inference(mel.to(self.vocoder_device) if get_device_name() != "dml" else mel)
+                mel_lengths = get_diffusion_output_length(latent_lengths, self.input_sample_rate, self.output_sample_rate)
+                for b in range(wavs.shape[0]):
+                    wav_candidates.append(wavs[b:b+1, :, :mel_lengths[b].item() * self.vocoder.hop_length])
             else:
-                res = wav_candidates[0]
+                for _, latents, latent_length, diffusion_conditioning in candidates:
+                    latents = latents[:latent_length].unsqueeze(0)
 
-            do_gc()
+                    mel = do_spectrogram_diffusion(self.diffusion, diffuser, latents, diffusion_conditioning,
+                                                   temperature=diffusion_temperature, desc="Transforming autoregressive outputs into audio..", sampler=diffusion_sampler,
+                                                   input_sample_rate=self.input_sample_rate, output_sample_rate=self.output_sample_rate)
 
-            if return_deterministic_state:
-                return res, (deterministic_seed, text, voice_samples, conditioning_latents)
-            else:
-                return res
+                    if get_device_name() != "dml":
+                        self.load_model('vocoder')
+                    wav = self.vocoder.inference(mel.to(self.vocoder_device) if get_device_name() != "dml" else mel)
+                    wav_candidates.append(wav)
+            
+            if not self.preloaded_tensors:
+                self.release_model('diffusion')
+                self.release_model('vocoder')
+
+            def potentially_redact(clips, text):
+                # lines without brackets never touch the aligner, and the candidates of a line are aligned together
+                if self.enable_redaction and '[' in text:
+                    clips = [ migrate_to_device( clip.squeeze(1), 'cpu' if get_device_name() == "dml" else self.vocoder_device) for clip in clips ]
+                    return [ clip.unsqueeze(1) for clip in self.aligner.redact_batch(clips, text, self.output_sample_rate) ]
+                return clips
+
+            results = [ [] for _ in jobs ]
+            for (i, _, _, _), wav_candidate in zip(candidates, wav_candidates):
+                results[i].append(wav_candidate)
+            results = [ potentially_redact(res, jobs[i][0]) for i, res in enumerate(results) ]
+
+            return [ res if len(res) > 1 else res[0] for res in results ]
 
     def deterministic_state(self, seed=None):
         """
@@ -19,8 +19,22 @@ def zero_module(module):
 
 
 class GroupNorm32(nn.GroupNorm):
-    def forward(self, x):
-        return super().forward(x.float()).type(x.dtype)
+    def forward(self, x, mask=None):
+        if mask is None:
+            return super().forward(x.float()).type(x.dtype)
+
+        # Only gather statistics over the valid positions, so a padded batch element normalizes the same way it would on its own.
+        h = x.float()
+        b, c, t = h.shape
+        h = h.reshape(b, self.num_groups, c // self.num_groups, t)
+        m = mask.float().view(b, 1, 1, t)
+        count = m.sum(dim=(2, 3), keepdim=True) * (c // self.num_groups)
+        mean = (h * m).sum(dim=(2, 3), keepdim=True) / count
+        var = (((h - mean) * m) ** 2).sum(dim=(2, 3), keepdim=True) / count
+        h = ((h - mean) / torch.sqrt(var + self.eps)).reshape(b, c, t)
+        if self.affine:
+            h = h * self.weight.view(1, -1, 1) + self.bias.view(1, -1, 1)
+        return h.type(x.dtype)
 
 
 def normalization(channels):
@@ -67,11 +81,12 @@ class QKVAttentionLegacy(nn.Module):
         )  # More stable with f16 than dividing afterwards
         if rel_pos is not None:
             weight = rel_pos(weight.reshape(bs, self.n_heads, weight.shape[-2], weight.shape[-1])).reshape(bs * self.n_heads, weight.shape[-2], weight.shape[-1])
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+        weight = weight.float()
         if mask is not None:
-            # The proper way to do this is to mask before the softmax using -inf, but that doesn't work properly on CPUs.
-            mask = mask.repeat(self.n_heads, 1).unsqueeze(1)
-            weight = weight * mask
+            # Mask out keys before the softmax. -inf doesn't work properly on CPUs, so use the smallest finite value instead.
+            mask = mask.bool().repeat_interleave(self.n_heads, dim=0).unsqueeze(1)
+            weight = weight.masked_fill(~mask, torch.finfo(weight.dtype).min)
+        weight = torch.softmax(weight, dim=-1).type(v.dtype)
         a = torch.einsum("bts,bcs->bct", weight, v)
 
         return a.reshape(bs, -1, length)
@@ -117,7 +132,7 @@ class AttentionBlock(nn.Module):
     def forward(self, x, mask=None):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
-        qkv = self.qkv(self.norm(x))
+        qkv = self.qkv(self.norm(x) if mask is None else self.norm(x, mask))
         h = self.attention(qkv, mask, self.relative_pos_embeddings)
         h = self.proj_out(h)
         return (x + h).reshape(b, c, *spatial)
@@ -329,6 +344,25 @@ class TorchMelSpectrogram(nn.Module):
         return mel
 
 
+# Mel front-ends are cheap to run but not to build (the filterbank and the norms file), so they are shared.
+_MEL_SPECTROGRAMS = {}
+
+
+def get_mel_spectrogram(sampling_rate=22050, device='cpu', dtype=torch.float32):
+    """
+    Returns the TorchMelSpectrogram for <sampling_rate>, built once per (sampling_rate, device, dtype) and kept on
+    that device.
+    """
+    device = torch.device(device)
+    key = (sampling_rate, str(device), dtype)
+    if key not in _MEL_SPECTROGRAMS:
+        mel = TorchMelSpectrogram(sampling_rate=sampling_rate).to(device=device, dtype=dtype)
+        if mel.mel_norms is not None:
+            mel.mel_norms = mel.mel_norms.to(device=device, dtype=dtype)
+        _MEL_SPECTROGRAMS[key] = mel
+    return _MEL_SPECTROGRAMS[key]
+
+
 class CheckpointedLayer(nn.Module):
     """
     Wraps a module. When forward() is called, passes kwargs that require_grad through torch.checkpoint() and bypasses
@@ -3,7 +3,8 @@ import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList
+from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList, RepetitionPenaltyLogitsProcessor, \
+    TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.utils.model_parallel_utils import get_device_map, assert_device_map
 from tortoise.models.arch_util import AttentionBlock
@@ -35,6 +36,98 @@ class ResBlock(nn.Module):
         return F.relu(self.net(x) + x)
 
 
+class StaticKVCache:
+    """
+    Pre-allocated key/value buffers for every layer of a GPT2Model. While in use, the attention layers write the keys and
+    values of the new positions into the buffers in place and attend over views of them, instead of growing
+    past_key_values with torch.cat at every token. The buffers are kept across batches and generate calls, and are only
+    reallocated for a larger batch, a longer sequence or another dtype/device.
+    """
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.keys = []
+        self.values = []
+        self.in_use = False
+
+    def attach(self, gpt):
+        for layer, block in enumerate(gpt.h):
+            block.attn.forward = functools.partial(self.attention_forward, block.attn, layer)
+
+    def release(self):
+        self.keys = []
+        self.values = []
+
+    def get_buffers(self, layer, like, length):
+        while len(self.keys) <= layer:
+            self.keys.append(None)
+            self.values.append(None)
+        keys = self.keys[layer]
+        batch_size, heads, _, head_dim = like.shape
+        if keys is None or keys.shape[0] < batch_size or keys.shape[2] < length or keys.dtype != like.dtype or keys.device != like.device:
+            self.keys[layer] = self.values[layer] = keys = None
+            shape = (batch_size, heads, max(self.max_length, length), head_dim)
+            self.keys[layer] = torch.empty(shape, dtype=like.dtype, device=like.device)
+            self.values[layer] = torch.empty(shape, dtype=like.dtype, device=like.device)
+        return self.keys[layer], self.values[layer]
+
+    def reorder(self, past, rows):
+        """
+        Keeps only <rows> of the batch (in that order), moving them to the front of the buffers in place.
+        """
+        return tuple(
+            tuple(self.move_rows(past_state, rows) for past_state in layer_past)
+            for layer_past in past
+        )
+
+    @staticmethod
+    def move_rows(past_state, rows):
+        kept = past_state.index_select(0, rows.to(past_state.device))
+        past_state[:kept.shape[0]] = kept
+        return past_state[:kept.shape[0]]
+
+    def attention_forward(self, attn, layer, hidden_states, layer_past=None, attention_mask=None, head_mask=None,
+                          encoder_hidden_states=None, encoder_attention_mask=None, use_cache=False, output_attentions=False):
+        """
+        GPT2Attention.forward(), with the past keys and values kept in this cache rather than concatenated.
+        """
+        if not self.in_use or not use_cache or encoder_hidden_states is not None:
+            return type(attn).forward(attn, hidden_states, layer_past=layer_past, attention_mask=attention_mask, head_mask=head_mask,
+                                      encoder_hidden_states=encoder_hidden_states, encoder_attention_mask=encoder_attention_mask,
+                                      use_cache=use_cache, output_attentions=output_attentions)
+
+        query, key, value = attn.c_attn(hidden_states).split(attn.split_size, dim=2)
+        query = attn._split_heads(query, attn.num_heads, attn.head_dim)
+        key = attn._split_heads(key, attn.num_heads, attn.head_dim)
+        value = attn._split_heads(value, attn.num_heads, attn.head_dim)
+
+        batch_size = key.shape[0]
+        start = 0 if layer_past is None else layer_past[0].shape[-2]
+        end = start + key.shape[-2]
+        keys, values = self.get_buffers(layer, key, end)
+        if layer_past is not None and layer_past[0].data_ptr() != keys.data_ptr():
+            # The past lives elsewhere (the buffers were just reallocated, or something like beam search reordered it).
+            keys[:batch_size, :, :start] = layer_past[0]
+            values[:batch_size, :, :start] = layer_past[1]
+        keys[:batch_size, :, start:end] = key
+        values[:batch_size, :, start:end] = value
+        key = keys[:batch_size, :, :end]
+        value = values[:batch_size, :, :end]
+
+        if attn.reorder_and_upcast_attn:
+            attn_output, attn_weights = attn._upcast_and_reordered_attn(query, key, value, attention_mask, head_mask)
+        else:
+            attn_output, attn_weights = attn._attn(query, key, value, attention_mask, head_mask)
+
+        attn_output = attn._merge_heads(attn_output, attn.num_heads, attn.head_dim)
+        attn_output = attn.c_proj(attn_output)
+        attn_output = attn.resid_dropout(attn_output)
+
+        outputs = (attn_output, (key, value))
+        if output_attentions:
+            outputs += (attn_weights,)
+        return outputs
+
+
 class GPT2InferenceModel(GPT2PreTrainedModel):
     def __init__(self, config, gpt, text_pos_emb, embeddings, norm, linear, kv_cache):
         super().__init__(config)
@@ -44,11 +137,14 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.lm_head = nn.Sequential(norm, linear)
 
         self.kv_cache = kv_cache
+        self.static_cache = None
 
         # Model parallel
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        self.cached_latents = None
+        self.latent_start = None
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -57,13 +153,27 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             else device_map
         )
         assert_device_map(self.device_map, len(self.transformer.h))
-        self.transformer.parallelize(self.device_map)
-        self.lm_head = self.lm_head.to(self.transformer.first_device)
+        # GPT2Model.parallelize() can't be used, as it moves wte and wpe, which UnifiedVoice replaces or removes. The
+        # layers are placed the same way, so GPT2Model.forward() still hands the hidden states from device to device.
+        transformer = self.transformer
+        transformer.device_map = self.device_map
+        transformer.first_device = "cuda:" + str(min(self.device_map.keys()))
+        transformer.last_device = "cuda:" + str(max(self.device_map.keys()))
+        for k, v in self.device_map.items():
+            for block in v:
+                transformer.h[block] = transformer.h[block].to("cuda:" + str(k))
+        transformer.ln_f = transformer.ln_f.to(transformer.last_device)
+        transformer.model_parallel = True
+        self.lm_head = self.lm_head.to(transformer.first_device)
         self.model_parallel = True
 
     def deparallelize(self):
-        self.transformer.deparallelize()
-        self.transformer = self.transformer.to("cpu")
+        transformer = self.transformer
+        transformer.model_parallel = False
+        transformer.device_map = None
+        transformer.first_device = "cpu"
+        transformer.last_device = "cpu"
+        self.transformer = transformer.to("cpu")
         self.lm_head = self.lm_head.to("cpu")
         self.model_parallel = False
         torch.cuda.empty_cache()
@@ -74,9 +184,37 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.lm_head = new_embeddings
 
+    def use_static_cache(self, max_length):
+        """
+        Keeps the KV cache in buffers of <max_length> positions that are written in place and reused by every generate call,
+        instead of letting past_key_values grow a token at a time.
+        """
+        self.static_cache = StaticKVCache(max_length)
+        self.static_cache.attach(self.transformer)
+
+    def release_static_cache(self):
+        if self.static_cache is not None:
+            self.static_cache.release()
+
     def store_mel_emb(self, mel_emb):
         self.cached_mel_emb = mel_emb
 
+    def store_latents(self, start=None):
+        """
+        Starts keeping the normalized final hidden state of every position from <start> onwards, which is what
+        UnifiedVoice.forward(return_latent=True) produces for the same codes. Passing None stops keeping them.
+        """
+        self.latent_start = start
+        self.cached_latents = [] if start is not None else None
+
+    def fetch_latents(self):
+        """
+        Returns the latents kept since store_latents() as a (b,s,d) tensor and stops keeping them.
+        """
+        latents = torch.cat(self.cached_latents, dim=1)
+        self.store_latents(None)
+        return latents
+
     def prepare_inputs_for_generation(self, input_ids, past=None, **kwargs):
 
         token_type_ids = kwargs.get("token_type_ids", None)
@@ -144,28 +282,40 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             emb = self.embeddings(input_ids)
             emb = emb + self.text_pos_embedding.get_fixed_embedding(attention_mask.shape[1]-mel_len, attention_mask.device)
 
-        transformer_outputs = self.transformer(
-            inputs_embeds=emb,
-            past_key_values=past_key_values,
-            attention_mask=attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=encoder_attention_mask,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        if self.static_cache is not None:
+            self.static_cache.in_use = self.kv_cache
+        try:
+            transformer_outputs = self.transformer(
+                inputs_embeds=emb,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_attention_mask,
+                use_cache=use_cache,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+                return_dict=return_dict,
+            )
+        finally:
+            if self.static_cache is not None:
+                self.static_cache.in_use = False
         hidden_states = transformer_outputs[0]
 
         # Set device for model parallelism
         if self.model_parallel:
             torch.cuda.set_device(self.transformer.first_device)
-            hidden_states = hidden_states.to(self.lm_head.weight.device)
+            hidden_states = hidden_states.to(self.transformer.first_device)
 
-        lm_logits = self.lm_head(hidden_states)
+        if self.cached_latents is not None:
+            latents = self.lm_head[0](hidden_states)
+            # The first pass covers the whole prompt, every following pass (with or without the KV cache) only adds the last position.
+            self.cached_latents.append(latents[:, self.latent_start:] if len(self.cached_latents) == 0 else latents[:, -1:])
+            lm_logits = self.lm_head[1](latents)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -191,6 +341,95 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             for layer_past in past
         )
 
+    def sample(self, inputs, max_length, stop_token, num_return_sequences=1, logits_processor=None,
+               temperature=1.0, top_k=50, top_p=1.0, repetition_penalty=1.0, do_sample=True, **unused_generate_kwargs):
+        """
+        Multinomial sampling, as done by generate(do_sample=True, eos_token_id=stop_token, pad_token_id=stop_token), except
+        that a sequence leaves the batch as soon as it samples <stop_token>: its rows are dropped from the inputs and the
+        KV cache, so every following pass only runs over the sequences that are still speaking.
+        The remaining generate() arguments (length_penalty, ...) have no effect on sampling and are ignored.
+        :return: (b*num_return_sequences,s) tensor of the prompts followed by the sampled codes, padded with <stop_token>.
+        """
+        assert do_sample, "Only sampling is supported by the early exit loop, use generate() instead."
+        processors = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if logits_processor is not None:
+            processors.extend(logits_processor)
+        if temperature != 1.0:
+            processors.append(TemperatureLogitsWarper(temperature))
+        if top_k is not None and top_k != 0:
+            processors.append(TopKLogitsWarper(top_k=top_k))
+        if top_p < 1.0:
+            processors.append(TopPLogitsWarper(top_p=top_p))
+
+        input_ids = inputs.repeat_interleave(num_return_sequences, dim=0)
+        batch_size, prompt_length = input_ids.shape
+        generated = torch.full((batch_size, max(max_length - prompt_length, 0)), fill_value=stop_token, dtype=torch.long, device=input_ids.device)
+        lengths = torch.full((batch_size,), fill_value=generated.shape[1], dtype=torch.long, device=input_ids.device)
+        active = torch.arange(batch_size, device=input_ids.device)
+        active_rows = []
+
+        # Give every row its own copy of the conditioning, so it can be compacted along with the inputs when re-embedding the whole sequence.
+        mel_emb = self.cached_mel_emb
+        if mel_emb.shape[0] != batch_size:
+            self.cached_mel_emb = mel_emb.repeat_interleave(batch_size // mel_emb.shape[0], 0)
+
+        past = None
+        step = 0
+        try:
+            while step < generated.shape[1]:
+                active_rows.append(active)
+                outputs = self(input_ids if past is None else input_ids[:, -1:],
+                               past_key_values=past,
+                               attention_mask=torch.ones_like(input_ids),
+                               use_cache=self.kv_cache,
+                               return_dict=True)
+                scores = processors(input_ids, outputs.logits[:, -1, :])
+                next_tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+
+                generated[active, step] = next_tokens
+                input_ids = torch.cat([input_ids, next_tokens.unsqueeze(1)], dim=-1)
+                past = outputs.past_key_values if self.kv_cache else None
+                step += 1
+
+                finished = next_tokens == stop_token
+                if not finished.any():
+                    continue
+                lengths[active[finished]] = step
+                keep = (~finished).nonzero().squeeze(1)
+                if keep.shape[0] == 0:
+                    break
+                active = active[keep]
+                input_ids = input_ids[keep]
+                self.cached_mel_emb = self.cached_mel_emb[keep]
+                if past is not None:
+                    past = self._reorder_cache(past, keep) if self.static_cache is None else self.static_cache.reorder(past, keep)
+        finally:
+            self.cached_mel_emb = mel_emb
+
+        if self.cached_latents is not None and len(self.cached_latents) > 0:
+            self.cached_latents = [self._scatter_latents(self.cached_latents, active_rows, batch_size, lengths.clamp(max=step))]
+        return torch.cat([inputs.repeat_interleave(num_return_sequences, dim=0), generated[:, :step]], dim=1)
+
+    @staticmethod
+    def _scatter_latents(latents, active_rows, batch_size, lengths):
+        """
+        Puts the latents kept by each pass of sample() back into the rows they came from. A finished sequence repeats the
+        latent of its stop token from there on, standing in for the latents of the padding it no longer computes.
+        """
+        first = latents[0]
+        prompt_latents = first.shape[1]
+        out = first.new_zeros((batch_size, prompt_latents + len(latents) - 1, first.shape[-1]))
+        out[:, :prompt_latents] = first
+        for i, (rows, latent) in enumerate(zip(active_rows[1:], latents[1:])):
+            out[rows, prompt_latents + i] = latent[:, 0]
+
+        last = (prompt_latents - 2 + lengths).clamp(min=0)
+        positions = torch.arange(out.shape[1], device=out.device).unsqueeze(0)
+        index = torch.minimum(positions, last.unsqueeze(1))
+        return out.gather(1, index.unsqueeze(-1).expand(-1, -1, out.shape[-1]))
+
 
 class ConditioningEncoder(nn.Module):
     def __init__(self,
@@ -375,6 +614,8 @@ class UnifiedVoice(nn.Module):
             self.inference_model = self.ds_engine.module.eval()
         else:
             self.inference_model = self.inference_model.eval()
+            if kv_cache:
+                self.inference_model.use_static_cache(self.max_conditioning_inputs + seq_length)
             
         self.gpt.wte = self.mel_embedding
 
@@ -495,7 +736,14 @@ class UnifiedVoice(nn.Module):
         return loss_text.mean(), loss_mel.mean(), mel_logits
 
     def inference_speech(self, speech_conditioning_latent, text_inputs, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latent=False, early_exit=False,
+                         **hf_generate_kwargs):
+        """
+        If return_latent is specified, the latents of the sampled codes (as returned by forward(return_latent=True)) are
+        kept while sampling and returned alongside the codes, so they do not need to be recomputed afterwards.
+        If early_exit is specified, sampling goes through GPT2InferenceModel.sample(), which stops computing each sequence
+        once it has produced its stop token instead of running the whole batch until the longest one is done.
+        """
         seq_length = self.max_mel_tokens + self.max_text_tokens + self.max_prompt_tokens
         if not hasattr(self, 'inference_model'):
             self.post_init_gpt2_config(kv_cache=self.kv_cache)
@@ -523,9 +771,21 @@ class UnifiedVoice(nn.Module):
 
         logits_processor = LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)]) if typical_sampling else LogitsProcessorList()
         max_length = trunc_index + self.max_mel_tokens - 1  if max_generate_length is None else trunc_index + max_generate_length
-        gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+        if return_latent:
+            # The latent for a code is the hidden state of the position before it.
+            self.inference_model.store_latents(start=trunc_index - 1)
+        try:
+            if early_exit:
+                gen = self.inference_model.sample(inputs, max_length=max_length, stop_token=self.stop_mel_token, logits_processor=logits_processor,
+                                                  num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+            else:
+                gen = self.inference_model.generate(inputs, bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token, eos_token_id=self.stop_mel_token,
+                                                    max_length=max_length, logits_processor=logits_processor,
+                                                    num_return_sequences=num_return_sequences, **hf_generate_kwargs)
+            if return_latent:
+                return gen[:, trunc_index:], self.inference_model.fetch_latents()
+        finally:
+            self.inference_model.store_latents(None)
         return gen[:, trunc_index:]
 
 
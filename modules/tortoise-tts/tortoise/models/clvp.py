@@ -9,7 +9,7 @@ from tortoise.models.xtransformers import Encoder
 
 import tortoise.utils.torch_intermediary as ml
 
-from tortoise.utils.device import print_stats, do_gc
+from tortoise.utils.device import print_stats
 
 def exists(val):
     return val is not None
@@ -105,49 +105,64 @@ class CLVP(nn.Module):
             # nn.Embedding
             self.speech_pos_emb = ml.Embedding(num_speech_tokens, dim_speech)
 
-    def forward(
-            self,
-            text,
-            speech_tokens,
-            return_loss=False
-    ):
-        b, device = text.shape[0], text.device
+    def encode_text(self, text):
+        """
+        Encode a batch of text tokens into normalized [N x dim_latent] text latents.
+        """
         if self.training:
             text_mask = torch.rand_like(text.float()) > self.text_mask_percentage
-            voice_mask = torch.rand_like(speech_tokens.float()) > self.voice_mask_percentage
         else:
             text_mask = torch.ones_like(text.float()).bool()
-            voice_mask = torch.ones_like(speech_tokens.float()).bool()
 
         text_emb = self.text_emb(text)
-        speech_emb = self.speech_emb(speech_tokens)
-
         if not self.xformers:
-            text_emb += self.text_pos_emb(torch.arange(text.shape[1], device=device))
-            speech_emb += self.speech_pos_emb(torch.arange(speech_emb.shape[1], device=device))
+            text_emb += self.text_pos_emb(torch.arange(text.shape[1], device=text.device))
 
-        
         text_latents = self.to_text_latent(masked_mean(self.text_transformer(text_emb, mask=text_mask), text_mask, dim=1))
+        return F.normalize(text_latents, p=2, dim=-1)
+
+    def encode_speech(self, speech_tokens):
+        """
+        Encode a batch of speech tokens into normalized [N x dim_latent] speech latents.
+        """
+        if self.training:
+            voice_mask = torch.rand_like(speech_tokens.float()) > self.voice_mask_percentage
+        else:
+            voice_mask = torch.ones_like(speech_tokens.float()).bool()
+
+        speech_emb = self.speech_emb(speech_tokens)
+        if not self.xformers:
+            speech_emb += self.speech_pos_emb(torch.arange(speech_emb.shape[1], device=speech_tokens.device))
 
-        # on ROCm at least, allocated VRAM spikes here
-        do_gc()
         speech_latents = self.to_speech_latent(masked_mean(self.speech_transformer(speech_emb, mask=voice_mask), voice_mask, dim=1))
-        do_gc()
+        return F.normalize(speech_latents, p=2, dim=-1)
 
-        text_latents, speech_latents = map(lambda t: F.normalize(t, p=2, dim=-1), (text_latents, speech_latents))
+    def similarity(self, text_latents, speech_latents):
+        """
+        Score latents from encode_text() against latents from encode_speech(). Either side may be a single row,
+        which is broadcast against the other, so a text only has to be encoded once to rank many speech candidates.
+        """
+        return (text_latents * speech_latents).sum(dim=-1) * self.temperature.exp()
 
-        temp = self.temperature.exp()
+    def forward(
+            self,
+            text,
+            speech_tokens,
+            return_loss=False
+    ):
+        b, device = text.shape[0], text.device
+        text_latents = self.encode_text(text)
+        speech_latents = self.encode_speech(speech_tokens)
 
         if not return_loss:
-            sim = einsum('n d, n d -> n', text_latents, speech_latents) * temp
-            return sim
+            return self.similarity(text_latents, speech_latents)
 
+        temp = self.temperature.exp()
         sim = einsum('i d, j d -> i j', text_latents, speech_latents) * temp
         labels = torch.arange(b, device=device)
         loss = (F.cross_entropy(sim, labels) + F.cross_entropy(sim.t(), labels)) / 2
         return loss
 
-
 if __name__ == '__main__':
     clip = CLVP(text_mask_percentage=.2, voice_mask_percentage=.2)
     clip(torch.randint(0,256,(2,120)),
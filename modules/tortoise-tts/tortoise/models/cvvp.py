@@ -106,29 +106,42 @@ class CVVP(nn.Module):
             'speech': list(self.speech_transformer.parameters()),
         }
 
-    def forward(
-            self,
-            mel_cond,
-            mel_input,
-            return_loss=False
-    ):
+    def encode_conditioning(self, mel_cond):
+        """
+        Encode a batch of conditioning clips into normalized [N x latent_dim] conditioning latents.
+        """
         cond_emb = self.cond_emb(mel_cond).permute(0, 2, 1)
         enc_cond = self.conditioning_transformer(cond_emb)
-        cond_latents = self.to_conditioning_latent(enc_cond)
+        return F.normalize(self.to_conditioning_latent(enc_cond), p=2, dim=-1)
 
+    def encode_speech(self, mel_input):
+        """
+        Encode a batch of speech inputs into normalized [N x latent_dim] speech latents.
+        """
         speech_emb = self.speech_emb(mel_input).permute(0, 2, 1)
         enc_speech = self.speech_transformer(speech_emb)
-        speech_latents = self.to_speech_latent(enc_speech)
+        return F.normalize(self.to_speech_latent(enc_speech), p=2, dim=-1)
 
-        cond_latents, speech_latents = map(lambda t: F.normalize(
-            t, p=2, dim=-1), (cond_latents, speech_latents))
-        temp = self.temperature.exp()
+    def similarity(self, cond_latents, speech_latents):
+        """
+        Score latents from encode_conditioning() against latents from encode_speech(). Either side may be a single
+        row, which is broadcast against the other.
+        """
+        return (cond_latents * speech_latents).sum(dim=-1) * self.temperature.exp()
+
+    def forward(
+            self,
+            mel_cond,
+            mel_input,
+            return_loss=False
+    ):
+        cond_latents = self.encode_conditioning(mel_cond)
+        speech_latents = self.encode_speech(mel_input)
 
         if not return_loss:
-            sim = einsum('n d, n d -> n', cond_latents,
-                         speech_latents) * temp
-            return sim
+            return self.similarity(cond_latents, speech_latents)
 
+        temp = self.temperature.exp()
         sim = einsum('i d, j d -> i j', cond_latents,
                      speech_latents) * temp
         labels = torch.arange(
@@ -138,7 +151,6 @@ class CVVP(nn.Module):
 
         return loss
 
-
 if __name__ == '__main__':
     clvp = CVVP()
     clvp(torch.randn(2, 80, 100),
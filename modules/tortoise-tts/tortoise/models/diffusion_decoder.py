@@ -50,10 +50,10 @@ class TimestepBlock(nn.Module):
 
 
 class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
-    def forward(self, x, emb):
+    def forward(self, x, emb, mask=None):
         for layer in self:
             if isinstance(layer, TimestepBlock):
-                x = layer(x, emb)
+                x = layer(x, emb, mask=mask)
             else:
                 x = layer(x)
         return x
@@ -107,19 +107,25 @@ class ResBlock(TimestepBlock):
         else:
             self.skip_connection = nn.Conv1d(channels, self.out_channels, eff_kernel, padding=eff_padding)
 
-    def forward(self, x, emb):
-        h = self.in_layers(x)
+    def forward(self, x, emb, mask=None):
+        if mask is None:
+            h = self.in_layers(x)
+        else:
+            h = self.in_layers[1:](self.in_layers[0](x, mask))
         emb_out = self.emb_layers(emb).type(h.dtype)
         while len(emb_out.shape) < len(h.shape):
             emb_out = emb_out[..., None]
+        out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
         if self.use_scale_shift_norm:
-            out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
             scale, shift = torch.chunk(emb_out, 2, dim=1)
-            h = out_norm(h) * (1 + scale) + shift
-            h = out_rest(h)
+            h = (out_norm(h) if mask is None else out_norm(h, mask)) * (1 + scale) + shift
         else:
             h = h + emb_out
-            h = self.out_layers(h)
+            h = out_norm(h) if mask is None else out_norm(h, mask)
+        if mask is not None:
+            # Zero the padding so the output convolution only sees valid positions.
+            h = h * mask.unsqueeze(1).type(h.dtype)
+        h = out_rest(h)
         return self.skip_connection(x) + h
 
 
@@ -129,9 +135,9 @@ class DiffusionLayer(TimestepBlock):
         self.resblk = ResBlock(model_channels, model_channels, dropout, model_channels, dims=1, use_scale_shift_norm=True)
         self.attn = AttentionBlock(model_channels, num_heads, relative_pos_embeddings=True)
 
-    def forward(self, x, time_emb):
-        y = self.resblk(x, time_emb)
-        return self.attn(y)
+    def forward(self, x, time_emb, mask=None):
+        y = self.resblk(x, time_emb, mask=mask)
+        return self.attn(y, mask)
 
 
 class DiffusionTts(nn.Module):
@@ -235,18 +241,39 @@ class DiffusionTts(nn.Module):
         conds = conds.mean(dim=-1)
         return conds
 
-    def timestep_independent(self, aligned_conditioning, conditioning_latent, expected_seq_len, return_code_pred):
+    def timestep_independent(self, aligned_conditioning, conditioning_latent, expected_seq_len, return_code_pred, aligned_lengths=None, expected_lengths=None):
+        """
+        When aligned_lengths (the valid length of each padded aligned_conditioning row) and expected_lengths (the valid
+        output length of each row) are given, padding is masked out so every row is embedded as it would be on its own.
+        """
         # Shuffle aligned_latent to BxCxS format
         if is_latent(aligned_conditioning):
             aligned_conditioning = aligned_conditioning.permute(0, 2, 1)
 
+        mask = None
+        if aligned_lengths is not None:
+            mask = torch.arange(aligned_conditioning.shape[-1], device=aligned_conditioning.device).unsqueeze(0) < aligned_lengths.unsqueeze(1)
+
         cond_scale, cond_shift = torch.chunk(conditioning_latent, 2, dim=1)
         if is_latent(aligned_conditioning):
-            code_emb = self.latent_conditioner(aligned_conditioning)
+            if mask is None:
+                code_emb = self.latent_conditioner(aligned_conditioning)
+            else:
+                code_emb = aligned_conditioning
+                for layer in self.latent_conditioner:
+                    if isinstance(layer, AttentionBlock):
+                        code_emb = layer(code_emb, mask)
+                    else:
+                        code_emb = layer(code_emb * mask.unsqueeze(1).type(code_emb.dtype))
         else:
             code_emb = self.code_embedding(aligned_conditioning).permute(0, 2, 1)
-            code_emb = self.code_converter(code_emb)
-        code_emb = self.code_norm(code_emb) * (1 + cond_scale.unsqueeze(-1)) + cond_shift.unsqueeze(-1)
+            if mask is None:
+                code_emb = self.code_converter(code_emb)
+            else:
+                for layer in self.code_converter:
+                    code_emb = layer(code_emb, mask)
+        code_emb = self.code_norm(code_emb) if mask is None else self.code_norm(code_emb, mask)
+        code_emb = code_emb * (1 + cond_scale.unsqueeze(-1)) + cond_shift.unsqueeze(-1)
 
         unconditioned_batches = torch.zeros((code_emb.shape[0], 1, 1), device=code_emb.device)
         # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
@@ -255,7 +282,14 @@ class DiffusionTts(nn.Module):
                                                device=code_emb.device) < self.unconditioned_percentage
             code_emb = torch.where(unconditioned_batches, self.unconditioned_embedding.repeat(aligned_conditioning.shape[0], 1, 1),
                                    code_emb)
-        expanded_code_emb = F.interpolate(code_emb, size=expected_seq_len, mode='nearest')
+        if mask is None:
+            expanded_code_emb = F.interpolate(code_emb, size=expected_seq_len, mode='nearest')
+        else:
+            # Stretch each row from its own valid length, otherwise the nearest-neighbor mapping drifts by the padding ratio.
+            expanded_code_emb = torch.zeros((code_emb.shape[0], code_emb.shape[1], expected_seq_len), dtype=code_emb.dtype, device=code_emb.device)
+            for i in range(code_emb.shape[0]):
+                length, expected_length = int(aligned_lengths[i]), int(expected_lengths[i])
+                expanded_code_emb[i:i+1, :, :expected_length] = F.interpolate(code_emb[i:i+1, :, :length], size=expected_length, mode='nearest')
 
         if not return_code_pred:
             return expanded_code_emb
@@ -265,7 +299,7 @@ class DiffusionTts(nn.Module):
             mel_pred = mel_pred * unconditioned_batches.logical_not()
             return expanded_code_emb, mel_pred
 
-    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False):
+    def forward(self, x, timesteps, aligned_conditioning=None, conditioning_latent=None, precomputed_aligned_embeddings=None, conditioning_free=False, return_code_pred=False, mask=None):
         """
         Apply the model to an input batch.
 
@@ -275,12 +309,18 @@ class DiffusionTts(nn.Module):
         :param conditioning_latent: a pre-computed conditioning latent; see get_conditioning().
         :param precomputed_aligned_embeddings: Embeddings returned from self.timestep_independent()
         :param conditioning_free: When set, all conditioning inputs (including tokens and conditioning_input) will not be considered.
+                                  May also be an [N] boolean Tensor, in which case only the flagged batch elements are unconditioned.
+        :param mask: an optional [N x ...] boolean Tensor marking the valid positions of each padded batch element.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert precomputed_aligned_embeddings is not None or (aligned_conditioning is not None and conditioning_latent is not None)
         assert not (return_code_pred and precomputed_aligned_embeddings is not None)  # These two are mutually exclusive.
 
         unused_params = []
+        row_conditioning_free = None
+        if torch.is_tensor(conditioning_free):
+            row_conditioning_free = conditioning_free.to(device=x.device, dtype=torch.bool)
+            conditioning_free = False
         if conditioning_free:
             code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
@@ -297,8 +337,17 @@ class DiffusionTts(nn.Module):
 
             unused_params.append(self.unconditioned_embedding)
 
+        if row_conditioning_free is not None:
+            unconditioned = self.unconditioned_embedding.to(code_emb.dtype).expand(code_emb.shape[0], -1, code_emb.shape[-1])
+            code_emb = torch.where(row_conditioning_free.view(-1, 1, 1), unconditioned, code_emb)
+
+        if mask is not None:
+            m = mask.unsqueeze(1).type(x.dtype)
+            x = x * m
+            code_emb = code_emb * m.type(code_emb.dtype)
+
         time_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels))
-        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb)
+        code_emb = self.conditioning_timestep_integrator(code_emb, time_emb, mask=mask)
         x = self.inp_block(x)
         x = torch.cat([x, code_emb], dim=1)
         x = self.integrating_conv(x)
@@ -310,10 +359,13 @@ class DiffusionTts(nn.Module):
                 # First and last blocks will have autocast disabled for improved precision.
                 # x.device.type
                 with autocast(device_type='cuda', enabled=self.enable_fp16 and i != 0):
-                    x = lyr(x, time_emb)
+                    x = lyr(x, time_emb, mask=mask)
 
         x = x.float()
-        out = self.out(x)
+        if mask is None:
+            out = self.out(x)
+        else:
+            out = self.out[1:](self.out[0](x, mask) * mask.unsqueeze(1).type(x.dtype))
 
         # Involve probabilistic or possibly unused parameters in loss so we don't get DDP errors.
         extraneous_addition = 0
@@ -1,4 +1,7 @@
 import os
+import json
+import stat
+import threading
 from glob import glob
 
 import librosa
@@ -81,69 +84,210 @@ def dynamic_range_decompression(x, C=1):
     return torch.exp(x) / C
 
 
-def get_voices(extra_voice_dirs=[], load_latents=True):
-    dirs = [get_voice_dir()] + extra_voice_dirs
-    voices = {}
-    for d in dirs:
-        subs = os.listdir(d)
-        for sub in subs:
-            subj = os.path.join(d, sub)
-            if os.path.isdir(subj):
-                voices[sub] = list(glob(f'{subj}/*.wav')) + list(glob(f'{subj}/*.mp3')) + list(glob(f'{subj}/*.flac'))
-                if load_latents:
-                    voices[sub] = voices[sub] + list(glob(f'{subj}/*.pth'))
-    return voices
+class VoiceIndex:
+    """
+    Index of a voices directory: for every voice, its files with their mtimes, sizes and (lazily) durations, and the
+    latent files it holds for each model hash. A folder is only listed again when its mtime changes, so resolving one
+    voice costs a couple of stats instead of walking every voice. The index of the main voice directory is kept on disk,
+    so a restart does not rescan it either.
+    """
+    AUDIO_EXTENSIONS = ["wav", "mp3", "flac"]
+    DEFAULTS = ["random", "microphone"]
+
+    def __init__(self, dir, path=None):
+        self.dir = dir
+        self.path = path
+        self.root = None
+        self.folders = {}
+        self.dirty = False
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                data = json.load(f)
+            self.root = data['root']
+            self.folders = data['folders']
+        except Exception as e:
+            print(f"Rebuilding voice index, failed to read {self.path}: {e}")
+            self.root = None
+            self.folders = {}
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        # Written in place rather than through a rename, so saving does not touch the mtime of the directory it indexes.
+        with open(self.path, 'w', encoding="utf-8") as f:
+            json.dump({ 'root': self.root, 'folders': self.folders }, f)
+        self.dirty = False
+
+    def scan_folder(self, name):
+        path = f'{self.dir}/{name}'
+        try:
+            folder_stat = os.stat(path)
+        except OSError:
+            folder_stat = None
+        if folder_stat is None or not stat.S_ISDIR(folder_stat.st_mode):
+            if self.folders.pop(name, None) is not None:
+                self.dirty = True
+            return None
+
+        entry = self.folders.get(name)
+        if entry is not None and entry['mtime'] == folder_stat.st_mtime_ns:
+            return entry
+
+        old_files = entry['files'] if entry is not None else {}
+        files = {}
+        subdirs = []
+        with os.scandir(path) as it:
+            for file in it:
+                if file.is_dir():
+                    subdirs.append(file.name)
+                    continue
+                file_stat = file.stat()
+                files[file.name] = self.file_entry(file_stat, old_files.get(file.name))
+
+        entry = { 'mtime': folder_stat.st_mtime_ns, 'files': files, 'subdirs': sorted(subdirs) }
+        self.folders[name] = entry
+        self.dirty = True
+        return entry
+
+    @staticmethod
+    def file_entry(file_stat, old=None):
+        # the duration is only carried over while the file is unchanged
+        duration = None
+        if old is not None and old['mtime'] == file_stat.st_mtime_ns and old['size'] == file_stat.st_size:
+            duration = old['duration']
+        return { 'mtime': file_stat.st_mtime_ns, 'size': file_stat.st_size, 'duration': duration }
+
+    def validate_files(self, name, entry):
+        # folder mtimes do not change when a file is rewritten in place, so the files themselves are checked as well
+        for filename in list(entry['files']):
+            old = entry['files'][filename]
+            try:
+                file_stat = os.stat(f'{self.dir}/{name}/{filename}')
+            except OSError:
+                del entry['files'][filename]
+                self.dirty = True
+                continue
+            if old['mtime'] != file_stat.st_mtime_ns or old['size'] != file_stat.st_size:
+                entry['files'][filename] = self.file_entry(file_stat)
+                self.dirty = True
+
+    @staticmethod
+    def has_extension(filename, extensions):
+        return os.path.splitext(filename)[-1][1:] in extensions
+
+    def get_entries(self, name, extensions, validate=False):
+        """
+        Returns { path: file entry } for the files of voice <name> with one of <extensions>, or None if there is no such voice.
+        """
+        with self.lock:
+            entry = self.scan_folder(name)
+            if entry is None:
+                return None
+            if validate:
+                self.validate_files(name, entry)
+            res = { f'{self.dir}/{name}/{filename}': file for filename, file in sorted(entry['files'].items()) if self.has_extension(filename, extensions) }
+            self.save()
+        return res
+
+    def get_files(self, name, extensions, validate=False):
+        entries = self.get_entries(name, extensions, validate=validate)
+        return None if entries is None else list(entries.keys())
+
+    def get_latents(self, name):
+        """
+        Returns { model hash: path } of the latent files of voice <name>, the hash being None for a plain cond_latents.pth.
+        """
+        latents = {}
+        for path in self.get_files(name, ["pth"]) or []:
+            filename = os.path.basename(path)
+            if filename == "cond_latents.pth":
+                latents[None] = path
+            elif filename[:13] == "cond_latents_":
+                latents[filename[13:-4]] = path
+        return latents
+
+    def get_durations(self, name, extensions=AUDIO_EXTENSIONS):
+        """
+        Returns { path: duration in seconds } for the audio files of voice <name>, reading the durations it has not seen yet.
+        """
+        with self.lock:
+            entries = self.get_entries(name, extensions, validate=True) or {}
+            for path, file in entries.items():
+                if file['duration'] is None:
+                    metadata = torchaudio.info(path)
+                    file['duration'] = metadata.num_frames / metadata.sample_rate
+                    self.dirty = True
+            self.save()
+        return { path: file['duration'] for path, file in entries.items() }
+
+    def get_list(self, extensions):
+        with self.lock:
+            os.makedirs(self.dir, exist_ok=True)
+            root_mtime = os.stat(self.dir).st_mtime_ns
+            if self.root is None or self.root['mtime'] != root_mtime:
+                subdirs = sorted([ d.name for d in os.scandir(self.dir) if d.is_dir() ])
+                self.root = { 'mtime': root_mtime, 'subdirs': subdirs }
+                # forget the folders that are gone
+                for name in list(self.folders):
+                    if name.split("/")[0] not in subdirs:
+                        del self.folders[name]
+                self.dirty = True
+
+            res = []
+            for name in self.root['subdirs']:
+                if name in self.DEFAULTS:
+                    continue
+                entry = self.scan_folder(name)
+                if entry is None or len(entry['files']) + len(entry['subdirs']) == 0:
+                    continue
+                if any([ self.has_extension(filename, extensions) for filename in entry['files'] ]):
+                    res.append(name)
+                    continue
+                for subdir in entry['subdirs']:
+                    sub_entry = self.scan_folder(f'{name}/{subdir}')
+                    if sub_entry is not None and any([ self.has_extension(filename, extensions) for filename in sub_entry['files'] ]):
+                        res.append(f'{name}/{subdir}')
+            self.save()
+        return sorted(res)
 
-def get_voice( name, dir=get_voice_dir(), load_latents=True, extensions=["wav", "mp3", "flac"] ):
-    subj = f'{dir}/{name}/'
-    if not os.path.isdir(subj):
-        return
-    files = os.listdir(subj)
-    
-    if load_latents:
-        extensions.append("pth")
 
-    voice = []
-    for file in files:
-        ext = os.path.splitext(file)[-1][1:]
-        if ext not in extensions:
-            continue
+VOICE_INDEXES = {}
+VOICE_INDEXES_LOCK = threading.Lock()
 
-        voice.append(f'{subj}/{file}')
+def get_voice_index(dir=None):
+    """
+    Returns the VoiceIndex of <dir> (the voice directory by default). Only the voice directory's index is kept on disk.
+    """
+    voice_dir = get_voice_dir()
+    if dir is None:
+        dir = voice_dir
+    key = os.path.realpath(dir)
+    with VOICE_INDEXES_LOCK:
+        if key not in VOICE_INDEXES:
+            persistent = key == os.path.realpath(voice_dir)
+            VOICE_INDEXES[key] = VoiceIndex(dir, path=f'{dir}/.voice_index.json' if persistent else None)
+        return VOICE_INDEXES[key]
 
-    return sorted( voice )
+def get_voices(extra_voice_dirs=[], load_latents=True):
+    return _get_voices(dirs=[get_voice_dir()] + extra_voice_dirs, load_latents=load_latents)
 
-def get_voice_list(dir=get_voice_dir(), append_defaults=False, load_latents=True, extensions=["wav", "mp3", "flac"]):
-    defaults = [ "random", "microphone" ]
-    os.makedirs(dir, exist_ok=True)
-    #res = sorted([d for d in os.listdir(dir) if d not in defaults and os.path.isdir(os.path.join(dir, d)) and len(os.listdir(os.path.join(dir, d))) > 0 ])
-
-    res = []
-    for name in os.listdir(dir):
-        if name in defaults:
-            continue
-        if not os.path.isdir(f'{dir}/{name}'):
-            continue
-        if len(os.listdir(os.path.join(dir, name))) == 0:
-            continue
-        files = get_voice( name, dir=dir, extensions=extensions, load_latents=load_latents )
-
-        if len(files) > 0:
-            res.append(name)
-        else:
-            for subdir in os.listdir(f'{dir}/{name}'):
-                if not os.path.isdir(f'{dir}/{name}/{subdir}'):
-                    continue
-                files = get_voice( f'{name}/{subdir}', dir=dir, extensions=extensions, load_latents=load_latents )
-                if len(files) == 0:
-                    continue
-                res.append(f'{name}/{subdir}')
+def get_voice( name, dir=get_voice_dir(), load_latents=True, extensions=["wav", "mp3", "flac"] ):
+    if load_latents:
+        extensions = extensions + ["pth"]
+    return get_voice_index(dir).get_files(name, extensions)
 
-    res = sorted(res)
-    
+def get_voice_list(dir=get_voice_dir(), append_defaults=False, load_latents=True, extensions=["wav", "mp3", "flac"]):
+    if load_latents:
+        extensions = extensions + ["pth"]
+    res = get_voice_index(dir).get_list(extensions)
     if append_defaults:
-        res = res + defaults
-    
+        res = res + VoiceIndex.DEFAULTS
     return res
 
 
@@ -159,24 +303,19 @@ def load_voice(voice, extra_voice_dirs=[], load_latents=True, sample_rate=22050,
     if voice == 'random':
         return None, None
 
-    voices = _get_voices(dirs=[get_voice_dir()] + extra_voice_dirs, load_latents=load_latents)
+    # later directories take precedence, as they would when merging every directory's voices
+    index, clips = None, None
+    for dir in reversed([get_voice_dir()] + extra_voice_dirs):
+        index = get_voice_index(dir)
+        clips = index.get_entries(voice, VoiceIndex.AUDIO_EXTENSIONS, validate=True)
+        if clips is not None:
+            break
+    if clips is None:
+        raise KeyError(voice)
 
-    paths = voices[voice]
-    mtime = 0
-    
-    latent = None
-    voices = []
-
-    for path in paths:
-        filename = os.path.basename(path)
-        if filename[-4:] == ".pth" and filename[:12] == "cond_latents":
-            if not model_hash and filename == "cond_latents.pth":
-                latent = path
-            elif model_hash and filename == f"cond_latents_{model_hash[:8]}.pth":
-                latent = path
-        else:
-            voices.append(path)
-            mtime = max(mtime, os.path.getmtime(path))
+    voices = list(clips.keys())
+    mtime = max([ clip['mtime'] / 1e9 for clip in clips.values() ], default=0)
+    latent = index.get_latents(voice).get(model_hash[:8] if model_hash else None) if load_latents else None
 
     if load_latents and latent is not None:
         if os.path.getmtime(latent) > mtime:
@@ -258,10 +397,24 @@ class TacotronSTFT(torch.nn.Module):
         return mel_output
 
 
+# Building a TacotronSTFT recomputes its librosa mel basis and STFT kernels, so one is kept per (sample rate, device, dtype).
+_UNIVNET_STFTS = {}
+
+
+def get_univnet_stft(sample_rate=24000, device='cpu', dtype=torch.float32):
+    device = torch.device(device)
+    key = (sample_rate, str(device), dtype)
+    if key not in _UNIVNET_STFTS:
+        _UNIVNET_STFTS[key] = TacotronSTFT(1024, 256, 1024, 100, sample_rate, 0, 12000).to(device=device, dtype=dtype)
+    return _UNIVNET_STFTS[key]
+
+
 def wav_to_univnet_mel(wav, do_normalization=False, device='cpu', sample_rate=24000):
-    stft = TacotronSTFT(1024, 256, 1024, 100, sample_rate, 0, 12000)
-    stft = stft.to(device)
-    mel = stft.mel_spectrogram(wav)
+    """
+    Computes the univnet mel of a (b,t) batch of waves, using the shared TacotronSTFT for <device>.
+    """
+    stft = get_univnet_stft(sample_rate, device, wav.dtype)
+    mel = stft.mel_spectrogram(wav.to(device))
     if do_normalization:
         mel = normalize_tacotron_mel(mel)
     return mel
@@ -199,6 +199,7 @@ class GaussianDiffusion:
         conditioning_free=False,
         conditioning_free_k=1,
         ramp_conditioning_free=True,
+        fused_conditioning_free=False,
     ):
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
@@ -207,6 +208,7 @@ class GaussianDiffusion:
         self.conditioning_free = conditioning_free
         self.conditioning_free_k = conditioning_free_k
         self.ramp_conditioning_free = ramp_conditioning_free
+        self.fused_conditioning_free = fused_conditioning_free
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -247,6 +249,53 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
+        # Arrays that are otherwise derived per step, kept so they can be uploaded alongside the others.
+        self.log_betas = np.log(betas)
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef2_over_coef1 = self.posterior_mean_coef2 / self.posterior_mean_coef1
+        self.fixed_large_variance = np.append(self.posterior_variance[1], self.betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+        self._schedule_key = (self.betas.tobytes(),)
+
+    _SCHEDULE_TABLES = (
+        "betas", "log_betas", "alphas_cumprod", "alphas_cumprod_prev", "alphas_cumprod_next",
+        "one_minus_alphas_cumprod", "sqrt_alphas_cumprod", "sqrt_one_minus_alphas_cumprod",
+        "log_one_minus_alphas_cumprod", "sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod",
+        "posterior_variance", "posterior_log_variance_clipped", "posterior_mean_coef1", "posterior_mean_coef2",
+        "recip_posterior_mean_coef1", "posterior_mean_coef2_over_coef1", "fixed_large_variance", "fixed_large_log_variance",
+    )
+
+    def get_schedule_tables(self, device, dtype=th.float32):
+        """
+        Get the schedule arrays as tensors resident on a device.
+
+        Tables are uploaded once per (schedule, device, dtype) and shared between
+        every diffusion instance built with the same schedule.
+
+        :param device: the device the tables should live on.
+        :param dtype: the floating point type of the tables.
+        :return: a dict mapping each array name to its 1-D tensor.
+        """
+        key = (self._schedule_key, str(device), dtype)
+        tables = _schedule_tables.get(key)
+        if tables is None:
+            tables = {
+                name: th.from_numpy(getattr(self, name)).to(device=device, dtype=dtype)
+                for name in self._SCHEDULE_TABLES
+            }
+            _schedule_tables[key] = tables
+        return tables
+
+    def get_timesteps(self, batch_size, device):
+        """
+        Get a [num_timesteps x batch_size] tensor where row i holds timestep i for every batch element.
+        """
+        return th.arange(self.num_timesteps, device=device).unsqueeze(1).expand(-1, batch_size)
+
+    def _extract(self, name, t, broadcast_shape):
+        return _extract_into_tensor(self.get_schedule_tables(t.device)[name], t, broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -256,11 +305,11 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
         )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract(
+            "log_one_minus_alphas_cumprod", t, x_start.shape
         )
         return mean, variance, log_variance
 
@@ -279,8 +328,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape)
             * noise
         )
 
@@ -293,12 +342,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -308,6 +357,28 @@ class GaussianDiffusion:
         )
         return posterior_mean, posterior_variance, posterior_log_variance_clipped
 
+    def _fused_conditioning_free_output(self, model, x, t, model_kwargs):
+        """
+        Evaluate the conditioned and conditioning-free branches of guidance in a
+        single model call by stacking both along the batch dimension.
+
+        The model must accept a per-row boolean `conditioning_free` tensor.
+
+        :return: a tuple (conditioned output, conditioning-free output).
+        """
+        B = x.shape[0]
+
+        def stack(v):
+            if th.is_tensor(v) and v.dim() > 0 and v.shape[0] == B:
+                return th.cat([v, v], dim=0)
+            return v
+
+        kwargs = {k: stack(v) for k, v in model_kwargs.items()}
+        conditioning_free = th.arange(2 * B, device=x.device) >= B
+        model_output = model(th.cat([x, x], dim=0), self._scale_timesteps(th.cat([t, t], dim=0)),
+                             conditioning_free=conditioning_free, **kwargs)
+        return model_output[:B], model_output[B:]
+
     def p_mean_variance(
         self, model, x, t, clip_denoised=True, denoised_fn=None, model_kwargs=None
     ):
@@ -336,9 +407,12 @@ class GaussianDiffusion:
 
         B, C = x.shape[:2]
         assert t.shape == (B,)
-        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
-        if self.conditioning_free:
-            model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
+        if self.conditioning_free and self.fused_conditioning_free:
+            model_output, model_output_no_conditioning = self._fused_conditioning_free_output(model, x, t, model_kwargs)
+        else:
+            model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+            if self.conditioning_free:
+                model_output_no_conditioning = model(x, self._scale_timesteps(t), conditioning_free=True, **model_kwargs)
 
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
@@ -349,10 +423,10 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
+                min_log = self._extract(
+                    "posterior_log_variance_clipped", t, x.shape
                 )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                max_log = self._extract("log_betas", t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -362,20 +436,20 @@ class GaussianDiffusion:
                 # for fixedlarge, we set the initial (log-)variance like so
                 # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    "fixed_large_variance",
+                    "fixed_large_log_variance",
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
                 ),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                # This should only be used in inference, where every batch element shares the same timestep.
                 cfk = self.conditioning_free_k * (1 - self._scale_timesteps(t)[0].item() / self.num_timesteps)
             else:
                 cfk = self.conditioning_free_k
@@ -419,25 +493,25 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
         return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
+            self._extract("recip_posterior_mean_coef1", t, x_t.shape) * xprev
+            - self._extract(
+                "posterior_mean_coef2_over_coef1", t, x_t.shape
             )
             * x_t
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
@@ -469,7 +543,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
@@ -535,6 +609,10 @@ class GaussianDiffusion:
             return self.p_sample_loop(*args, **kwargs)
         if s == 'ddim':
             return self.ddim_sample_loop(*args, **kwargs)
+        if s == 'dpm++2m':
+            return self.dpmpp_2m_sample_loop(*args, **kwargs)
+        if s == 'unipc':
+            return self.unipc_sample_loop(*args, **kwargs)
         else: raise RuntimeError("sampler not implemented")
 
     def p_sample_loop(
@@ -614,9 +692,10 @@ class GaussianDiffusion:
         else:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
+        timesteps = self.get_timesteps(shape[0], device)
 
         for i in tqdm(indices, desc=desc):
-            t = th.tensor([i] * shape[0], device=device)
+            t = timesteps[i]
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -661,8 +740,8 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -705,10 +784,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -783,11 +862,13 @@ class GaussianDiffusion:
             img = th.randn(*shape, device=device)
         indices = list(range(self.num_timesteps))[::-1]
 
+        timesteps = self.get_timesteps(shape[0], device)
+
         if verbose:
             indices = tqdm(indices, desc=desc)
 
         for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+            t = timesteps[i]
             with th.no_grad():
                 out = self.ddim_sample(
                     model,
@@ -802,6 +883,154 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def _ode_log_snr(self, i):
+        """
+        Get (alpha, sigma, lambda) of the probability flow ODE at timestep index i, where
+        lambda = log(alpha / sigma) is the half log-SNR used by the multistep solvers.
+        """
+        alpha = math.sqrt(self.alphas_cumprod[i])
+        sigma = math.sqrt(1.0 - self.alphas_cumprod[i])
+        return alpha, sigma, math.log(alpha) - math.log(sigma)
+
+    def _ode_predict_xstart(self, model, x, t, clip_denoised, denoised_fn, model_kwargs):
+        # The learned-range variance channels are dropped by p_mean_variance, and conditioning-free
+        # guidance is applied there as well, so the solvers only ever see the guided x_0 prediction.
+        with th.no_grad():
+            out = self.p_mean_variance(
+                model,
+                x,
+                t,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+            )
+        return out["pred_xstart"]
+
+    def dpmpp_2m_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        verbose=False,
+        desc=None,
+    ):
+        """
+        Generate samples from the model with the multistep DPM-Solver++(2M) ODE solver.
+
+        One model evaluation is spent per timestep, and the final step returns the
+        x_0 prediction at t=0. cond_fn is not supported.
+
+        Same usage as p_sample_loop().
+        """
+        assert cond_fn is None, "dpm++2m does not support cond_fn"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+        timesteps = self.get_timesteps(shape[0], device)
+
+        old_pred_xstart = None
+        h_last = None
+        for i in tqdm(indices, desc=desc):
+            pred_xstart = self._ode_predict_xstart(model, img, timesteps[i], clip_denoised, denoised_fn, model_kwargs)
+            if i == 0:
+                img = pred_xstart
+                break
+            _, sigma_s, lambda_s = self._ode_log_snr(i)
+            alpha_t, sigma_t, lambda_t = self._ode_log_snr(i - 1)
+            h = lambda_t - lambda_s
+            if old_pred_xstart is None:
+                denoised = pred_xstart
+            else:
+                r = h_last / h
+                denoised = (1 + 1 / (2 * r)) * pred_xstart - (1 / (2 * r)) * old_pred_xstart
+            img = (sigma_t / sigma_s) * img - (alpha_t * math.expm1(-h)) * denoised
+            old_pred_xstart = pred_xstart
+            h_last = h
+        return img
+
+    def unipc_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        verbose=False,
+        desc=None,
+    ):
+        """
+        Generate samples from the model with the second order UniPC predictor-corrector
+        (data prediction, B(h) = expm1(h)).
+
+        The model evaluation made for each corrector is reused by the following
+        predictor, so one model evaluation is spent per timestep, and the final
+        step returns the x_0 prediction at t=0. cond_fn is not supported.
+
+        Same usage as p_sample_loop().
+        """
+        assert cond_fn is None, "unipc does not support cond_fn"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        indices = list(range(self.num_timesteps))[::-1]
+        timesteps = self.get_timesteps(shape[0], device)
+
+        pred_xstart = self._ode_predict_xstart(model, img, timesteps[indices[0]], clip_denoised, denoised_fn, model_kwargs)
+        old_pred_xstart = None
+        lambda_old = None
+        for i in tqdm(indices[:-1], desc=desc):
+            _, sigma_s, lambda_s = self._ode_log_snr(i)
+            alpha_t, sigma_t, lambda_t = self._ode_log_snr(i - 1)
+            h = lambda_t - lambda_s
+            hh = -h
+            h_phi_1 = math.expm1(hh)
+            B_h = h_phi_1
+
+            x_t_ = (sigma_t / sigma_s) * img - (alpha_t * h_phi_1) * pred_xstart
+            if old_pred_xstart is None:
+                # First order warmup: UniP-1 is plain DDIM and UniC-1 uses rho = 0.5.
+                img = x_t_
+                rhos_c = (None, 0.5)
+                D1 = None
+            else:
+                rk = (lambda_old - lambda_s) / h
+                D1 = (old_pred_xstart - pred_xstart) / rk
+                img = x_t_ - (alpha_t * B_h * 0.5) * D1
+                # Solve R @ rhos_c = b for R = [[1, 1], [rk, 1]].
+                h_phi_k = h_phi_1 / hh - 1
+                b1 = h_phi_k / B_h
+                b2 = (h_phi_k / hh - 1 / 2) * 2 / B_h
+                rho_1 = (b1 - b2) / (1 - rk)
+                rhos_c = (rho_1, b1 - rho_1)
+
+            model_t = self._ode_predict_xstart(model, img, timesteps[i - 1], clip_denoised, denoised_fn, model_kwargs)
+            corr_res = rhos_c[-1] * (model_t - pred_xstart)
+            if D1 is not None:
+                corr_res = corr_res + rhos_c[0] * D1
+            img = x_t_ - (alpha_t * B_h) * corr_res
+
+            old_pred_xstart = pred_xstart
+            lambda_old = lambda_s
+            pred_xstart = model_t
+        return pred_xstart
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=True, model_kwargs=None
     ):
@@ -1124,6 +1353,8 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        self._schedule_key += (tuple(self.timestep_map),)
+        self._wrapped_models = {}
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -1149,10 +1380,16 @@ class SpacedDiffusion(GaussianDiffusion):
     def _wrap_model(self, model, autoregressive=False):
         if isinstance(model, _WrappedModel) or isinstance(model, _WrappedAutoregressiveModel):
             return model
-        mod = _WrappedAutoregressiveModel if autoregressive else _WrappedModel
-        return mod(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
-        )
+        # The sample loops wrap the same model every step; reuse the wrapper so its timestep map stays on device.
+        key = (id(model), autoregressive)
+        wrapped = self._wrapped_models.get(key)
+        if wrapped is None or wrapped.model is not model:
+            mod = _WrappedAutoregressiveModel if autoregressive else _WrappedModel
+            wrapped = mod(
+                model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            )
+            self._wrapped_models[key] = wrapped
+        return wrapped
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -1215,16 +1452,24 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+def _get_timestep_map(timestep_map, map_tensors, ts):
+    map_tensor = map_tensors.get(ts.device)
+    if map_tensor is None:
+        map_tensor = th.tensor(timestep_map, device=ts.device)
+        map_tensors[ts.device] = map_tensor
+    return map_tensor[ts]
+
+
 class _WrappedModel:
     def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {}
 
     def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _get_timestep_map(self.timestep_map, self.map_tensors, ts)
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, new_ts, **kwargs)
@@ -1236,25 +1481,32 @@ class _WrappedAutoregressiveModel:
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self.map_tensors = {}
 
     def __call__(self, x, x0, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+        new_ts = _get_timestep_map(self.timestep_map, self.map_tensors, ts)
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
         return self.model(x, x0, new_ts, **kwargs)
 
+# Device-resident schedule tables, keyed by (schedule, device, dtype); see GaussianDiffusion.get_schedule_tables().
+_schedule_tables = {}
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
 
-    :param arr: the 1-D numpy array.
+    :param arr: the 1-D numpy array, or a 1-D tensor already on the device of timesteps.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    if th.is_tensor(arr):
+        res = arr[timesteps].float()
+    else:
+        res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res.expand(broadcast_shape)
\ No newline at end of file
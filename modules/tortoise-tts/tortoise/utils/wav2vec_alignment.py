@@ -1,5 +1,6 @@
 import re
 
+import numpy as np
 import torch
 import torchaudio
 from transformers import Wav2Vec2ForCTC, Wav2Vec2FeatureExtractor, Wav2Vec2CTCTokenizer, Wav2Vec2Processor
@@ -14,10 +15,8 @@ def max_alignment(s1, s2, skip_character='~', record=None):
     A clever function that aligns s1 to s2 as best it can. Wherever a character from s1 is not found in s2, a '~' is
     used to replace that character.
 
-    Finally got to use my DP skills!
+    Finally got to use my DP skills! The DP is filled in bottom-up, one vectorized row of the table at a time.
     """
-    if record is None:
-        record = {}
     assert skip_character not in s1, f"Found the skip character {skip_character} in the provided string, {s1}"
     if len(s1) == 0:
         return ''
@@ -25,61 +24,132 @@ def max_alignment(s1, s2, skip_character='~', record=None):
         return skip_character * len(s1)
     if s1 == s2:
         return s1
-    if s1[0] == s2[0]:
-        return s1[0] + max_alignment(s1[1:], s2[1:], skip_character, record)
 
-    take_s1_key = (len(s1), len(s2) - 1)
-    if take_s1_key in record:
-        take_s1, take_s1_score = record[take_s1_key]
-    else:
-        take_s1 = max_alignment(s1, s2[1:], skip_character, record)
-        take_s1_score = len(take_s1.replace(skip_character, ''))
-        record[take_s1_key] = (take_s1, take_s1_score)
+    c1 = np.frombuffer(s1.encode('utf-32-le'), dtype=np.uint32)
+    c2 = np.frombuffer(s2.encode('utf-32-le'), dtype=np.uint32)
+    matches = c1[:, None] == c2[None, :]
+
+    # scores[i, j] is how many characters of s1[i:] can be kept when aligning it to s2[j:]
+    scores = np.zeros((len(s1) + 1, len(s2) + 1), dtype=np.int32)
+    for i in range(len(s1) - 1, -1, -1):
+        # a match is always worth taking, otherwise s1[i] is skipped or s2[j:] is searched further along,
+        # which makes each row the running maximum over what is left of s2
+        best = np.where(matches[i], scores[i + 1, 1:] + 1, scores[i + 1, :-1])
+        scores[i, :-1] = np.maximum.accumulate(best[::-1])[::-1]
+
+    aligned = []
+    i, j = 0, 0
+    while i < len(s1):
+        if j == len(s2):
+            aligned.append(skip_character * (len(s1) - i))
+            break
+        if matches[i, j]:
+            aligned.append(s1[i])
+            i += 1
+            j += 1
+        elif scores[i, j + 1] > scores[i + 1, j]:
+            j += 1
+        else:
+            aligned.append(skip_character)
+            i += 1
+    return ''.join(aligned)
+
+
+def split_redactions(expected_text):
+    """
+    Splits text with [bracketed] parts to redact into the text with the brackets taken out, and the (start, end)
+    character intervals of it that are kept.
+    """
+    splitted = expected_text.split('[')
+    fully_split = [splitted[0]]
+    for spl in splitted[1:]:
+        assert ']' in spl, 'Every "[" character must be paired with a "]" with no nesting.'
+        fully_split.extend(spl.split(']'))
 
-    take_s2_key = (len(s1) - 1, len(s2))
-    if take_s2_key in record:
-        take_s2, take_s2_score = record[take_s2_key]
-    else:
-        take_s2 = max_alignment(s1[1:], s2, skip_character, record)
-        take_s2_score = len(take_s2.replace(skip_character, ''))
-        record[take_s2_key] = (take_s2, take_s2_score)
+    # At this point, fully_split is a list of strings, with every other string being something that should be redacted.
+    non_redacted_intervals = []
+    last_point = 0
+    for i in range(len(fully_split)):
+        if i % 2 == 0 and fully_split[i] != "": # Check for empty string fixes index error
+            end_interval = max(0, last_point + len(fully_split[i]) - 1)
+            non_redacted_intervals.append((last_point, end_interval))
+        last_point += len(fully_split[i])
 
-    return take_s1 if take_s1_score > take_s2_score else skip_character + take_s2
+    return ''.join(fully_split), non_redacted_intervals
 
 
 class Wav2VecAlignment:
     """
     Uses wav2vec2 to perform audio<->text alignment.
     """
-    def __init__(self, device=None):
+    def __init__(self, device=None, keep_loaded=False):
+        """
+        :param keep_loaded: Keeps wav2vec2 on the device between calls instead of moving it back to the CPU after each one.
+        """
         if device is None:
             device = torch.device(get_device())
 
+        # wav2vec2 is only loaded once there is something to redact
+        self.model = None
+        self.feature_extractor = None
+        self.tokenizer = None
+        self.device = device
+        self.keep_loaded = keep_loaded
+
+    def load(self):
+        if self.model is not None:
+            return
+
         self.model = Wav2Vec2ForCTC.from_pretrained("jbetker/wav2vec2-large-robust-ft-libritts-voxpopuli").cpu()
         self.feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(f"facebook/wav2vec2-large-960h")
         self.tokenizer = Wav2Vec2CTCTokenizer.from_pretrained('jbetker/tacotron-symbols')
-        self.device = device
+        if self.keep_loaded and torch.cuda.is_available():
+            self.model = self.model.to(self.device)
 
     def align(self, audio, expected_text, audio_sample_rate=24000):
-        orig_len = audio.shape[-1]
+        return self.align_batch([audio], expected_text, audio_sample_rate)[0]
+
+    def align_batch(self, audios, expected_text, audio_sample_rate=24000):
+        """
+        align() for a list of clips of the same text, which go through wav2vec2 together as one padded batch.
+        """
+        self.load()
 
         with torch.no_grad():
-            if torch.cuda.is_available(): # This is unneccessary technically, but it's a placebo
+            if torch.cuda.is_available() and not self.keep_loaded: # This is unneccessary technically, but it's a placebo
                 self.model = self.model.to(self.device)
 
-            audio = audio.to(self.device)
-            audio = torchaudio.functional.resample(audio, audio_sample_rate, 16000)
-            clip_norm = (audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7)
-            logits = self.model(clip_norm).logits
-
-            if torch.cuda.is_available():
+            clips = []
+            for audio in audios:
+                audio = audio.to(self.device)
+                audio = torchaudio.functional.resample(audio, audio_sample_rate, 16000)
+                clip_norm = (audio - audio.mean()) / torch.sqrt(audio.var() + 1e-7)
+                clips.append(clip_norm.reshape(-1))
+
+            lengths = torch.tensor([ clip.shape[-1] for clip in clips ], device=clips[0].device)
+            batch = torch.nn.utils.rnn.pad_sequence(clips, batch_first=True)
+            attention_mask = None
+            # models with group norm in their feature extractor are meant to be fed zero padding without a mask
+            if self.model.config.feat_extract_norm == "layer":
+                attention_mask = (torch.arange(batch.shape[-1], device=batch.device).unsqueeze(0) < lengths.unsqueeze(1)).long()
+            logits = self.model(batch, attention_mask=attention_mask).logits
+            frames = self.model._get_feat_extract_output_lengths(lengths).tolist()
+            top = logits.argmax(-1).tolist()
+
+            if torch.cuda.is_available() and not self.keep_loaded:
                 self.model = self.model.cpu()
 
-        logits = logits[0]
-        pred_string = self.tokenizer.decode(logits.argmax(-1).tolist())
+        return [ self.align_tokens(audio, top[b][:frames[b]], expected_text) for b, audio in enumerate(audios) ]
+
+    def align_tokens(self, audio, top, expected_text):
+        """
+        Finds where each character of expected_text starts in audio, from the most likely wav2vec2 token of every frame.
+        """
+        orig_len = audio.shape[-1]
+        pred_string = self.tokenizer.decode(top)
 
         fixed_expectation = max_alignment(expected_text.lower(), pred_string)
-        w2v_compression = orig_len // logits.shape[0]
+        w2v_compression = orig_len // len(top)
         expected_tokens = self.tokenizer.encode(fixed_expectation)
         expected_chars = list(fixed_expectation)
         if len(expected_tokens) == 1:
@@ -102,9 +172,8 @@ class Wav2VecAlignment:
             return popped
 
         next_expected_token = pop_till_you_win()
-        for i, logit in enumerate(logits):
-            top = logit.argmax()
-            if next_expected_token == top:
+        for i, token in enumerate(top):
+            if next_expected_token == token:
                 alignments.append(i * w2v_compression)
                 if len(expected_tokens) > 0:
                     next_expected_token = pop_till_you_win()
@@ -132,28 +201,23 @@ class Wav2VecAlignment:
         return alignments[:-1]
 
     def redact(self, audio, expected_text, audio_sample_rate=24000):
+        return self.redact_batch([audio], expected_text, audio_sample_rate)[0]
+
+    def redact_batch(self, audios, expected_text, audio_sample_rate=24000):
+        """
+        redact() for a list of clips of the same text, which are all aligned with one wav2vec2 call.
+        """
         if '[' not in expected_text:
-            return audio
-        splitted = expected_text.split('[')
-        fully_split = [splitted[0]]
-        for spl in splitted[1:]:
-            assert ']' in spl, 'Every "[" character must be paired with a "]" with no nesting.'
-            fully_split.extend(spl.split(']'))
-
-        # At this point, fully_split is a list of strings, with every other string being something that should be redacted.
-        non_redacted_intervals = []
-        last_point = 0
-        for i in range(len(fully_split)):
-            if i % 2 == 0 and fully_split[i] != "": # Check for empty string fixes index error
-                end_interval = max(0, last_point + len(fully_split[i]) - 1)
-                non_redacted_intervals.append((last_point, end_interval))
-            last_point += len(fully_split[i])
-
-        bare_text = ''.join(fully_split)
-        alignments = self.align(audio, bare_text, audio_sample_rate)
-
-        output_audio = []
-        for nri in non_redacted_intervals:
-            start, stop = nri
-            output_audio.append(audio[:, alignments[start]:alignments[stop]])
-        return torch.cat(output_audio, dim=-1)
+            return audios
+
+        bare_text, non_redacted_intervals = split_redactions(expected_text)
+        alignments = self.align_batch(audios, bare_text, audio_sample_rate)
+
+        redacted = []
+        for audio, alignment in zip(audios, alignments):
+            output_audio = []
+            for nri in non_redacted_intervals:
+                start, stop = nri
+                output_audio.append(audio[:, alignment[start]:alignment[stop]])
+            redacted.append(torch.cat(output_audio, dim=-1))
+        return redacted
@@ -1,10 +1,14 @@
 import asyncio
 import json
+import threading
+import time
 from threading import Thread
 
 from websockets.server import serve
 
-from utils import generate, get_autoregressive_models, get_voice_list, args, update_autoregressive_model, update_diffusion_model, update_tokenizer
+import utils
+from utils import generate, get_autoregressive_models, get_voice_list, args, update_autoregressive_model, update_diffusion_model, update_tokenizer, load_tts
+from tortoise.api import CandidateDecodeBatcher
 
 # this is a not so nice workaround to set values to None if their string value is "None"
 def replaceNoneStringWithNone(message):
@@ -17,7 +21,7 @@ def replaceNoneStringWithNone(message):
     return message
 
 
-async def _handle_generate(websocket, message):
+def _apply_model_settings(message):
     # update args parameters which control the model settings
     if message.get('autoregressive_model'):
         update_autoregressive_model(message['autoregressive_model'])
@@ -32,10 +36,191 @@ async def _handle_generate(websocket, message):
         global args
         args.sample_batch_size = message['sample_batch_size']
 
-    message['result'] = generate(**message)
+
+# requests with the same key load the same models and diffuse the same way, so they can run together
+def _get_batch_key(message):
+    if utils.args.tts_backend != "tortoise":
+        return None
+    # low VRAM mode offloads models between stages, which only works with one request using them at a time
+    if utils.args.low_vram:
+        return None
+    # per-line settings overrides could switch models in the middle of a batch
+    if '{' in (message.get('text') or ''):
+        return None
+
+    # "auto" models are picked per voice, so requests are grouped by the models they actually end up with
+    autoregressive_model = _resolve_model(message, 'autoregressive_model')
+    diffusion_model = _resolve_model(message, 'diffusion_model')
+    if autoregressive_model is None or diffusion_model is None:
+        return None
+
+    keys = ['tokenizer_json', 'sample_batch_size', 'diffusion_sampler', 'diffusion_iterations',
+            'diffusion_temperature', 'cond_free_k', 'breathing_room', 'candidates']
+    return tuple([ autoregressive_model, diffusion_model ] + [ f'{message.get(k)}' for k in keys ] + sorted(message.get('experimentals') or []))
+
+
+# the model a request will generate with, or None when that can't be told ahead of time
+def _resolve_model(message, name):
+    model = message.get(name) or getattr(utils.args, name)
+    if model != "auto":
+        return f'{model}'
+    if name != 'autoregressive_model':
+        return None
+    try:
+        # a requested "auto" is resolved once by _apply_model_settings against the current voice,
+        # while a stored "auto" is resolved by get_tortoise_settings against the request's own voice
+        if message.get(name):
+            return utils.deduce_autoregressive_model()
+        return utils.deduce_autoregressive_model(message.get('voice'))
+    except Exception as e:
+        return None
+
+
+def _resolve(future, result=None, error=None):
+    if future.done():  # the client went away
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class GenerateScheduler:
+    """
+    Queues generate requests from every connection and runs them on a single thread, so the event loop stays free.
+    Pending requests with compatible settings are taken together: each runs on its own worker thread, the autoregressive
+    sampling of their lines takes turns, and their candidates are diffused and vocoded in shared batches.
+    """
+    def __init__(self, max_batch_size=4):
+        self.max_batch_size = max(1, max_batch_size)
+        self.pending = []
+        self.condition = threading.Condition()
+        self.metrics = {
+            'queue_depth': 0,
+            'max_queue_depth': 0,
+            'requests': 0,
+            'batches': 0,
+            'batch_sizes': {},
+            'decode_batch_sizes': {},
+        }
+        Thread(target=self._run, daemon=True).start()
+
+    def submit(self, message, loop):
+        future = loop.create_future()
+        with self.condition:
+            self.pending.append((message, loop, future))
+            self.metrics['queue_depth'] = len(self.pending)
+            self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], len(self.pending))
+            self.condition.notify()
+        return future
+
+    def get_metrics(self):
+        with self.condition:
+            return json.loads(json.dumps(self.metrics))
+
+    def _take_batch(self):
+        with self.condition:
+            while len(self.pending) == 0:
+                self.condition.wait()
+
+            batch = [self.pending.pop(0)]
+            key = _get_batch_key(batch[0][0])
+            if key is not None:
+                for request in list(self.pending):
+                    if len(batch) >= self.max_batch_size:
+                        break
+                    if _get_batch_key(request[0]) == key:
+                        batch.append(request)
+                        self.pending.remove(request)
+
+            self.metrics['queue_depth'] = len(self.pending)
+            self.metrics['batches'] += 1
+            self.metrics['requests'] += len(batch)
+            size = f'{len(batch)}'
+            self.metrics['batch_sizes'][size] = self.metrics['batch_sizes'].get(size, 0) + 1
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            start_time = time.time()
+            try:
+                _apply_model_settings(batch[0][0])
+                if len(batch) == 1:
+                    self._generate(*batch[0])
+                else:
+                    self._generate_batch(batch)
+            except Exception as e:
+                for _, loop, future in batch:
+                    loop.call_soon_threadsafe(_resolve, future, None, e)
+            print(f"websocket: processed {len(batch)} request(s) in {time.time()-start_time:.3f} seconds, {self.metrics['queue_depth']} queued")
+
+    def _generate(self, message, loop, future):
+        try:
+            result = generate(**message)
+        except Exception as e:
+            loop.call_soon_threadsafe(_resolve, future, None, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, future, result)
+
+    def _generate_batch(self, batch):
+        if not utils.tts:
+            load_tts()
+
+        # voices (and their latents) are resolved one after another before anything runs concurrently
+        requests = []
+        for message, loop, future in batch:
+            try:
+                voice_cache = utils.prepare_tortoise_voice(**message)
+            except Exception as e:
+                loop.call_soon_threadsafe(_resolve, future, None, e)
+                continue
+            requests.append(({ **message, 'voice_cache': voice_cache }, loop, future))
+        if len(requests) == 0:
+            return
+
+        batcher = CandidateDecodeBatcher()
+        # everyone has to be registered before anyone decodes, or the first line would be decoded on its own
+        ready = threading.Barrier(len(requests))
+        def run(message, loop, future):
+            batcher.join()
+            ready.wait()
+            try:
+                self._generate(message, loop, future)
+            finally:
+                batcher.leave()
+
+        utils.tts.decode_batcher = batcher
+        try:
+            threads = [ Thread(target=run, args=request) for request in requests ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            utils.tts.decode_batcher = None
+
+        with self.condition:
+            for size in batcher.batch_sizes:
+                size = f'{size}'
+                self.metrics['decode_batch_sizes'][size] = self.metrics['decode_batch_sizes'].get(size, 0) + 1
+
+
+scheduler = None
+# running message tasks, referenced here so they aren't garbage collected before they finish
+message_tasks = set()
+
+
+async def _handle_generate(websocket, message):
+    message['result'] = await scheduler.submit(message, asyncio.get_running_loop())
     await websocket.send(json.dumps(replaceNoneStringWithNone(message)))
 
 
+async def _handle_get_metrics(websocket, message):
+    message['result'] = scheduler.get_metrics()
+    await websocket.send(json.dumps(message))
+
+
 async def _handle_get_autoregressive_models(websocket, message):
     message['result'] = get_autoregressive_models()
     await websocket.send(json.dumps(replaceNoneStringWithNone(message)))
@@ -55,6 +240,8 @@ async def _handle_message(websocket, message):
         await _handle_get_voice_list(websocket, message)
     elif message.get('action') and message['action'] == 'get_autoregressive_models':
         await _handle_get_autoregressive_models(websocket, message)
+    elif message.get('action') and message['action'] == 'get_metrics':
+        await _handle_get_metrics(websocket, message)
     else:
         print("websocket: undhandled message: " + message)
 
@@ -64,9 +251,29 @@ async def _handle_connection(websocket, path):
 
     async for message in websocket:
         try:
-            await _handle_message(websocket, json.loads(message))
+            message = json.loads(message)
         except ValueError:
             print("websocket: malformed json received")
+            continue
+        # handled as its own task, so a connection can have several generate requests queued at once
+        task = asyncio.create_task(_handle_message_task(websocket, message))
+        message_tasks.add(task)
+        task.add_done_callback(message_tasks.discard)
+
+
+async def _handle_message_task(websocket, message):
+    try:
+        await _handle_message(websocket, message)
+    except Exception as e:
+        print(f"websocket: failed to handle message: {e}")
+        # the request is echoed back with the error, so the client isn't left waiting on a reply
+        if not isinstance(message, dict):
+            return
+        message['error'] = str(e)
+        try:
+            await websocket.send(json.dumps(message, default=str))
+        except Exception as e:
+            print(f"websocket: failed to send error: {e}")
 
 
 async def _run(host: str, port: int):
@@ -81,4 +288,6 @@ def _run_server(listen_address: str, port: int):
 
 
 def start_websocket_server(listen_address: str, port: int):
+    global scheduler
+    scheduler = GenerateScheduler(max_batch_size=utils.args.websocket_max_batch_size)
     Thread(target=_run_server, args=[listen_address, port], daemon=True).start()
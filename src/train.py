@@ -7,11 +7,15 @@ import datetime
 from torch.distributed.run import main as torchrun
 
 # this is effectively just copy pasted and cleaned up from the __main__ section of training.py
-def train(config_path, launcher='none'):
+def train(config_path, launcher='none', keep_x_past_checkpoints=0):
     opt = option.parse(config_path, is_train=True)
 
     if launcher == 'none' and opt['gpus'] > 1:
-        return torchrun([f"--nproc_per_node={opt['gpus']}", "./src/train.py", "--yaml", config_path, "--launcher=pytorch"])
+        return torchrun([f"--nproc_per_node={opt['gpus']}", "./src/train.py", "--yaml", config_path, "--launcher=pytorch", f"--keep-x-past-checkpoints={keep_x_past_checkpoints}"])
+
+    # pruned by the trainer's checkpoint writer once each new checkpoint is written
+    if keep_x_past_checkpoints > 0:
+        opt['logger']['keep_x_past_checkpoints'] = keep_x_past_checkpoints
 
     trainer = tr.Trainer()
     if launcher == 'none':
@@ -34,6 +38,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--yaml', type=str, help='Path to training configuration file.', default='./training/voice/train.yml', nargs='+') # ugh
     parser.add_argument('--launcher', choices=['none', 'pytorch'], default='none', help='Job launcher')
+    parser.add_argument('--keep-x-past-checkpoints', type=int, default=0, help='How many past checkpoints to keep (0 keeps them all)')
     args = parser.parse_args()
     args.yaml = " ".join(args.yaml) # absolutely disgusting
     config_path = args.yaml
@@ -61,4 +66,4 @@ if __name__ == "__main__":
     from dlas import train as tr
     from dlas.utils import util, options as option
 
-    train(config_path, args.launcher)
\ No newline at end of file
+    train(config_path, args.launcher, args.keep_x_past_checkpoints)
\ No newline at end of file
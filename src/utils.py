@@ -23,6 +23,8 @@ import yaml
 import hashlib
 import string
 import random
+import threading
+import queue
 
 from tqdm import tqdm
 import torch
@@ -34,11 +36,12 @@ import pandas as pd
 import numpy as np
 
 from glob import glob
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
 
 from tortoise.api import TextToSpeech as TorToise_TTS, MODELS, get_model_path, pad_or_truncate
-from tortoise.utils.audio import load_audio, load_voice, load_voices, get_voice_dir, get_voices
+from tortoise.utils.audio import load_audio, load_voice, load_voices, get_voice_dir, get_voices, get_voice_index
 from tortoise.utils.text import split_and_recombine_text
 from tortoise.utils.device import get_device_name, set_device_name, get_device_count, get_device_vram, get_device_batch_size, do_gc
 
@@ -63,6 +66,20 @@ MIN_TRAINING_DURATION = 0.6
 MAX_TRAINING_DURATION = 11.6097505669
 MAX_TRAINING_CHAR_LENGTH = 200
 
+# turns every training clip into DVAE codes on the fly, for when they were not precomputed with the dataset
+DVAE_CODE_INJECTORS = "\n".join([
+	"paired_to_mel:",
+	"        type: torch_mel_spectrogram",
+	"        mel_norm_file: ./modules/tortoise-tts/tortoise/data/mel_norms.pth # ./models/tortoise/clips_mel_norms.pth",
+	"        in: wav",
+	"        out: paired_mel",
+	"      to_codes:",
+	"        type: discrete_token",
+	"        in: paired_mel",
+	"        out: paired_mel_codes",
+	"        dvae_config: \"./models/tortoise/train_diffusion_vocoder_22k_level.yml\"",
+])
+
 VALLE_ENABLED = False
 BARK_ENABLED = False
 
@@ -358,6 +375,31 @@ def resample( waveform, input_rate, output_rate=44100 ):
 
 	return RESAMPLERS[key]( waveform ), output_rate
 
+# batched websocket requests for the same voice generate at the same time, so an output index is handed out under a
+# lock and remembered, otherwise both would scan the same folder before either saved and write over each other
+output_idx_lock = threading.Lock()
+reserved_output_idxs = {}
+
+def reserve_output_idx( outdir, voice ):
+	with output_idx_lock:
+		idx_cache = {}
+		for i, file in enumerate(os.listdir(outdir)):
+			filename = os.path.basename(file)
+			extension = os.path.splitext(filename)[-1][1:]
+			if extension != "json" and extension != "wav":
+				continue
+			match = re.findall(rf"^{voice}_(\d+)(?:.+?)?{extension}$", filename)
+			if match and len(match) > 0:
+				key = int(match[0])
+				idx_cache[key] = True
+
+		reserved = reserved_output_idxs.setdefault(outdir, set())
+		keys = list(idx_cache.keys()) + list(reserved)
+		idx = max(keys) + 1 if len(keys) > 0 else 0
+
+		reserved.add(idx)
+		return idx
+
 def generate(**kwargs):
 	if args.tts_backend == "tortoise":
 		return generate_tortoise(**kwargs)
@@ -751,23 +793,7 @@ def generate_valle(**kwargs):
 
 	volume_adjust = torchaudio.transforms.Vol(gain=args.output_volume, gain_type="amplitude") if args.output_volume != 1 else None
 
-	idx = 0
-	idx_cache = {}
-	for i, file in enumerate(os.listdir(outdir)):
-		filename = os.path.basename(file)
-		extension = os.path.splitext(filename)[-1][1:]
-		if extension != "json" and extension != "wav":
-			continue
-		match = re.findall(rf"^{voice}_(\d+)(?:.+?)?{extension}$", filename)
-		if match and len(match) > 0:
-			key = int(match[0])
-			idx_cache[key] = True
-
-	if len(idx_cache) > 0:
-		keys = sorted(list(idx_cache.keys()))
-		idx = keys[-1] + 1
-
-	idx = pad(idx, 4)
+	idx = pad(reserve_output_idx(outdir, voice), 4)
 
 	def get_name(line=0, candidate=0, combined=False):
 		name = f"{idx}"
@@ -965,6 +991,155 @@ def generate_valle(**kwargs):
 		stats,
 	)
 
+def get_generate_texts( parameters ):
+	if not parameters['delimiter']:
+		parameters['delimiter'] = "\n"
+	elif parameters['delimiter'] == "\\n":
+		parameters['delimiter'] = "\n"
+
+	if parameters['delimiter'] and parameters['delimiter'] != "" and parameters['delimiter'] in parameters['text']:
+		return parameters['text'].split(parameters['delimiter'])
+	return split_and_recombine_text(parameters['text'])
+
+def format_generate_line( parameters, cut_text ):
+	if should_phonemize():
+		cut_text = phonemizer( cut_text )
+
+	if parameters['emotion'] == "Custom":
+		if parameters['prompt'] and parameters['prompt'].strip() != "":
+			cut_text = f"[{parameters['prompt']},] {cut_text}"
+	elif parameters['emotion'] != "None" and parameters['emotion']:
+		cut_text = f"[I am really {parameters['emotion'].lower()},] {cut_text}"
+	return cut_text
+
+def fetch_tortoise_voice( voice, parameters, voice_cache, progress=None ):
+	cache_key = f'{voice}:{tts.autoregressive_model_hash[:8]}'
+	if cache_key in voice_cache:
+		return voice_cache[cache_key]
+
+	print(f"Loading voice: {voice} with model {tts.autoregressive_model_hash[:8]}")
+	sample_voice = None
+	if voice == "microphone":
+		if parameters['mic_audio'] is None:
+			raise Exception("Please provide audio from mic when choosing `microphone` as a voice input")
+		voice_samples, conditioning_latents = [load_audio(parameters['mic_audio'], tts.input_sample_rate)], None
+	elif voice == "random":
+		voice_samples, conditioning_latents = None, tts.get_random_conditioning_latents()
+	else:
+		if progress is not None:
+			notify_progress(f"Loading voice: {voice}", progress=progress)
+
+		latents_key = latents_cache.get_key( voice, parameters['voice_latents_chunks'] )
+		conditioning_latents = latents_cache.get( voice, latents_key ) if latents_key is not None else None
+		if conditioning_latents is not None:
+			voice_samples = None
+		else:
+			voice_samples, conditioning_latents = load_voice(voice, model_hash=tts.autoregressive_model_hash)
+			if conditioning_latents is not None and latents_key is not None:
+				latents_cache.put( voice, latents_key, conditioning_latents )
+		
+	if voice_samples and len(voice_samples) > 0:
+		if conditioning_latents is None:
+			conditioning_latents = compute_latents(voice=voice, voice_samples=voice_samples, voice_latents_chunks=parameters['voice_latents_chunks'])
+			
+		sample_voice = torch.cat(voice_samples, dim=-1).squeeze().cpu()
+		voice_samples = None
+
+	voice_cache[cache_key] = (voice_samples, conditioning_latents, sample_voice)
+	return voice_cache[cache_key]
+
+def get_tortoise_settings( parameters, voice_cache, override=None, progress=None ):
+	voice = parameters['voice']
+	settings = {
+		'temperature': float(parameters['temperature']),
+
+		'top_p': float(parameters['top_p']),
+		'diffusion_temperature': float(parameters['diffusion_temperature']),
+		'length_penalty': float(parameters['length_penalty']),
+		'repetition_penalty': float(parameters['repetition_penalty']),
+		'cond_free_k': float(parameters['cond_free_k']),
+
+		'num_autoregressive_samples': parameters['num_autoregressive_samples'],
+		'sample_batch_size': args.sample_batch_size,
+		'adaptive_patience': args.adaptive_sampling_patience,
+		'adaptive_margin': args.adaptive_sampling_margin,
+		'adaptive_threshold': args.adaptive_sampling_threshold,
+		'diffusion_iterations': parameters['diffusion_iterations'],
+
+		'voice_samples': None,
+		'conditioning_latents': None,
+
+		'use_deterministic_seed': parameters['seed'],
+		'return_deterministic_state': True,
+		'k': parameters['candidates'],
+		'diffusion_sampler': parameters['diffusion_sampler'],
+		'breathing_room': parameters['breathing_room'],
+		'half_p': "Half Precision" in parameters['experimentals'],
+		'cond_free': "Conditioning-Free" in parameters['experimentals'],
+		'cvvp_amount': parameters['cvvp_weight'],
+		
+		'autoregressive_model': args.autoregressive_model,
+		'diffusion_model': args.diffusion_model,
+		'tokenizer_json': args.tokenizer_json,
+	}
+
+	# could be better to just do a ternary on everything above, but i am not a professional
+	selected_voice = voice
+	if override is not None:
+		if 'voice' in override:
+			selected_voice = override['voice']
+
+		for k in override:
+			if k not in settings:
+				continue
+			settings[k] = override[k]
+
+	if settings['autoregressive_model'] is not None:
+		if settings['autoregressive_model'] == "auto":
+			settings['autoregressive_model'] = deduce_autoregressive_model(selected_voice)
+		tts.load_autoregressive_model(settings['autoregressive_model'])
+
+	if settings['diffusion_model'] is not None:
+		if settings['diffusion_model'] == "auto":
+			settings['diffusion_model'] = deduce_diffusion_model(selected_voice)
+		tts.load_diffusion_model(settings['diffusion_model'])
+	
+	if settings['tokenizer_json'] is not None:
+		tts.load_tokenizer_json(settings['tokenizer_json'])
+
+	settings['voice_samples'], settings['conditioning_latents'], _ = fetch_tortoise_voice(selected_voice, parameters, voice_cache, progress=progress)
+
+	# clamp it down for the insane users who want this
+	# it would be wiser to enforce the sample size to the batch size, but this is what the user wants
+	settings['sample_batch_size'] = args.sample_batch_size
+	if not settings['sample_batch_size']:
+		settings['sample_batch_size'] = tts.autoregressive_batch_size
+	if settings['num_autoregressive_samples'] < settings['sample_batch_size']:
+		settings['sample_batch_size'] = settings['num_autoregressive_samples']
+
+	if settings['conditioning_latents'] is not None and len(settings['conditioning_latents']) == 2 and settings['cvvp_amount'] > 0:
+		print("Requesting weighing against CVVP weight, but voice latents are missing some extra data. Please regenerate your voice latents with 'Slimmer voice latents' unchecked.")
+		settings['cvvp_amount'] = 0
+		
+	return settings
+
+# resolves a request's voice (computing its latents if needed) ahead of generate_tortoise, for requests that generate
+# together: computing latents moves models around, so it can't happen while another request samples or decodes
+def prepare_tortoise_voice(**kwargs):
+	parameters = {}
+	parameters.update(kwargs)
+	if parameters['seed'] == 0:
+		parameters['seed'] = None
+
+	if not tts:
+		if tts_loading:
+			raise Exception("TTS is still initializing...")
+		load_tts()
+
+	voice_cache = {}
+	get_tortoise_settings( parameters, voice_cache )
+	return voice_cache
+
 def generate_tortoise(**kwargs):
 	parameters = {}
 	parameters.update(kwargs)
@@ -996,116 +1171,14 @@ def generate_tortoise(**kwargs):
 	conditioning_latents = None
 	sample_voice = None
 
-	voice_cache = {}
-	def fetch_voice( voice ):
-		cache_key = f'{voice}:{tts.autoregressive_model_hash[:8]}'
-		if cache_key in voice_cache:
-			return voice_cache[cache_key]
-
-		print(f"Loading voice: {voice} with model {tts.autoregressive_model_hash[:8]}")
-		sample_voice = None
-		if voice == "microphone":
-			if parameters['mic_audio'] is None:
-				raise Exception("Please provide audio from mic when choosing `microphone` as a voice input")
-			voice_samples, conditioning_latents = [load_audio(parameters['mic_audio'], tts.input_sample_rate)], None
-		elif voice == "random":
-			voice_samples, conditioning_latents = None, tts.get_random_conditioning_latents()
-		else:
-			if progress is not None:
-				notify_progress(f"Loading voice: {voice}", progress=progress)
-
-			voice_samples, conditioning_latents = load_voice(voice, model_hash=tts.autoregressive_model_hash)
-			
-		if voice_samples and len(voice_samples) > 0:
-			if conditioning_latents is None:
-				conditioning_latents = compute_latents(voice=voice, voice_samples=voice_samples, voice_latents_chunks=parameters['voice_latents_chunks'])
-				
-			sample_voice = torch.cat(voice_samples, dim=-1).squeeze().cpu()
-			voice_samples = None
-
-		voice_cache[cache_key] = (voice_samples, conditioning_latents, sample_voice)
-		return voice_cache[cache_key]
-
+	# a voice resolved up front with prepare_tortoise_voice, so its latents aren't computed in the middle of a batch
+	voice_cache = parameters.pop('voice_cache', None)
+	if voice_cache is None:
+		voice_cache = {}
 	def get_settings( override=None ):
-		settings = {
-			'temperature': float(parameters['temperature']),
-
-			'top_p': float(parameters['top_p']),
-			'diffusion_temperature': float(parameters['diffusion_temperature']),
-			'length_penalty': float(parameters['length_penalty']),
-			'repetition_penalty': float(parameters['repetition_penalty']),
-			'cond_free_k': float(parameters['cond_free_k']),
-
-			'num_autoregressive_samples': parameters['num_autoregressive_samples'],
-			'sample_batch_size': args.sample_batch_size,
-			'diffusion_iterations': parameters['diffusion_iterations'],
-
-			'voice_samples': None,
-			'conditioning_latents': None,
-
-			'use_deterministic_seed': parameters['seed'],
-			'return_deterministic_state': True,
-			'k': parameters['candidates'],
-			'diffusion_sampler': parameters['diffusion_sampler'],
-			'breathing_room': parameters['breathing_room'],
-			'half_p': "Half Precision" in parameters['experimentals'],
-			'cond_free': "Conditioning-Free" in parameters['experimentals'],
-			'cvvp_amount': parameters['cvvp_weight'],
-			
-			'autoregressive_model': args.autoregressive_model,
-			'diffusion_model': args.diffusion_model,
-			'tokenizer_json': args.tokenizer_json,
-		}
-
-		# could be better to just do a ternary on everything above, but i am not a professional
-		selected_voice = voice
-		if override is not None:
-			if 'voice' in override:
-				selected_voice = override['voice']
-
-			for k in override:
-				if k not in settings:
-					continue
-				settings[k] = override[k]
-
-		if settings['autoregressive_model'] is not None:
-			if settings['autoregressive_model'] == "auto":
-				settings['autoregressive_model'] = deduce_autoregressive_model(selected_voice)
-			tts.load_autoregressive_model(settings['autoregressive_model'])
-
-		if settings['diffusion_model'] is not None:
-			if settings['diffusion_model'] == "auto":
-				settings['diffusion_model'] = deduce_diffusion_model(selected_voice)
-			tts.load_diffusion_model(settings['diffusion_model'])
-		
-		if settings['tokenizer_json'] is not None:
-			tts.load_tokenizer_json(settings['tokenizer_json'])
-
-		settings['voice_samples'], settings['conditioning_latents'], _ = fetch_voice(voice=selected_voice)
-
-		# clamp it down for the insane users who want this
-		# it would be wiser to enforce the sample size to the batch size, but this is what the user wants
-		settings['sample_batch_size'] = args.sample_batch_size
-		if not settings['sample_batch_size']:
-			settings['sample_batch_size'] = tts.autoregressive_batch_size
-		if settings['num_autoregressive_samples'] < settings['sample_batch_size']:
-			settings['sample_batch_size'] = settings['num_autoregressive_samples']
-
-		if settings['conditioning_latents'] is not None and len(settings['conditioning_latents']) == 2 and settings['cvvp_amount'] > 0:
-			print("Requesting weighing against CVVP weight, but voice latents are missing some extra data. Please regenerate your voice latents with 'Slimmer voice latents' unchecked.")
-			settings['cvvp_amount'] = 0
-			
-		return settings
-
-	if not parameters['delimiter']:
-		parameters['delimiter'] = "\n"
-	elif parameters['delimiter'] == "\\n":
-		parameters['delimiter'] = "\n"
+		return get_tortoise_settings( parameters, voice_cache, override=override, progress=progress )
 
-	if parameters['delimiter'] and parameters['delimiter'] != "" and parameters['delimiter'] in parameters['text']:
-		texts = parameters['text'].split(parameters['delimiter'])
-	else:
-		texts = split_and_recombine_text(parameters['text'])
+	texts = get_generate_texts( parameters )
  
 	full_start_time = time.time()
  
@@ -1116,23 +1189,7 @@ def generate_tortoise(**kwargs):
 
 	volume_adjust = torchaudio.transforms.Vol(gain=args.output_volume, gain_type="amplitude") if args.output_volume != 1 else None
 
-	idx = 0
-	idx_cache = {}
-	for i, file in enumerate(os.listdir(outdir)):
-		filename = os.path.basename(file)
-		extension = os.path.splitext(filename)[-1][1:]
-		if extension != "json" and extension != "wav":
-			continue
-		match = re.findall(rf"^{voice}_(\d+)(?:.+?)?{extension}$", filename)
-		if match and len(match) > 0:
-			key = int(match[0])
-			idx_cache[key] = True
-
-	if len(idx_cache) > 0:
-		keys = sorted(list(idx_cache.keys()))
-		idx = keys[-1] + 1
-
-	idx = pad(idx, 4)
+	idx = pad(reserve_output_idx(outdir, voice), 4)
 
 	def get_name(line=0, candidate=0, combined=False):
 		name = f"{idx}"
@@ -1172,6 +1229,9 @@ def generate_tortoise(**kwargs):
 				if settings['cond_free']:
 					info['experimentals'].append("Conditioning-Free")
 
+			if 'num_autoregressive_samples_used' in settings:
+				info['num_autoregressive_samples_used'] = settings['num_autoregressive_samples_used']
+
 		if latents and "latents" not in info:
 			voice = info['voice']
 			model_hash = settings["model_hash"][:8] if settings is not None and "model_hash" in settings else tts.autoregressive_model_hash[:8]
@@ -1195,14 +1255,7 @@ def generate_tortoise(**kwargs):
 
 	INFERENCING = True
 	for line, cut_text in enumerate(texts):
-		if should_phonemize():
-			cut_text = phonemizer( cut_text )
-
-		if parameters['emotion'] == "Custom":
-			if parameters['prompt'] and parameters['prompt'].strip() != "":
-				cut_text = f"[{parameters['prompt']},] {cut_text}"
-		elif parameters['emotion'] != "None" and parameters['emotion']:
-			cut_text = f"[I am really {parameters['emotion'].lower()},] {cut_text}"
+		cut_text = format_generate_line( parameters, cut_text )
 		
 		tqdm_prefix = f'[{str(line+1)}/{str(len(texts))}]'
 		print(f"{tqdm_prefix} Generating line: {cut_text}")
@@ -1223,6 +1276,7 @@ def generate_tortoise(**kwargs):
 		gen, additionals = tts.tts(cut_text, **settings )
 
 		parameters['seed'] = additionals[0]
+		settings['num_autoregressive_samples_used'] = additionals[4]
 		run_time = time.time()-start_time
 		print(f"Generating line took {run_time} seconds")
 
@@ -1364,6 +1418,73 @@ def generate_tortoise(**kwargs):
 		stats,
 	)
 
+def generate_stream(**kwargs):
+	"""
+	Streaming flavor of generate_tortoise: yields each line's audio as soon as it is vocoded instead of writing WAVs at
+	the end. Every yield is a dict carrying the line's index and text, the best candidate resampled to the output
+	sample rate, and the same audio as mono PCM16 bytes ready to be sent over the wire.
+	"""
+	parameters = {}
+	parameters.update(kwargs)
+
+	if parameters['seed'] == 0:
+		parameters['seed'] = None
+
+	global args
+	global tts
+	global INFERENCING
+
+	if args.tts_backend != "tortoise":
+		raise Exception("Streaming generation is only supported with the TorToiSe backend")
+
+	unload_whisper()
+	unload_voicefixer()
+
+	if not tts:
+		# should check if it's loading or unloaded, and load it if it's unloaded
+		if tts_loading:
+			raise Exception("TTS is still initializing...")
+		load_tts()
+	if hasattr(tts, "loading") and tts.loading:
+		raise Exception("TTS is still initializing...")
+
+	do_gc()
+
+	texts = []
+	for cut_text in get_generate_texts( parameters ):
+		cut_text = format_generate_line( parameters, cut_text )
+		if re.findall(r'^(\{.+\}) (.+?)$', cut_text):
+			raise Exception("Prompt settings editing is not supported when streaming")
+		texts.append(cut_text)
+
+	settings = get_tortoise_settings( parameters, {} )
+	del settings['return_deterministic_state']
+
+	volume_adjust = torchaudio.transforms.Vol(gain=args.output_volume, gain_type="amplitude") if args.output_volume != 1 else None
+
+	INFERENCING = True
+	try:
+		start_time = time.time()
+		for line, gen in tts.tts_stream(texts, **settings):
+			if isinstance(gen, list):
+				gen = gen[0]
+
+			audio, sample_rate = resample(gen.squeeze(0).cpu(), tts.output_sample_rate, args.output_sample_rate)
+			if volume_adjust is not None:
+				audio = volume_adjust(audio)
+
+			print(f"[{line+1}/{len(texts)}] Streamed line after {time.time()-start_time} seconds: {texts[line]}")
+			yield {
+				'line': line,
+				'text': texts[line],
+				'audio': audio,
+				'sample_rate': sample_rate,
+				'pcm16': (audio.clamp(-1, 1) * 32767).to(torch.int16).numpy().tobytes(),
+			}
+	finally:
+		INFERENCING = False
+		do_gc()
+
 def cancel_generate():
 	if not INFERENCING:
 		return
@@ -1408,20 +1529,10 @@ def update_baseline_for_latents_chunks( voice ):
 	if os.path.exists(dataset_file):
 		return 0 # 0 will leverage using the LJspeech dataset for computing latents
 
-	files = os.listdir(path)
+	durations = get_voice_index().get_durations(voice, extensions=["wav"])
 	
-	total = 0
-	total_duration = 0
-
-	for file in files:
-		if file[-4:] != ".wav":
-			continue
-
-		metadata = torchaudio.info(f'{path}/{file}')
-		duration = metadata.num_frames / metadata.sample_rate
-		total_duration += duration
-		total = total + 1
-
+	total = len(durations)
+	total_duration = sum(durations.values())
 
 	# brain too fried to figure out a better way
 	if args.autocalculate_voice_chunk_duration_size == 0:
@@ -1450,6 +1561,7 @@ def compute_latents(voice=None, voice_samples=None, voice_latents_chunks=0, orig
 	if args.autoregressive_model == "auto":
 		tts.load_autoregressive_model(deduce_autoregressive_model(voice))
 
+	requested_chunks = voice_latents_chunks
 	if voice:
 		load_from_dataset = voice_latents_chunks == 0
 
@@ -1485,6 +1597,8 @@ def compute_latents(voice=None, voice_samples=None, voice_latents_chunks=0, orig
 	if voice_samples is None:
 		return
 
+	latents_key = latents_cache.get_key( voice, requested_chunks ) if voice and not original_ar and not original_diffusion else None
+
 	conditioning_latents = tts.get_conditioning_latents(voice_samples, return_mels=not args.latents_lean_and_mean, slices=voice_latents_chunks, force_cpu=args.force_cpu_for_conditioning_latents, original_ar=original_ar, original_diffusion=original_diffusion)
 
 	if len(conditioning_latents) == 4:
@@ -1494,8 +1608,99 @@ def compute_latents(voice=None, voice_samples=None, voice_latents_chunks=0, orig
 	torch.save(conditioning_latents, outfile)
 	print(f'Saved voice latents: {outfile}')
 
+	if latents_key is not None:
+		latents_cache.put( voice, latents_key, conditioning_latents )
+
 	return conditioning_latents
 
+# process-wide cache of conditioning latents, so repeated requests for a voice skip both disk and get_conditioning_latents
+# entries are keyed by the content of the voice's clips, the models in use, and the chunk count, so they never go stale
+class ConditioningLatentsCache():
+	def __init__(self):
+		self.entries = OrderedDict()
+		self.size = 0
+		self.file_hashes = {}
+		self.lock = threading.Lock()
+
+	# hashing a clip's content is only redone when its mtime or size changes
+	def hash_file( self, path ):
+		stat = os.stat(path)
+		signature = (stat.st_mtime_ns, stat.st_size)
+		with self.lock:
+			cached = self.file_hashes.get(path)
+		if cached is None or cached[0] != signature:
+			cached = (signature, hash_file(path, algo="sha1", buffer_size=1024 * 1024))
+			with self.lock:
+				self.file_hashes[path] = cached
+		return cached[1]
+
+	def get_key( self, voice, chunks ):
+		files = get_voice(name=voice, load_latents=False, extensions=["wav", "mp3", "flac"])
+		if not files:
+			return None
+
+		# a chunk count of 0 computes from the voice's dataset instead, if it has one
+		dataset_path = f'./training/{voice}/train.txt'
+		if not chunks and os.path.exists(dataset_path):
+			files = files + [dataset_path]
+
+		content = hashlib.sha1("".join([ self.hash_file(path) for path in files ]).encode()).hexdigest()
+		return ( content, tts.autoregressive_model_hash, tts.diffusion_model_hash, chunks )
+
+	def get_path( self, voice, key ):
+		digest = hashlib.sha1(":".join([ f'{k}' for k in key ]).encode()).hexdigest()
+		return f'{get_voice_dir()}/{voice}/cond_latents_{key[1][:8]}_{digest[:16]}.pth'
+
+	def get( self, voice, key ):
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				return self.entries[key][0]
+
+		path = self.get_path( voice, key )
+		if not os.path.exists(path):
+			return None
+
+		print(f"Reading from cached latents: {path}")
+		conditioning_latents = torch.load(path, map_location='cpu')
+		self.store( key, conditioning_latents )
+		return conditioning_latents
+
+	def put( self, voice, key, conditioning_latents ):
+		self.store( key, conditioning_latents )
+
+		path = self.get_path( voice, key )
+		if os.path.exists(path):
+			return
+		torch.save(conditioning_latents, path)
+
+		# only the newest entry per model is kept on disk, so edits to a voice's clips don't pile up files in its folder
+		for stale in glob(f'{get_voice_dir()}/{voice}/cond_latents_{key[1][:8]}_*.pth'):
+			if os.path.normpath(stale) == os.path.normpath(path):
+				continue
+			try:
+				os.remove(stale)
+			except Exception as e:
+				print(f"Failed to remove stale latents: {stale}", e)
+
+	def store( self, key, conditioning_latents ):
+		size = sum([ latent.numel() * latent.element_size() for latent in conditioning_latents if latent is not None ])
+		budget = args.latents_cache_size * 1024 * 1024
+
+		with self.lock:
+			if key in self.entries:
+				self.size -= self.entries.pop(key)[1]
+			if size > budget:
+				return
+
+			self.entries[key] = (conditioning_latents, size)
+			self.size += size
+			while self.size > budget:
+				_, (_, evicted) = self.entries.popitem(last=False)
+				self.size -= evicted
+
+latents_cache = ConditioningLatentsCache()
+
 # superfluous, but it cleans up some things
 class TrainingState():
 	def __init__(self, config_path, keep_x_past_checkpoints=0, start=True):
@@ -1563,13 +1768,17 @@ class TrainingState():
 		if keep_x_past_checkpoints > 0:
 			self.cleanup_old(keep=keep_x_past_checkpoints)
 		if start:
-			self.spawn_process(config_path=config_path, gpus=self.gpus)
+			self.spawn_process(config_path=config_path, gpus=self.gpus, keep_x_past_checkpoints=keep_x_past_checkpoints)
 
-	def spawn_process(self, config_path, gpus=1):
+	def spawn_process(self, config_path, gpus=1, keep_x_past_checkpoints=0):
 		if args.tts_backend == "vall-e":
 			self.cmd = ['deepspeed', f'--num_gpus={gpus}', '--module', 'vall_e.train', f'yaml="{config_path}"']
 		else:
 			self.cmd = ['train.bat', config_path] if os.name == "nt" else ['./train.sh', config_path]
+			# checkpoints are written in the background, so the trainer prunes them itself once they're on disk
+			if keep_x_past_checkpoints > 0:
+				# as separate arguments, since batch files split "--flag=value" on the "=" anyways
+				self.cmd += ['--keep-x-past-checkpoints', str(keep_x_past_checkpoints)]
 
 		print("Spawning process: ", " ".join(self.cmd))
 		self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
@@ -1939,8 +2148,6 @@ class TrainingState():
 				self.checkpoint += 1
 				message = f"[{self.checkpoint}/{self.checkpoints}] Saving checkpoint..."
 				percent = self.checkpoint / self.checkpoints
-
-				self.cleanup_old(keep=keep_x_past_checkpoints)
 			elif line.find(MESSAGE_METRICS_TRAINING) >= 0:
 				data = json.loads(line.split(MESSAGE_METRICS_TRAINING)[-1])
 				data['mode'] = "training"
@@ -2243,6 +2450,8 @@ def transcribe_dataset( voice, language=None, skip_existings=False, progress=Non
 	files = get_voice(voice, load_latents=False)
 	indir = f'./training/{voice}/'
 	infile = f'{indir}/whisper.json'
+	# every transcription is appended here as it completes, and only folded into whisper.json once at the end
+	journal_file = f'{indir}/whisper.journal.jsonl'
 
 	quantize_in_memory = args.tts_backend == "vall-e"
 	
@@ -2257,43 +2466,103 @@ def transcribe_dataset( voice, language=None, skip_existings=False, progress=Non
 	if os.path.exists(infile):
 		results = json.load(open(infile, 'r', encoding="utf-8"))
 
-	for file in tqdm(files, desc="Iterating through voice files"):
-		basename = os.path.basename(file)
+	# replay a journal left behind by an interrupted run
+	if os.path.exists(journal_file):
+		with open(journal_file, 'r', encoding="utf-8") as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except Exception as e:
+					print("Ignoring incomplete journal record:", e)
+					continue
+				results[record['file']] = record['result']
+
+	# resampling and saving the audio happens on a background thread, so whisper never waits on the disk
+	def write_audio( file, basename ):
+		waveform, sample_rate = torchaudio.load(file)
+		# resample to the input rate, since it'll get resampled for training anyways
+		# this should also "help" increase throughput a bit when filling the dataloaders
+		waveform, sample_rate = resample(waveform, sample_rate, TARGET_SAMPLE_RATE)
+		if waveform.shape[0] == 2:
+			waveform = waveform[:1]
+		
+		kwargs = {}
+		if basename[-4:] == ".wav":
+			kwargs['encoding'] = "PCM_S"
+			kwargs['bits_per_sample'] = 16
+
+		torchaudio.save(f"{indir}/audio/{basename}", waveform, sample_rate, **kwargs)
+
+	# a file is only journaled once its audio is saved, so a resumed run never skips a file whose audio is missing
+	write_queue = queue.Queue(maxsize=16)
+	writer_errors = []
+	unsaved = []
+	def audio_writer():
+		with open(journal_file, 'a', encoding="utf-8") as journal:
+			while True:
+				job = write_queue.get()
+				if job is None:
+					break
+				if len(writer_errors) > 0:
+					continue
+				file, basename, result = job
+				if not quantize_in_memory:
+					try:
+						write_audio( file, basename )
+					except Exception as e:
+						# left out of the journal (and whisper.json), so the next run transcribes it again
+						print("Failed to save audio:", file, e)
+						unsaved.append(basename)
+						continue
+
+				# only a broken journal stops the run
+				try:
+					journal.write(json.dumps({ 'file': basename, 'result': result }) + "\n")
+					journal.flush()
+					os.fsync(journal.fileno())
+				except Exception as e:
+					writer_errors.append(e)
 
-		if basename in results and skip_existings:
-			print(f"Skipping already parsed file: {basename}")
-			continue
+	writer = threading.Thread(target=audio_writer, daemon=True)
+	writer.start()
 
-		try:
-			result = whisper_transcribe(file, language=language)
-		except Exception as e:
-			print("Failed to transcribe:", file, e)
-			continue
+	try:
+		for file in tqdm(files, desc="Iterating through voice files"):
+			if len(writer_errors) > 0:
+				break
 
-		results[basename] = result
+			basename = os.path.basename(file)
 
-		if not quantize_in_memory:
-			waveform, sample_rate = torchaudio.load(file)
-			# resample to the input rate, since it'll get resampled for training anyways
-			# this should also "help" increase throughput a bit when filling the dataloaders
-			waveform, sample_rate = resample(waveform, sample_rate, TARGET_SAMPLE_RATE)
-			if waveform.shape[0] == 2:
-				waveform = waveform[:1]
-			
-			try:
-				kwargs = {}
-				if basename[-4:] == ".wav":
-					kwargs['encoding'] = "PCM_S"
-					kwargs['bits_per_sample'] = 16
+			if basename in results and skip_existings:
+				print(f"Skipping already parsed file: {basename}")
+				continue
 
-				torchaudio.save(f"{indir}/audio/{basename}", waveform, sample_rate, **kwargs)
+			try:
+				result = whisper_transcribe(file, language=language)
 			except Exception as e:
-				print(e)
+				print("Failed to transcribe:", file, e)
+				continue
 
-		with open(infile, 'w', encoding="utf-8") as f:
-			f.write(json.dumps(results, indent='\t'))
+			results[basename] = result
+			write_queue.put((file, basename, result))
 
-		do_gc()
+			do_gc()
+	finally:
+		write_queue.put(None)
+		writer.join()
+
+	# whatever was journaled before the failure is kept for the next run
+	if len(writer_errors) > 0:
+		raise Exception(f"Failed to write the transcription journal for {voice}: {writer_errors[0]}") from writer_errors[0]
+
+	for basename in unsaved:
+		results.pop(basename, None)
+
+	# compact the journal into whisper.json
+	with open(f'{infile}.tmp', 'w', encoding="utf-8") as f:
+		f.write(json.dumps(results, indent='\t'))
+	os.replace(f'{infile}.tmp', infile)
+	os.remove(journal_file)
 
 	modified = False
 	for basename in results:
@@ -2499,7 +2768,7 @@ def should_phonemize():
 			return False
 	return should
 
-def prepare_dataset( voice, use_segments=False, text_length=0, audio_length=0, progress=gr.Progress() ):
+def prepare_dataset( voice, use_segments=False, text_length=0, audio_length=0, precompute_codes=False, progress=gr.Progress() ):
 	indir = f'./training/{voice}/'
 	infile = f'{indir}/whisper.json'
 	if not os.path.exists(infile):
@@ -2774,8 +3043,34 @@ def prepare_dataset( voice, use_segments=False, text_length=0, audio_length=0, p
 		f.write(validation_joined)
 
 	messages.append(f"Prepared {len(lines['training'])} lines (validation: {len(lines['validation'])}, culled: {errored}).\n{training_joined}\n\n{validation_joined}")
+
+	if precompute_codes and args.tts_backend == "tortoise":
+		messages.append(precompute_dataset_codes( voice ))
+
 	return "\n".join(messages)
 
+def precompute_dataset_codes( voice ):
+	indir = f'./training/{voice}/'
+	outdir = f'{indir}/codes/'
+
+	try:
+		from dlas.scripts.audio.preparation.precompute_dvae_codes import precompute_dvae_codes
+	except Exception as e:
+		message = f"DLAS not available, cannot precompute DVAE codes: {e}"
+		print(message)
+		return message
+
+	paths = [ f'{indir}/{name}.txt' for name in ['train', 'validation'] if os.path.exists(f'{indir}/{name}.txt') ]
+	precompute_dvae_codes( paths, outdir, './models/tortoise/train_diffusion_vocoder_22k_level.yml',
+		mel_norm_file='./modules/tortoise-tts/tortoise/data/mel_norms.pth',
+		max_wav_length=255995,
+		sample_rate=22050,
+		device='cuda' if get_device_name() == "cuda" else 'cpu',
+	)
+	do_gc()
+
+	return f"Precomputed DVAE codes: {outdir}"
+
 def calc_iterations( epochs, lines, batch_size ):
 	return int(math.ceil(epochs * math.ceil(lines / batch_size)))
 
@@ -2903,6 +3198,17 @@ def save_training_settings( **kwargs ):
 
 	settings['dataset_path'] = f"./training/{settings['voice']}/train.txt"
 	settings['validation_path'] = f"./training/{settings['voice']}/validation.txt"
+	settings['codes_path'] = f"./training/{settings['voice']}/codes"
+
+	# precomputed DVAE codes are only used as long as they are newer than the dataset they were made from
+	codes_index = f"{settings['codes_path']}/index.pth"
+	if args.tts_backend == "tortoise" and os.path.exists(codes_index) and os.path.getmtime(codes_index) >= os.path.getmtime(settings['dataset_path']):
+		settings['dataset_mode'] = 'paired_voice_codes'
+		settings['code_injectors'] = "# paired_mel_codes come precomputed from codes_path"
+		messages.append(f"Using precomputed DVAE codes: {settings['codes_path']}")
+	else:
+		settings['dataset_mode'] = 'paired_voice_audio'
+		settings['code_injectors'] = DVAE_CODE_INJECTORS
 
 	with open(settings['dataset_path'], 'r', encoding="utf-8") as f:
 		lines = len(f.readlines())
@@ -3088,51 +3394,14 @@ def relative_paths( dirs ):
 	return [ './' + os.path.relpath( d ).replace("\\", "/") for d in dirs ]
 
 def get_voice( name, dir=get_voice_dir(), load_latents=True, extensions=["wav", "mp3", "flac"] ):
-	subj = f'{dir}/{name}/'
-	if not os.path.isdir(subj):
-		return
-	files = os.listdir(subj)
-	
 	if load_latents:
-		extensions.append("pth")
-
-	voice = []
-	for file in files:
-		ext = os.path.splitext(file)[-1][1:]
-		if ext not in extensions:
-			continue
-
-		voice.append(f'{subj}/{file}') 
-
-	return sorted( voice )
+		extensions = extensions + ["pth"]
+	return get_voice_index(dir).get_files(name, extensions)
 
+# resolved through the voice index, which only relists a voice folder once its mtime changes
 def get_voice_list(dir=get_voice_dir(), append_defaults=False, extensions=["wav", "mp3", "flac", "pth"]):
 	defaults = [ "random", "microphone" ]
-	os.makedirs(dir, exist_ok=True)
-	#res = sorted([d for d in os.listdir(dir) if d not in defaults and os.path.isdir(os.path.join(dir, d)) and len(os.listdir(os.path.join(dir, d))) > 0 ])
-
-	res = []
-	for name in os.listdir(dir):
-		if name in defaults:
-			continue
-		if not os.path.isdir(f'{dir}/{name}'):
-			continue
-		if len(os.listdir(os.path.join(dir, name))) == 0:
-			continue
-		files = get_voice( name, dir=dir, extensions=extensions )
-
-		if len(files) > 0:
-			res.append(name)
-		else:
-			for subdir in os.listdir(f'{dir}/{name}'):
-				if not os.path.isdir(f'{dir}/{name}/{subdir}'):
-					continue
-				files = get_voice( f'{name}/{subdir}', dir=dir, extensions=extensions )
-				if len(files) == 0:
-					continue
-				res.append(f'{name}/{subdir}')
-
-	res = sorted(res)
+	res = get_voice_index(dir).get_list(extensions)
 	
 	if append_defaults:
 		res = res + defaults
@@ -3287,8 +3556,12 @@ def setup_args(cli=False):
 		'check-for-updates': False,
 		'models-from-local-only': False,
 		'low-vram': False,
+		'offload-budget': 0,
 		'sample-batch-size': None,
 		'unsqueeze-sample-batches': False,
+		'adaptive-sampling-patience': 0,
+		'adaptive-sampling-margin': 0.0,
+		'adaptive-sampling-threshold': None,
 		'embed-output-metadata': True,
 		'latents-lean-and-mean': True,
 		'voice-fixer': False, # getting tired of long initialization times in a Colab for downloading a large dataset for it
@@ -3297,8 +3570,10 @@ def setup_args(cli=False):
 
 		
 		'force-cpu-for-conditioning-latents': False,
+		'latents-cache-size': 512,
 		'defer-tts-load': False,
 		'device-override': None,
+		'device-map': None,
 		'prune-nonfinal-outputs': True,
 		'concurrency-count': 2,
 		'autocalculate-voice-chunk-duration-size': 10,
@@ -3328,7 +3603,8 @@ def setup_args(cli=False):
 
 		'websocket-listen-address': "0.0.0.0",
 		'websocket-listen-port': 8069,
-		'websocket-enabled': False
+		'websocket-enabled': False,
+		'websocket-max-batch-size': 4,
 	}
 
 	if os.path.isfile('./config/exec.json'):
@@ -3347,17 +3623,23 @@ def setup_args(cli=False):
 	parser.add_argument("--check-for-updates", action='store_true', default=default_arguments['check-for-updates'], help="Checks for update on startup")
 	parser.add_argument("--models-from-local-only", action='store_true', default=default_arguments['models-from-local-only'], help="Only loads models from disk, does not check for updates for models")
 	parser.add_argument("--low-vram", action='store_true', default=default_arguments['low-vram'], help="Disables some optimizations that increases VRAM usage")
+	parser.add_argument("--offload-budget", type=int, default=default_arguments['offload-budget'], help="With --low-vram, how many MiB of model weights may stay on the GPU between stages (0 offloads them right after use)")
 	parser.add_argument("--no-embed-output-metadata", action='store_false', default=not default_arguments['embed-output-metadata'], help="Disables embedding output metadata into resulting WAV files for easily fetching its settings used with the web UI (data is stored in the lyrics metadata tag)")
 	parser.add_argument("--latents-lean-and-mean", action='store_true', default=default_arguments['latents-lean-and-mean'], help="Exports the bare essentials for latents.")
 	parser.add_argument("--voice-fixer", action='store_true', default=default_arguments['voice-fixer'], help="Uses python module 'voicefixer' to improve audio quality, if available.")
 	parser.add_argument("--voice-fixer-use-cuda", action='store_true', default=default_arguments['voice-fixer-use-cuda'], help="Hints to voicefixer to use CUDA, if available.")
 	parser.add_argument("--use-deepspeed", action='store_true', default=default_arguments['use-deepspeed'], help="Use deepspeed for speed bump.")
 	parser.add_argument("--force-cpu-for-conditioning-latents", default=default_arguments['force-cpu-for-conditioning-latents'], action='store_true', help="Forces computing conditional latents to be done on the CPU (if you constantyl OOM on low chunk counts)")
+	parser.add_argument("--latents-cache-size", type=int, default=default_arguments['latents-cache-size'], help="How many MiB of conditioning latents are kept in memory between generations")
 	parser.add_argument("--defer-tts-load", default=default_arguments['defer-tts-load'], action='store_true', help="Defers loading TTS model")
 	parser.add_argument("--prune-nonfinal-outputs", default=default_arguments['prune-nonfinal-outputs'], action='store_true', help="Deletes non-final output files on completing a generation")
 	parser.add_argument("--device-override", default=default_arguments['device-override'], help="A device string to override pass through Torch")
+	parser.add_argument("--device-map", default=default_arguments['device-map'], help="Places TorToiSe's models on separate devices, e.g. \"autoregressive=cuda:0,diffusion=cuda:1\" (join devices with + to split the autoregressive model's layers across them)")
 	parser.add_argument("--sample-batch-size", default=default_arguments['sample-batch-size'], type=int, help="Sets how many batches to use during the autoregressive samples pass")
 	parser.add_argument("--unsqueeze-sample-batches", default=default_arguments['unsqueeze-sample-batches'], action='store_true', help="Unsqueezes sample batches to process one by one after sampling")
+	parser.add_argument("--adaptive-sampling-patience", type=int, default=default_arguments['adaptive-sampling-patience'], help="Stops drawing autoregressive samples once the best CLVP score has not improved for this many batches (0 to disable)")
+	parser.add_argument("--adaptive-sampling-margin", type=float, default=default_arguments['adaptive-sampling-margin'], help="How much the best CLVP score has to improve by for a batch to count as an improvement")
+	parser.add_argument("--adaptive-sampling-threshold", type=float, default=default_arguments['adaptive-sampling-threshold'], help="Stops drawing autoregressive samples once a candidate reaches this CLVP score")
 	parser.add_argument("--concurrency-count", type=int, default=default_arguments['concurrency-count'], help="How many Gradio events to process at once")
 	parser.add_argument("--autocalculate-voice-chunk-duration-size", type=float, default=default_arguments['autocalculate-voice-chunk-duration-size'], help="Number of seconds to suggest voice chunk size for (for example, 100 seconds of audio at 10 seconds per chunk will suggest 10 chunks)")
 	parser.add_argument("--output-sample-rate", type=int, default=default_arguments['output-sample-rate'], help="Sample rate to resample the output to (from 24KHz)")
@@ -3386,6 +3668,7 @@ def setup_args(cli=False):
 	parser.add_argument("--websocket-listen-port", type=int, default=default_arguments['websocket-listen-port'], help="Websocket server listen port, default: 8069")
 	parser.add_argument("--websocket-listen-address", default=default_arguments['websocket-listen-address'], help="Websocket server listen address, default: 0.0.0.0")
 	parser.add_argument("--websocket-enabled", action='store_true', default=default_arguments['websocket-enabled'], help="Websocket API server enabled, default: false")
+	parser.add_argument("--websocket-max-batch-size", type=int, default=default_arguments['websocket-max-batch-size'], help="How many compatible websocket requests can be generated together, default: 4")
 
 	if cli:
 		args, unknown = parser.parse_known_args()
@@ -3425,14 +3708,20 @@ def get_default_settings( hypenated=True ):
 		'listen': None if not args.listen else args.listen,
 		'share': args.share,
 		'low-vram':args.low_vram,
+		'offload-budget': args.offload_budget,
 		'check-for-updates':args.check_for_updates,
 		'models-from-local-only':args.models_from_local_only,
 		'force-cpu-for-conditioning-latents': args.force_cpu_for_conditioning_latents,
+		'latents-cache-size': args.latents_cache_size,
 		'defer-tts-load': args.defer_tts_load,
 		'prune-nonfinal-outputs': args.prune_nonfinal_outputs,
 		'device-override': args.device_override,
+		'device-map': args.device_map,
 		'sample-batch-size': args.sample_batch_size,
 		'unsqueeze-sample-batches': args.unsqueeze_sample_batches,
+		'adaptive-sampling-patience': args.adaptive_sampling_patience,
+		'adaptive-sampling-margin': args.adaptive_sampling_margin,
+		'adaptive-sampling-threshold': args.adaptive_sampling_threshold,
 		'embed-output-metadata': args.embed_output_metadata,
 		'latents-lean-and-mean': args.latents_lean_and_mean,
 		'voice-fixer': args.voice_fixer,
@@ -3480,12 +3769,18 @@ def update_args( **kwargs ):
 	args.check_for_updates = settings['check_for_updates']
 	args.models_from_local_only = settings['models_from_local_only']
 	args.low_vram = settings['low_vram']
+	args.offload_budget = settings['offload_budget']
 	args.force_cpu_for_conditioning_latents = settings['force_cpu_for_conditioning_latents']
+	args.latents_cache_size = settings['latents_cache_size']
 	args.defer_tts_load = settings['defer_tts_load']
 	args.prune_nonfinal_outputs = settings['prune_nonfinal_outputs']
 	args.device_override = settings['device_override']
+	args.device_map = settings['device_map']
 	args.sample_batch_size = settings['sample_batch_size']
 	args.unsqueeze_sample_batches = settings['unsqueeze_sample_batches']
+	args.adaptive_sampling_patience = settings['adaptive_sampling_patience']
+	args.adaptive_sampling_margin = settings['adaptive_sampling_margin']
+	args.adaptive_sampling_threshold = settings['adaptive_sampling_threshold']
 	args.embed_output_metadata = settings['embed_output_metadata']
 	args.latents_lean_and_mean = settings['latents_lean_and_mean']
 	args.voice_fixer = settings['voice_fixer']
@@ -3622,9 +3917,29 @@ def version_check_tts( min_version ):
 		return True
 	return False
 
+def parse_device_map( device_map ):
+	if not device_map:
+		return None
+	if isinstance(device_map, dict):
+		return device_map
+
+	res = {}
+	for entry in device_map.split(","):
+		entry = entry.strip()
+		if not entry:
+			continue
+		if "=" not in entry:
+			raise Exception(f"Invalid device map entry: {entry} (expected model=device)")
+		model, device = [ s.strip() for s in entry.split("=", 1) ]
+		if model not in ["autoregressive", "clvp", "diffusion", "vocoder"]:
+			raise Exception(f"Invalid device map entry: {entry} (unknown model: {model})")
+		devices = [ d.strip() for d in device.split("+") ]
+		res[model] = devices if len(devices) > 1 else devices[0]
+	return res
+
 def load_tts( restart=False, 
 	# TorToiSe configs
-	autoregressive_model=None, diffusion_model=None, vocoder_model=None, tokenizer_json=None,
+	autoregressive_model=None, diffusion_model=None, vocoder_model=None, tokenizer_json=None, device_map=None,
 	# VALL-E configs
 	valle_model=None,
 ):
@@ -3659,11 +3974,16 @@ def load_tts( restart=False,
 		else:
 			tokenizer_json = args.tokenizer_json
 
+		if device_map:
+			args.device_map = device_map
+		else:
+			device_map = args.device_map
+
 		if get_device_name() == "cpu":
 			print("!!!! WARNING !!!! No GPU available in PyTorch. You may need to reinstall PyTorch.")
 
 		print(f"Loading TorToiSe... (AR: {autoregressive_model}, diffusion: {diffusion_model}, vocoder: {vocoder_model})")
-		tts = TorToise_TTS(minor_optimizations=not args.low_vram, autoregressive_model_path=autoregressive_model, diffusion_model_path=diffusion_model, vocoder_model=vocoder_model, tokenizer_json=tokenizer_json, unsqueeze_sample_batches=args.unsqueeze_sample_batches, use_deepspeed=args.use_deepspeed)
+		tts = TorToise_TTS(minor_optimizations=not args.low_vram, autoregressive_model_path=autoregressive_model, diffusion_model_path=diffusion_model, vocoder_model=vocoder_model, tokenizer_json=tokenizer_json, unsqueeze_sample_batches=args.unsqueeze_sample_batches, use_deepspeed=args.use_deepspeed, device_map=parse_device_map(device_map), offload_budget=args.offload_budget)
 	elif args.tts_backend == "vall-e":
 		if valle_model:
 			args.valle_model = valle_model
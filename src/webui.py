@@ -213,7 +213,7 @@ def diarize_dataset( voice, progress=gr.Progress(track_tqdm=True) ):
 
 	return "\n".join(messages)
 
-def prepare_all_datasets( language, validation_text_length, validation_audio_length, skip_existings, slice_audio, trim_silence, slice_start_offset, slice_end_offset, progress=gr.Progress(track_tqdm=True) ):
+def prepare_all_datasets( language, validation_text_length, validation_audio_length, skip_existings, slice_audio, trim_silence, slice_start_offset, slice_end_offset, precompute_codes=False, progress=gr.Progress(track_tqdm=True) ):
 	kwargs = locals()
 
 	messages = []
@@ -232,12 +232,12 @@ def prepare_all_datasets( language, validation_text_length, validation_audio_len
 			
 	for voice in voices:
 		print("Processing:", voice)
-		message = prepare_dataset( voice, use_segments=slice_audio, text_length=validation_text_length, audio_length=validation_audio_length, progress=progress )
+		message = prepare_dataset( voice, use_segments=slice_audio, text_length=validation_text_length, audio_length=validation_audio_length, precompute_codes=precompute_codes, progress=progress )
 		messages.append(message)
 
 	return "\n".join(messages)
 
-def prepare_dataset_proxy( voice, language, validation_text_length, validation_audio_length, skip_existings, slice_audio, trim_silence, slice_start_offset, slice_end_offset, progress=gr.Progress(track_tqdm=True) ):
+def prepare_dataset_proxy( voice, language, validation_text_length, validation_audio_length, skip_existings, slice_audio, trim_silence, slice_start_offset, slice_end_offset, precompute_codes=False, progress=gr.Progress(track_tqdm=True) ):
 	messages = []
 	
 	message = transcribe_dataset( voice=voice, language=language, skip_existings=skip_existings, progress=progress )
@@ -247,7 +247,7 @@ def prepare_dataset_proxy( voice, language, validation_text_length, validation_a
 		message = slice_dataset( voice, trim_silence=trim_silence, start_offset=slice_start_offset, end_offset=slice_end_offset, results=None, progress=progress )
 		messages.append(message)
 
-	message = prepare_dataset( voice, use_segments=slice_audio, text_length=validation_text_length, audio_length=validation_audio_length, progress=progress )
+	message = prepare_dataset( voice, use_segments=slice_audio, text_length=validation_text_length, audio_length=validation_audio_length, precompute_codes=precompute_codes, progress=progress )
 	messages.append(message)
 
 	return "\n".join(messages)
@@ -421,7 +421,7 @@ def setup_gradio():
 					GENERATE_SETTINGS["experimentals"] = gr.CheckboxGroup(["Half Precision", "Conditioning-Free"], value=["Conditioning-Free"], label="Experimental Flags")
 					GENERATE_SETTINGS["breathing_room"] = gr.Slider(value=8, minimum=1, maximum=32, step=1, label="Pause Size")
 					GENERATE_SETTINGS["diffusion_sampler"] = gr.Radio(
-						["P", "DDIM"], # + ["K_Euler_A", "DPM++2M"],
+						["P", "DDIM", "DPM++2M", "UniPC"], # + ["K_Euler_A"],
 						value="DDIM", label="Diffusion Samplers", type="value"
 					)
 					GENERATE_SETTINGS["cvvp_weight"] = gr.Slider(value=0, minimum=0, maximum=1, label="CVVP Weight")
@@ -510,6 +510,8 @@ def setup_gradio():
 						with gr.Row():
 							DATASET_SETTINGS['slice_start_offset'] = gr.Number(label="Slice Start Offset", value=0)
 							DATASET_SETTINGS['slice_end_offset'] = gr.Number(label="Slice End Offset", value=0)
+						with gr.Row():
+							DATASET_SETTINGS['precompute_codes'] = gr.Checkbox(label="Precompute DVAE Codes", value=False, visible=args.tts_backend=="tortoise")
 
 						transcribe_button = gr.Button(value="Transcribe and Process")
 						transcribe_all_button = gr.Button(value="Transcribe All")
@@ -655,6 +657,8 @@ def setup_gradio():
 					EXEC_SETTINGS['autocalculate_voice_chunk_duration_size'] = gr.Number(label="Auto-Calculate Voice Chunk Duration (in seconds)", precision=0, value=args.autocalculate_voice_chunk_duration_size)
 					EXEC_SETTINGS['output_volume'] = gr.Slider(label="Output Volume", minimum=0, maximum=2, value=args.output_volume)
 					EXEC_SETTINGS['device_override'] = gr.Textbox(label="Device Override", value=args.device_override)
+					EXEC_SETTINGS['device_map'] = gr.Textbox(label="Device Map", placeholder="autoregressive=cuda:0,diffusion=cuda:1", value=args.device_map)
+					EXEC_SETTINGS['offload_budget'] = gr.Number(label="Low VRAM Offload Budget (MiB)", precision=0, value=args.offload_budget)
 
 					EXEC_SETTINGS['results_folder'] = gr.Textbox(label="Results Folder", value=args.results_folder)
 					# EXEC_SETTINGS['tts_backend'] = gr.Dropdown(TTSES, label="TTS Backend", value=args.tts_backend if args.tts_backend else TTSES[0])
@@ -931,6 +935,7 @@ def setup_gradio():
 				DATASET_SETTINGS['slice'],
 				DATASET_SETTINGS['validation_text_length'],
 				DATASET_SETTINGS['validation_audio_length'],
+				DATASET_SETTINGS['precompute_codes'],
 			],
 			outputs=prepare_dataset_output #console_output
 		)
@@ -1,5 +1,5 @@
 call .\venv\Scripts\activate.bat
 set PYTHONUTF8=1
-python ./src/train.py --yaml "%1"
+python ./src/train.py --yaml "%1" %2 %3
 pause
 deactivate
\ No newline at end of file
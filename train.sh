@@ -1,4 +1,4 @@
 #!/bin/bash
 source ./venv/bin/activate
-python3 ./src/train.py --yaml "$1"
+python3 ./src/train.py --yaml "$1" "${@:2}"
 deactivate